@@ -16,6 +16,7 @@ interface Metrics {
   total_tokens: number;
   timestamp: number;
   session_id: string;
+  event_id: string;
   is_cached?: boolean;
   cloud_provider?: string;
   cloud_region?: string;
@@ -1022,8 +1023,9 @@ class EventHandler {
 
 class MetricsAPI {
   static async sendMetrics(submissionType: "direct" | "suggestion"): Promise<void> {
+    // Built once so a stored-and-retried event keeps its event_id (deduplicated server-side)
+    const metrics = this.createMetricsObject(submissionType);
     try {
-      const metrics = this.createMetricsObject(submissionType);
 
       console.log("📊 Sending metrics via background:", metrics);
 
@@ -1052,7 +1054,7 @@ class MetricsAPI {
 
     } catch (error) {
       console.error("❌ Metrics failed, storing locally:", error);
-      await this.storeFailedMetrics(this.createMetricsObject(submissionType));
+      await this.storeFailedMetrics(metrics);
     }
   }
 
@@ -1068,6 +1070,7 @@ class MetricsAPI {
       total_tokens: (state.getInputTokensAfter() || 0) + (state.getOutputTokens() || 0),
       timestamp: Date.now(),
       session_id: state.getSessionId(),
+      event_id: crypto.randomUUID(),
       is_cached: false,
       cloud_provider: detection.cloudProvider,
       cloud_region: detection.cloudRegion,
@@ -1,13 +1,31 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import datetime
-import requests
-from dataclasses import dataclass, asdict
-from typing import Dict, Optional, List
+from typing import Dict, Optional
 import os
+import tempfile
+import threading
+import time
+
+from gaia_common.grid_snapshot import GridSnapshotReader, ZoneReading
+from gaia_common.singleflight import SingleFlight
+from gaia_common.warm_cache import WarmCachePersister
+from gaia_common.metrics import BATCH_SIZE, CACHE_EVENTS, StatsCollector, instrument_app
+from gaia_common.tracing import trace_app
+from impact_tracker import (
+    GRID_SNAPSHOT_ENABLED, GRID_SNAPSHOT_MAX_AGE, GRID_SNAPSHOT_NAME,
+    EnvironmentalImpactTracker, fetch_zone_reading
+)
 
 app = Flask(__name__)
 
+# ✅ Prometheus-style metrics at /metrics (bearer token required when METRICS_TOKEN is set)
+instrument_app(app, token=os.getenv("METRICS_TOKEN"))
+
+# ✅ Request IDs (X-Request-ID from the Node worker is echoed back), span timing
+# (sampled, or X-Gaia-Trace: 1 with the DEBUG_TOKEN), profiling + /debug/traces
+trace_app(app, sample_rate=float(os.getenv("TRACE_SAMPLE_RATE", 0)), debug_token=os.getenv("DEBUG_TOKEN"))
+
 # ✅ CORS Configuration
 CORS(app, resources={
     r"/*": {
@@ -21,284 +39,143 @@ CORS(app, resources={
     }
 })
 
+# ✅ Grid intensity shared by all workers on this host (see gunicorn.conf.py)
+grid_snapshot = (
+    GridSnapshotReader(GRID_SNAPSHOT_NAME, max_age=GRID_SNAPSHOT_MAX_AGE)
+    if GRID_SNAPSHOT_ENABLED else None
+)
+
+# ✅ Per-process zone cache used when the snapshot has no reading; concurrent
+# misses for a zone share one API call and wait at most COALESCE_TIMEOUT
+GRID_CACHE_SECONDS = float(os.getenv("GRID_CACHE_SECONDS", 300))
+COALESCE_TIMEOUT = float(os.getenv("UPSTREAM_COALESCE_TIMEOUT_SECONDS", 10))
+
+zone_readings: Dict[str, ZoneReading] = {}
+grid_flights = SingleFlight(timeout=COALESCE_TIMEOUT)
+
+SNAPSHOT_HIT = CACHE_EVENTS.labels("grid_snapshot", "hit")
+SNAPSHOT_MISS = CACHE_EVENTS.labels("grid_snapshot", "miss")
+ZONE_CACHE_HIT = CACHE_EVENTS.labels("zone_readings", "hit")
+ZONE_CACHE_MISS = CACHE_EVENTS.labels("zone_readings", "miss")
+ZONE_CACHE_STALE = CACHE_EVENTS.labels("zone_readings", "stale")
+
+# ✅ Warm-cache snapshot of zone_readings, restored before serving
+WARM_CACHE_ENABLED = os.getenv("WARM_CACHE_ENABLED", "true").lower() == "true"
+WARM_CACHE_PATH = os.getenv(
+    "WARM_CACHE_PATH", os.path.join(tempfile.gettempdir(), "gaia_calculator_warm_cache.bin")
+)
+WARM_CACHE_SAVE_SECONDS = float(os.getenv("WARM_CACHE_SAVE_SECONDS", 60))
+
 # =========================
-# DATA MODELS
+# SERVICE TRACKER
 # =========================
 
-@dataclass
-class ModelSpec:
-    parameters_billion: float
-    energy_per_1k_tokens_kwh: float
-    provider: str
-    architecture: str
-
-
-@dataclass
-class GridSpec:
-    carbon_intensity_g_per_kwh: float
-    grid_zone: str
-    timestamp: str
-    source: str
+class ServiceImpactTracker(EnvironmentalImpactTracker):
+    """EnvironmentalImpactTracker that reads the shared snapshot and the per-process zone cache"""
+
+    def _shared_reading(self, zone: str) -> Optional[ZoneReading]:
+        if grid_snapshot is None:
+            return None
+        reading = grid_snapshot.get(zone)
+        (SNAPSHOT_HIT if reading is not None else SNAPSHOT_MISS).inc()
+        return reading
+
+    def _live_reading(self, zone: str) -> ZoneReading:
+        return cached_zone_reading(zone, self.api_key)
+
+
+def cached_zone_reading(zone: str, api_key: Optional[str]) -> ZoneReading:
+    """fetch_zone_reading() behind the per-process cache, one in-flight call per zone"""
+    def fresh():
+        reading = zone_readings.get(zone)
+        if reading is not None and time.time() - reading.fetched_at < GRID_CACHE_SECONDS:
+            return reading
+        return None
+
+    def fetch():
+        # Another request may have refilled it while this one was waiting to lead
+        reading = fresh()
+        if reading is None:
+            reading = fetch_zone_reading(zone, api_key)
+            zone_readings[zone] = reading
+        return reading
+
+    reading = fresh()
+    if reading is not None:
+        ZONE_CACHE_HIT.inc()
+        return reading
+    (ZONE_CACHE_STALE if zone in zone_readings else ZONE_CACHE_MISS).inc()
+    return grid_flights.do(zone, fetch)
+
+
+def export_warm_cache() -> Dict[str, Dict]:
+    """zone_readings as warm-cache snapshot sections"""
+    return {
+        "intensity": {
+            zone: (reading.fetched_at, list(reading))
+            for zone, reading in list(zone_readings.items())
+        }
+    }
 
 
-# =========================
-# CORE TRACKER
-# =========================
+def restore_warm_cache(snapshot, api_key: Optional[str]) -> Dict[str, int]:
+    """Load snapshot readings into zone_readings and refresh expired ones in the background"""
+    stale = []
+    for zone, (fetched_at, value) in snapshot.sections.get("intensity", {}).items():
+        reading = ZoneReading(*value)
+        if time.time() - fetched_at < GRID_CACHE_SECONDS:
+            zone_readings[zone] = reading
+        else:
+            stale.append(zone)
+    ZONE_CACHE_STALE.inc(len(stale))
 
-class EnvironmentalImpactTracker:
-
-    def __init__(
-        self,
-        cloud_provider: str = "gcp",
-        cloud_region: str = "asia-south1",
-        electricity_maps_api_key: Optional[str] = None,
-        pue: float = 1.1,
-        gpu_utilization: float = 0.65,
-        batching_efficiency: float = 0.9,
-        confidence_margin: float = 0.30
-    ):
-        self.cloud_provider = cloud_provider.lower()
-        self.cloud_region = cloud_region.lower()
-        self.api_key = electricity_maps_api_key
-
-        self.pue = pue
-        self.gpu_utilization = gpu_utilization
-        self.batching_efficiency = batching_efficiency
-        self.confidence_margin = confidence_margin
-
-        self.models = self._load_models()
-        self.zone_map = self._load_cloud_zone_map()
-        self.grid = self._fetch_hourly_grid_data()
-
-    # =========================
-    # MODEL DATABASE (EXTENDED 2026)
-    # =========================
-
-    def _load_models(self) -> Dict[str, ModelSpec]:
-        return {
-            # OpenAI
-            "gpt-4o": ModelSpec(180, 0.0029, "openai", "transformer"),
-            "gpt-4-turbo": ModelSpec(110, 0.0022, "openai", "transformer"),
-            "gpt-4o-mini": ModelSpec(8, 0.00045, "openai", "transformer"),
-            "gpt-3.5-turbo": ModelSpec(20, 0.00035, "openai", "transformer"),
-            "o1-preview": ModelSpec(120, 0.0150, "openai", "o1-reasoning"),
-            "o1-mini": ModelSpec(60, 0.0055, "openai", "o1-reasoning"),
-
-            # Google
-            "gemini-1.5-pro": ModelSpec(120, 0.0026, "google", "transformer-moe"),
-            "gemini-1.5-flash": ModelSpec(15, 0.00012, "google", "transformer"),
-            "gemini-2.0-flash": ModelSpec(25, 0.00018, "google", "transformer"),
-
-            # Anthropic
-            "claude-3-opus": ModelSpec(130, 0.0024, "anthropic", "transformer"),
-            "claude-3.5-sonnet": ModelSpec(70, 0.0016, "anthropic", "transformer"),
-            "claude-3-sonnet": ModelSpec(70, 0.0014, "anthropic", "transformer"),
-            "claude-3-haiku": ModelSpec(20, 0.0003, "anthropic", "transformer"),
-
-            # Meta
-            "llama-3-8b": ModelSpec(8, 0.00006, "meta", "transformer"),
-            "llama-3-70b": ModelSpec(70, 0.0013, "meta", "transformer"),
-            "llama-3.1-8b": ModelSpec(8, 0.00008, "meta", "transformer"),
-            "llama-3.1-70b": ModelSpec(70, 0.0015, "meta", "transformer"),
-            "llama-3.1-405b": ModelSpec(405, 0.0070, "meta", "transformer"),
-
-            # Mistral
-            "mistral-large-2": ModelSpec(123, 0.0022, "mistral", "transformer"),
-            "mixtral-8x7b": ModelSpec(46, 0.0008, "mistral", "moe"),
-            "mixtral-8x22b": ModelSpec(141, 0.0020, "mistral", "moe"),
-
-            # xAI
-            "grok-2": ModelSpec(314, 0.0025, "xai", "moe"),
-
-            # DeepSeek
-            "deepseek-v3": ModelSpec(671, 0.0010, "deepseek", "moe"),
-
-            # Alibaba
-            "qwen2.5-72b": ModelSpec(72, 0.0013, "qwen", "transformer"),
-        }
+    def refresh():
+        for zone in stale:
+            try:
+                cached_zone_reading(zone, api_key)
+            except Exception as e:
+                print(f"Warm-cache refresh failed for {zone}: {e}")
+
+    if stale and api_key:
+        threading.Thread(target=refresh, name="warm-cache-refresh", daemon=True).start()
+    return {
+        "snapshot_age_seconds": round(time.time() - snapshot.written_at, 1),
+        "entries": len(zone_readings),
+        "stale": len(stale),
+    }
 
-    # =========================
-    # CLOUD → GRID ZONE MAP
-    # =========================
-
-    def _load_cloud_zone_map(self) -> Dict[str, Dict[str, str]]:
-        return {
-            "gcp": {
-                "asia-south1": "IN",
-                "us-central1": "US-MIDW-MISO",
-                "europe-west1": "BE",
-                "us-east1": "US-EAST-PJM",
-                "us-west1": "US-CAL-CISO",
-                "europe-north1": "FI",
-                "asia-southeast1": "SG",
-                "asia-northeast1": "JP-TK"
-            },
-            "aws": {
-                "ap-south-1": "IN",
-                "us-east-1": "US-EAST-PJM",
-                "us-west-2": "US-NW-PACW",
-                "eu-west-1": "IE",
-                "eu-central-1": "DE",
-                "ap-southeast-1": "SG",
-                "ap-northeast-1": "JP-TK"
-            },
-            "azure": {
-                "centralindia": "IN",
-                "eastus": "US-EAST-PJM",
-                "westus": "US-CAL-CISO",
-                "westeurope": "NL",
-                "northeurope": "IE",
-                "southeastasia": "SG"
-            }
-        }
 
-    # =========================
-    # REAL-TIME + HOURLY GRID DATA
-    # =========================
+warm_cache = None
+warm_cache_restored = None
+_warm_cache_lock = threading.Lock()
 
-    def _fetch_hourly_grid_data(self) -> GridSpec:
-        zone = self.zone_map.get(self.cloud_provider, {}).get(
-            self.cloud_region, "IN"
-        )
 
-        # ---- fallback (no API key) ----
-        if not self.api_key:
-            # Regional fallback values (2025-26 averages)
-            fallback_intensities = {
-                "IN": 708,
-                "US-MIDW-MISO": 420,
-                "US-EAST-PJM": 385,
-                "US-CAL-CISO": 250,
-                "BE": 150,
-                "FR": 90,
-                "DE": 380,
-                "IE": 320,
-                "NL": 400,
-                "FI": 85,
-                "SG": 410,
-                "JP-TK": 475
-            }
-            
-            return GridSpec(
-                carbon_intensity_g_per_kwh=fallback_intensities.get(zone, 450),
-                grid_zone=zone,
-                timestamp=datetime.datetime.now(datetime.timezone.utc).isoformat(),
-                source=f"static fallback ({zone})"
-            )
-
-        # ---- Electricity Maps API ----
-        headers = {"auth-token": self.api_key}
-        url = (
-            "https://api.electricitymap.org/v3/"
-            f"carbon-intensity/latest?zone={zone}"
-        )
+def start_warm_cache() -> Optional[WarmCachePersister]:
+    """
+    Restore the warm-cache snapshot and start saving it periodically.
 
-        try:
-            response = requests.get(url, headers=headers, timeout=6)
-            response.raise_for_status()
-            data = response.json()
-
-            return GridSpec(
-                carbon_intensity_g_per_kwh=data["carbonIntensity"],
-                grid_zone=zone,
-                timestamp=data["datetime"],
-                source="electricity-maps (real-time)"
-            )
-
-        except Exception as e:
-            print(f"Electricity Maps API error: {e}")
-            # Use fallback on API error
-            fallback_intensities = {
-                "IN": 708,
-                "US-MIDW-MISO": 420,
-                "US-EAST-PJM": 385,
-                "US-CAL-CISO": 250,
-                "BE": 150
-            }
-            
-            return GridSpec(
-                carbon_intensity_g_per_kwh=fallback_intensities.get(zone, 450),
-                grid_zone=zone,
-                timestamp=datetime.datetime.now(datetime.timezone.utc).isoformat(),
-                source=f"fallback (api error)"
-            )
-
-    # =========================
-    # IMPACT ESTIMATION
-    # =========================
-
-    def estimate(
-        self,
-        model_name: str,
-        input_tokens: int,
-        output_tokens: int,
-        cached: bool = False
-    ) -> Dict:
-
-        if model_name not in self.models:
-            raise ValueError(f"Unsupported model: {model_name}")
-
-        model = self.models[model_name]
-        total_tokens = input_tokens + output_tokens
-
-        base_energy = (total_tokens / 1000) * model.energy_per_1k_tokens_kwh
-
-        total_energy_kwh = (
-            base_energy
-            * (1 / self.gpu_utilization)
-            * (1 / self.batching_efficiency)
-            * self.pue
-            * (0.2 if cached else 1.0)
-        )
+    Called by the service entry points (__main__ and gunicorn's
+    post_worker_init), never on import, so scripts that import this module
+    don't read or overwrite the service's snapshot. Safe to call twice.
+    """
+    global warm_cache, warm_cache_restored
+    with _warm_cache_lock:
+        if warm_cache is not None or not WARM_CACHE_ENABLED:
+            return warm_cache
+        persister = WarmCachePersister(WARM_CACHE_PATH, export_warm_cache, interval=WARM_CACHE_SAVE_SECONDS)
+        warm_snapshot = persister.load()
+        if warm_snapshot is not None:
+            warm_cache_restored = restore_warm_cache(warm_snapshot, os.getenv("ELECTRICITY_MAPS_API_KEY"))
+            print(f"♻️  Restored warm cache: {warm_cache_restored}")
+        persister.start()
+        StatsCollector("gaia_warm_cache", "Warm-cache snapshot saves", persister.stats)
+        warm_cache = persister
+        return warm_cache
 
-        co2_g = total_energy_kwh * self.grid.carbon_intensity_g_per_kwh
-        water_l = total_energy_kwh * 1.8
-
-        return {
-            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
-            "model": model_name,
-            "provider": model.provider,
-            "architecture": model.architecture,
-            "parameters_billion": model.parameters_billion,
-            "cloud": {
-                "provider": self.cloud_provider,
-                "region": self.cloud_region,
-                "grid_zone": self.grid.grid_zone
-            },
-            "grid_data": {
-                "carbon_intensity_g_per_kwh": self.grid.carbon_intensity_g_per_kwh,
-                "measured_at": self.grid.timestamp,
-                "source": self.grid.source
-            },
-            "tokens": {
-                "input": input_tokens,
-                "output": output_tokens,
-                "total": total_tokens
-            },
-            "energy_kwh": round(total_energy_kwh, 6),
-            "co2_grams": round(co2_g, 4),
-            "water_liters": round(water_l, 4),
-            "assumptions": {
-                "pue": self.pue,
-                "gpu_utilization": self.gpu_utilization,
-                "batching_efficiency": self.batching_efficiency,
-                "cached": cached
-            },
-            "confidence_interval": f"±{int(self.confidence_margin * 100)}%"
-        }
 
-    def get_supported_models(self) -> List[Dict]:
-        """Return list of supported models with their specs"""
-        return [
-            {
-                "name": name,
-                "provider": spec.provider,
-                "parameters_billion": spec.parameters_billion,
-                "energy_per_1k_tokens_kwh": spec.energy_per_1k_tokens_kwh,
-                "architecture": spec.architecture
-            }
-            for name, spec in self.models.items()
-        ]
+StatsCollector("gaia_upstream_coalescing", "Coalesced grid fetches (singleflight)", grid_flights.stats)
+if grid_snapshot is not None:
+    StatsCollector("gaia_grid_snapshot", "Shared grid snapshot state", grid_snapshot.stats)
 
 
 # =========================
@@ -312,7 +189,10 @@ def health_check():
         "status": "healthy",
         "service": "GAIA CO2 Calculator",
         "version": "1.0.0",
-        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat()
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "grid_snapshot": grid_snapshot.stats() if grid_snapshot is not None else None,
+        "grid_fetch_coalescing": grid_flights.stats(),
+        "warm_cache": dict(warm_cache.stats(), restored=warm_cache_restored) if warm_cache is not None else None
     }), 200
 
 
@@ -320,7 +200,7 @@ def health_check():
 def get_models():
     """Return supported models"""
     try:
-        tracker = EnvironmentalImpactTracker(
+        tracker = ServiceImpactTracker(
             electricity_maps_api_key=os.getenv("ELECTRICITY_MAPS_API_KEY")
         )
         models = tracker.get_supported_models()
@@ -379,7 +259,7 @@ def calculate():
             }), 400
         
         # ✅ Create tracker instance
-        tracker = EnvironmentalImpactTracker(
+        tracker = ServiceImpactTracker(
             cloud_provider=cloud_provider,
             cloud_region=cloud_region,
             electricity_maps_api_key=os.getenv("ELECTRICITY_MAPS_API_KEY")
@@ -429,12 +309,13 @@ def batch_calculate():
                 "success": False,
                 "error": "Maximum 100 prompts per batch request"
             }), 400
+        BATCH_SIZE.labels("batch_calculate").observe(len(prompts))
         
         # Get common settings
         cloud_provider = data.get('cloud_provider', 'gcp')
         cloud_region = data.get('cloud_region', 'asia-south1')
         
-        tracker = EnvironmentalImpactTracker(
+        tracker = ServiceImpactTracker(
             cloud_provider=cloud_provider,
             cloud_region=cloud_region,
             electricity_maps_api_key=os.getenv("ELECTRICITY_MAPS_API_KEY")
@@ -496,6 +377,10 @@ if __name__ == "__main__":
     ╚══════════════════════════════════════════════╝
     """)
     
+    # With the reloader, only the child process that serves requests owns the snapshot
+    if not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_warm_cache()
+
     app.run(
         host='0.0.0.0',
         port=port,
@@ -0,0 +1,340 @@
+"""
+Offline bulk scoring of LLM usage records with EnvironmentalImpactTracker.
+
+Reads usage records from CSV or JSONL (gzip-compressed or not, detected
+automatically), scores them in chunks across a process pool with the same
+model table and grid logic as the calculator service, and writes the records
+back out in the same format with energy / CO2 / water columns added.
+
+    python bulk_score.py usage.csv.gz scored.csv.gz
+    python bulk_score.py usage.jsonl scored.jsonl --region us-central1 --workers 8
+    python bulk_score.py usage.csv.gz scored.csv.gz --resume   # continue after a crash
+
+Each record needs `model_name` (or `model`), `input_tokens` and
+`output_tokens`; `cached`, `cloud_provider` and `cloud_region` are optional
+and default to the command-line values. Grid intensity is looked up once per
+(provider, region) per run, so every record of a region is scored against
+the same reading. Records that can't be scored are written with an `error`.
+
+After every chunk the output is flushed and a checkpoint (`<output>.ckpt`)
+records how many input records are done; --resume truncates the output back
+to the last checkpoint and skips those records. Gzip output is written as
+one gzip member per chunk, so a truncated file is still valid.
+"""
+
+import argparse
+import csv
+import gzip
+import io
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from impact_tracker import EnvironmentalImpactTracker
+
+CHUNK_SIZE = 50000
+
+SCORE_COLUMNS = ['energy_kwh', 'co2_grams', 'water_liters', 'grid_zone', 'carbon_intensity_g_per_kwh', 'error']
+
+TRUE_VALUES = {'1', 'true', 'yes', 't', 'y'}
+
+
+def is_gzip(path):
+    with open(path, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+
+def detect_format(path):
+    name = path.lower()
+    if name.endswith('.gz'):
+        name = name[:-3]
+    if name.endswith('.csv'):
+        return 'csv'
+    if name.endswith(('.jsonl', '.ndjson', '.json')):
+        return 'jsonl'
+    raise ValueError(f"Can't tell the format of {path}; use a .csv or .jsonl name")
+
+
+def open_input(path):
+    raw = gzip.open(path, 'rb') if is_gzip(path) else open(path, 'rb')
+    return io.TextIOWrapper(raw, encoding='utf-8-sig', newline='')
+
+
+def read_chunks(path, fmt, chunk_size, skip=0):
+    """Yield (header, records) chunks; CSV records are lists, JSONL records are dicts or parse errors"""
+    with open_input(path) as text:
+        if fmt == 'csv':
+            reader = csv.reader(text)
+            header = [name.strip() for name in next(reader, [])]
+        else:
+            reader = (line for line in text if line.strip())
+            header = None
+
+        for _ in range(skip):
+            if next(reader, None) is None:
+                return
+
+        chunk = []
+        for record in reader:
+            if fmt == 'jsonl':
+                try:
+                    record = json.loads(record)
+                except ValueError as e:
+                    record = {'error': f'Invalid JSON: {e}'}
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                yield header, chunk
+                chunk = []
+        if chunk:
+            yield header, chunk
+
+
+def record_keys(header, records, defaults):
+    """The (provider, region) pairs a chunk needs trackers for"""
+    keys = set()
+    for record in records:
+        if header is not None:
+            record = dict(zip(header, record))
+        if isinstance(record, dict):
+            keys.add((
+                (record.get('cloud_provider') or defaults[0]).lower(),
+                (record.get('cloud_region') or defaults[1]).lower()
+            ))
+    return keys
+
+
+def _parse_usage(record, defaults):
+    """Returns ((provider, region), (model, input, output, cached)) or raises ValueError"""
+    if 'error' in record and not record.get('model_name') and not record.get('model'):
+        raise ValueError(record['error'])
+    model = record.get('model_name') or record.get('model')
+    if not model:
+        raise ValueError('Missing model_name')
+    try:
+        input_tokens = int(record.get('input_tokens') or 0)
+        output_tokens = int(record.get('output_tokens') or 0)
+    except (TypeError, ValueError):
+        raise ValueError('input_tokens and output_tokens must be integers')
+    if input_tokens < 0 or output_tokens < 0:
+        raise ValueError('Token counts must be non-negative')
+    cached = record.get('cached')
+    if isinstance(cached, str):
+        cached = cached.strip().lower() in TRUE_VALUES
+    key = (
+        (record.get('cloud_provider') or defaults[0]).lower(),
+        (record.get('cloud_region') or defaults[1]).lower()
+    )
+    return key, (model, input_tokens, output_tokens, bool(cached))
+
+
+def score_chunk(job):
+    """
+    Worker: score one chunk and serialize it.
+    Returns (text, scored, failed) with text ready to append to the output.
+    """
+    header, records, trackers, defaults, write_header = job
+    rows = [dict(zip(header, record)) if header is not None else record for record in records]
+
+    scores = [None] * len(rows)
+    groups = {}
+    for index, row in enumerate(rows):
+        if not isinstance(row, dict):
+            scores[index] = {'error': 'Record is not a JSON object'}
+            continue
+        try:
+            key, usage = _parse_usage(row, defaults)
+        except ValueError as e:
+            scores[index] = {'error': str(e)}
+            continue
+        groups.setdefault(key, ([], []))
+        groups[key][0].append(index)
+        groups[key][1].append(usage)
+
+    for key, (indexes, usages) in groups.items():
+        tracker = trackers[key]
+        results, errors = tracker.estimate_many(usages)
+        for position, energy, co2, water in results:
+            scores[indexes[position]] = {
+                'energy_kwh': energy,
+                'co2_grams': co2,
+                'water_liters': water,
+                'grid_zone': tracker.grid.grid_zone,
+                'carbon_intensity_g_per_kwh': tracker.grid.carbon_intensity_g_per_kwh,
+                'error': None,
+            }
+        for position, message in errors:
+            scores[indexes[position]] = {'error': message}
+
+    failed = sum(1 for score in scores if score.get('error'))
+    buffer = io.StringIO()
+    if header is not None:
+        writer = csv.writer(buffer)
+        columns = header + [column for column in SCORE_COLUMNS if column not in header]
+        if write_header:
+            writer.writerow(columns)
+        for row, score in zip(rows, scores):
+            row.update(score)
+            writer.writerow([row.get(column) for column in columns])
+    else:
+        for row, score in zip(rows, scores):
+            if not isinstance(row, dict):
+                row = {'record': row}
+            row.update(score)
+            buffer.write(json.dumps(row) + '\n')
+    return buffer.getvalue(), len(rows) - failed, failed
+
+
+class Checkpoint:
+    """Progress of one input -> output run, saved atomically next to the output"""
+
+    def __init__(self, path, input_path):
+        self.path = path
+        stat = os.stat(input_path)
+        self.identity = {
+            'input': os.path.abspath(input_path),
+            'input_size': stat.st_size,
+            'input_mtime': int(stat.st_mtime),
+        }
+        self.state = {'records_done': 0, 'output_bytes': 0, 'scored': 0, 'failed': 0}
+
+    def load(self):
+        """Resume from the saved checkpoint; False if there is none for this input"""
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if any(saved.get(key) != value for key, value in self.identity.items()):
+            raise SystemExit(f"❌ {self.path} belongs to a different or modified input; delete it to start over")
+        self.state = {key: saved[key] for key in self.state}
+        return True
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(dict(self.identity, **self.state), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def get_tracker(trackers, key):
+    if key not in trackers:
+        tracker = EnvironmentalImpactTracker(
+            cloud_provider=key[0],
+            cloud_region=key[1],
+            electricity_maps_api_key=os.getenv('ELECTRICITY_MAPS_API_KEY')
+        )
+        print(f"🌍 {key[0]}/{key[1]}: {tracker.grid.carbon_intensity_g_per_kwh} gCO2/kWh "
+              f"({tracker.grid.grid_zone}, {tracker.grid.source})")
+        trackers[key] = tracker
+    return trackers[key]
+
+
+def run(input_path, output_path, provider='gcp', region='asia-south1', workers=None,
+        chunk_size=CHUNK_SIZE, resume=False):
+    fmt = detect_format(input_path)
+    if detect_format(output_path) != fmt:
+        raise SystemExit("❌ Output must use the same format (csv/jsonl) as the input")
+    compress = output_path.lower().endswith('.gz')
+    defaults = (provider.lower(), region.lower())
+
+    checkpoint = Checkpoint(output_path + '.ckpt', input_path)
+    resumed = resume and checkpoint.load() and os.path.exists(output_path)
+    if resumed:
+        print(f"↩️  Resuming after {checkpoint.state['records_done']} records")
+    else:
+        checkpoint = Checkpoint(output_path + '.ckpt', input_path)
+        checkpoint.save()
+
+    trackers = {}
+    if workers is None:
+        workers = os.cpu_count() or 1
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 0 else None
+    pending = deque()
+    started = time.monotonic()
+    done_this_run = 0
+
+    output = open(output_path, 'r+b' if resumed else 'wb')
+    try:
+        output.truncate(checkpoint.state['output_bytes'])
+        output.seek(checkpoint.state['output_bytes'])
+
+        def finish_one():
+            nonlocal done_this_run
+            future, count = pending.popleft()
+            text, scored, failed = future.result() if executor else future
+            data = text.encode('utf-8')
+            output.write(gzip.compress(data) if compress else data)
+            output.flush()
+            os.fsync(output.fileno())
+
+            done_this_run += count
+            state = checkpoint.state
+            state['records_done'] += count
+            state['output_bytes'] = output.tell()
+            state['scored'] += scored
+            state['failed'] += failed
+            checkpoint.save()
+
+            elapsed = time.monotonic() - started
+            print(f"  {state['records_done']} records ({state['failed']} failed), "
+                  f"{done_this_run / max(elapsed, 1e-9):,.0f} records/s")
+
+        write_header = checkpoint.state['records_done'] == 0
+        for header, records in read_chunks(input_path, fmt, chunk_size, skip=checkpoint.state['records_done']):
+            chunk_trackers = {key: get_tracker(trackers, key) for key in record_keys(header, records, defaults)}
+            job = (header, records, chunk_trackers, defaults, write_header and header is not None)
+            write_header = False
+            pending.append((executor.submit(score_chunk, job) if executor else score_chunk(job), len(records)))
+            # Bounded read-ahead keeps memory flat on any input size
+            while len(pending) > max(workers, 1) * 2:
+                finish_one()
+        while pending:
+            finish_one()
+    finally:
+        output.close()
+        if executor:
+            executor.shutdown(cancel_futures=True)
+
+    elapsed = time.monotonic() - started
+    state = checkpoint.state
+    checkpoint.remove()
+    print(f"✅ {state['records_done']} records -> {output_path}: {state['scored']} scored, "
+          f"{state['failed']} failed; {done_this_run} in {elapsed:.1f}s "
+          f"({done_this_run / max(elapsed, 1e-9):,.0f} records/s)")
+    return state
+
+
+def main(argv=None):
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Score LLM usage records (CSV/JSONL, optionally .gz) offline")
+    parser.add_argument('input')
+    parser.add_argument('output')
+    parser.add_argument('--provider', default='gcp', help="cloud provider for records without cloud_provider")
+    parser.add_argument('--region', default='asia-south1', help="cloud region for records without cloud_region")
+    parser.add_argument('--workers', type=int, default=None, help="scoring processes (default: CPU count, 0 = inline)")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--resume', action='store_true', help="continue from <output>.ckpt")
+    args = parser.parse_args(argv)
+
+    try:
+        run(args.input, args.output, args.provider, args.region, args.workers, args.chunk_size, args.resume)
+    except ValueError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,342 @@
+from flask import Flask, request, jsonify
+from flask_cors import CORS
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from dotenv import load_dotenv
+import jwt
+import psycopg2
+import psycopg2.extras
+
+from pipeline import CHUNK_ROWS, UploadError, create_upload, fail_upload, fail_stale_uploads, ingest_upload
+from schema import ensure_schema
+
+# Load environment variables
+load_dotenv()
+
+app = Flask(__name__)
+
+CORS(app, resources={
+    r"/api/*": {
+        "origins": ["http://localhost:*"],
+        "methods": ["GET", "POST", "OPTIONS"],
+        "allow_headers": ["Content-Type", "Authorization"],
+        "supports_credentials": True
+    }
+})
+
+# Same secret as the web app, whose `token` cookie carries {userId}
+JWT_SECRET = os.getenv('JWT_SECRET', 'your-secret-key')
+JWT_ALGORITHM = 'HS256'
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+DB_AUTO_MIGRATE = os.getenv('DB_AUTO_MIGRATE', 'true').lower() == 'true'
+
+# Uploads are spooled to disk and ingested in the background
+CCFT_UPLOAD_DIR = os.getenv('CCFT_UPLOAD_DIR') or tempfile.gettempdir()
+CCFT_MAX_UPLOAD_BYTES = int(os.getenv('CCFT_MAX_UPLOAD_BYTES', 2 * 1024 ** 3))
+CCFT_WORKERS = int(os.getenv('CCFT_WORKERS', 2))
+CCFT_MAX_QUEUED = int(os.getenv('CCFT_MAX_QUEUED', 20))
+CCFT_CHUNK_ROWS = int(os.getenv('CCFT_CHUNK_ROWS', CHUNK_ROWS))
+# Uploads 'processing' without progress for this long were interrupted
+CCFT_STALE_MINUTES = int(os.getenv('CCFT_STALE_MINUTES', 30))
+# Spool files are named ccft-<pid>-*.upload by the process ingesting them
+SPOOL_PREFIX = 'ccft-'
+SPOOL_SUFFIX = '.upload'
+
+app.config['MAX_CONTENT_LENGTH'] = CCFT_MAX_UPLOAD_BYTES
+
+executor = ThreadPoolExecutor(max_workers=CCFT_WORKERS, thread_name_prefix='ccft-ingest')
+jobs_lock = threading.Lock()
+jobs_pending = 0
+
+
+def get_db_connection():
+    return psycopg2.connect(DATABASE_URL)
+
+
+# Create progress columns / error table on startup
+if DB_AUTO_MIGRATE and DATABASE_URL:
+    try:
+        conn = get_db_connection()
+        try:
+            ensure_schema(conn)
+        finally:
+            conn.close()
+    except Exception as e:
+        print(f"⚠️  Schema setup skipped: {e}")
+
+
+def _spool_owner_alive(name):
+    """Whether the process that spooled `name` may still be ingesting it"""
+    owner = name[len(SPOOL_PREFIX):].split('-', 1)[0]
+    if not owner.isdigit() or int(owner) == os.getpid():
+        # Unnamed (older release) or from a previous process with our pid
+        return False
+    try:
+        os.kill(int(owner), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def remove_orphaned_spools(directory):
+    """Delete spool files left behind by processes that stopped mid-ingest"""
+    removed = 0
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return 0
+    for name in names:
+        if not (name.startswith(SPOOL_PREFIX) and name.endswith(SPOOL_SUFFIX)):
+            continue
+        if _spool_owner_alive(name):
+            continue
+        try:
+            os.remove(os.path.join(directory, name))
+            removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+# Clean up after a previous process that stopped with uploads in flight
+orphans = remove_orphaned_spools(CCFT_UPLOAD_DIR)
+if orphans:
+    print(f"🧹 Removed {orphans} orphaned CCFT spool files")
+if DATABASE_URL:
+    try:
+        conn = get_db_connection()
+        try:
+            stale = fail_stale_uploads(conn, CCFT_STALE_MINUTES)
+        finally:
+            conn.close()
+        if stale:
+            print(f"⚠️  Marked {stale} interrupted CCFT uploads as failed")
+    except Exception as e:
+        print(f"⚠️  Stale upload check skipped: {e}")
+
+
+def token_required(f):
+    """Decorator to validate the web app's JWT (cookie or Bearer header)"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        token = request.cookies.get('token')
+        auth_header = request.headers.get('Authorization', '')
+        if auth_header.startswith('Bearer '):
+            token = auth_header[len('Bearer '):]
+
+        if not token:
+            return jsonify({'error': 'Unauthorized. Please log in.'}), 401
+
+        try:
+            data = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        except jwt.ExpiredSignatureError:
+            return jsonify({'error': 'Token has expired'}), 401
+        except jwt.InvalidTokenError:
+            return jsonify({'error': 'Invalid token'}), 401
+
+        # Web app tokens carry userId, extension backend tokens user_id
+        current_user_id = data.get('userId') or data.get('user_id')
+        if not current_user_id:
+            return jsonify({'error': 'Invalid token'}), 401
+
+        return f(current_user_id, *args, **kwargs)
+
+    return decorated
+
+
+def run_upload(upload_id, user_id, file_name, path):
+    """Background job: ingest a spooled upload, then delete the spool file"""
+    global jobs_pending
+    try:
+        conn = get_db_connection()
+        try:
+            with open(path, 'rb') as f:
+                result = ingest_upload(conn, upload_id, user_id, file_name, f, chunk_rows=CCFT_CHUNK_ROWS)
+            print(f"✅ CCFT upload {upload_id}: {result['recordsProcessed']} records, {result['recordsFailed']} failed")
+        except UploadError as e:
+            fail_upload(conn, upload_id, str(e))
+            print(f"⚠️  CCFT upload {upload_id} rejected: {e}")
+        except Exception as e:
+            fail_upload(conn, upload_id, f'Internal error: {e}')
+            print(f"❌ CCFT upload {upload_id} failed: {e}")
+        finally:
+            conn.close()
+    except Exception as e:
+        print(f"❌ CCFT upload {upload_id} could not be finalized: {e}")
+    finally:
+        with jobs_lock:
+            jobs_pending -= 1
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+# ==================== UPLOADS ====================
+
+@app.route('/api/ccft/uploads', methods=['POST', 'OPTIONS'])
+@token_required
+def upload(current_user_id):
+    """
+    Accept a CCFT export (multipart field `file`, .csv or .csv.gz) and
+    ingest it in the background. Returns 202 with the upload id; poll
+    GET /api/ccft/uploads/<id> for progress.
+    """
+    global jobs_pending
+    if request.method == 'OPTIONS':
+        return '', 204
+
+    file = request.files.get('file')
+    if not file or not file.filename:
+        return jsonify({'error': 'No file provided'}), 400
+
+    file_name = os.path.basename(file.filename)
+    if not file_name.lower().endswith(('.csv', '.csv.gz')):
+        return jsonify({'error': 'Invalid file type. Please upload a CSV file.'}), 400
+
+    with jobs_lock:
+        if jobs_pending >= CCFT_MAX_QUEUED:
+            return jsonify({'error': 'Too many uploads in progress, retry later'}), 503, {'Retry-After': '30'}
+        jobs_pending += 1
+
+    path = None
+    try:
+        fd, path = tempfile.mkstemp(prefix=f'{SPOOL_PREFIX}{os.getpid()}-', suffix=SPOOL_SUFFIX, dir=CCFT_UPLOAD_DIR)
+        with os.fdopen(fd, 'wb') as spool:
+            file.save(spool)
+
+        conn = get_db_connection()
+        try:
+            upload_id = create_upload(conn, current_user_id, file_name, os.path.getsize(path))
+        finally:
+            conn.close()
+
+        executor.submit(run_upload, upload_id, current_user_id, file_name, path)
+        path = None  # owned by the job now
+
+        return jsonify({
+            'success': True,
+            'uploadId': str(upload_id),
+            'status': 'processing',
+            'statusUrl': f'/api/ccft/uploads/{upload_id}'
+        }), 202
+
+    except Exception as e:
+        print(f"❌ CCFT upload error: {e}")
+        return jsonify({'error': 'Upload failed', 'details': str(e)}), 500
+    finally:
+        if path is not None:
+            with jobs_lock:
+                jobs_pending -= 1
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+@app.route('/api/ccft/uploads/<upload_id>', methods=['GET'])
+@token_required
+def upload_status(current_user_id, upload_id):
+    """
+    Progress of an upload. Query params:
+      errors_after: return row errors after this row number (default 0)
+      errors_limit: max row errors to return (default 100, max 1000)
+    """
+    try:
+        errors_after = max(0, int(request.args.get('errors_after', 0)))
+        errors_limit = min(max(1, int(request.args.get('errors_limit', 100))), 1000)
+    except ValueError:
+        return jsonify({'error': 'errors_after and errors_limit must be integers'}), 400
+
+    try:
+        conn = get_db_connection()
+        try:
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                cursor.execute(
+                    """
+                    SELECT id, file_name, file_size, status, records_processed, records_failed,
+                           rows_read, bytes_read, error_message, processing_completed_at, updated_at
+                    FROM aws_upload_history
+                    WHERE id::text = %s AND user_id = %s
+                    """,
+                    (upload_id, str(current_user_id))
+                )
+                upload_row = cursor.fetchone()
+                if not upload_row:
+                    return jsonify({'error': 'Upload not found'}), 404
+
+                cursor.execute(
+                    """
+                    SELECT row_number, error
+                    FROM aws_upload_errors
+                    WHERE upload_id = %s AND row_number > %s
+                    ORDER BY row_number
+                    LIMIT %s
+                    """,
+                    (str(upload_row['id']), errors_after, errors_limit)
+                )
+                errors = cursor.fetchall()
+        finally:
+            conn.close()
+
+        file_size = upload_row['file_size'] or 0
+        done = upload_row['status'] != 'processing'
+        # bytes_read counts the compressed bytes for .csv.gz, like file_size
+        progress = 1.0 if done else (min(upload_row['bytes_read'] / file_size, 0.99) if file_size else 0.0)
+
+        return jsonify({
+            'success': True,
+            'data': {
+                'uploadId': str(upload_row['id']),
+                'fileName': upload_row['file_name'],
+                'status': upload_row['status'],
+                'progress': round(progress, 4),
+                'rowsRead': upload_row['rows_read'],
+                'recordsProcessed': upload_row['records_processed'],
+                'recordsFailed': upload_row['records_failed'],
+                'errorMessage': upload_row['error_message'],
+                'completedAt': upload_row['processing_completed_at'].isoformat() if upload_row['processing_completed_at'] else None,
+                'updatedAt': upload_row['updated_at'].isoformat() if upload_row['updated_at'] else None,
+                'errors': [dict(error) for error in errors],
+            }
+        }), 200
+
+    except Exception as e:
+        print(f"❌ CCFT status error: {e}")
+        return jsonify({'error': 'Failed to fetch upload status', 'details': str(e)}), 500
+
+
+# ==================== HEALTH CHECK ====================
+
+@app.route('/api/health', methods=['GET'])
+def health_check():
+    with jobs_lock:
+        pending = jobs_pending
+    return jsonify({
+        'status': 'healthy',
+        'service': 'GAIA CCFT Ingestion',
+        'uploads_in_progress': pending,
+        'max_queued': CCFT_MAX_QUEUED
+    }), 200
+
+
+@app.errorhandler(413)
+def too_large(error):
+    return jsonify({'error': f'File too large (max {CCFT_MAX_UPLOAD_BYTES} bytes)'}), 413
+
+
+@app.errorhandler(404)
+def not_found(error):
+    return jsonify({'error': 'Endpoint not found'}), 404
+
+
+if __name__ == '__main__':
+    print("🚀 Starting GAIA CCFT ingestion service on port 5002...")
+    print("📍 Upload endpoint: http://localhost:5002/api/ccft/uploads")
+    app.run(host='0.0.0.0', port=5002, debug=False)
@@ -0,0 +1,422 @@
+"""
+Streaming ingestion of AWS Customer Carbon Footprint Tool (CCFT) exports.
+
+The CSV is read row by row (optionally gzip-compressed), validated in chunks
+of CHUNK_ROWS rows, and each chunk's valid rows are COPYed into a temporary
+staging table and upserted into aws_carbon_footprint with one statement.
+Every chunk commits together with its progress counters and row errors, so
+a multi-year export never holds one huge transaction and a bad row never
+aborts the upload. Monthly metrics and recommendations are computed once at
+the end, as the Next.js aws-tracker route does.
+
+    python pipeline.py <user_id> <export.csv[.gz]>
+"""
+
+import csv
+import gzip
+import io
+from datetime import date
+
+from recommendations import build_recommendations, insert_recommendations
+
+CHUNK_ROWS = 10000
+# Row errors kept per upload (all of them are counted)
+MAX_STORED_ERRORS = 1000
+DEFAULT_UNIT = 'mtCO2e'
+
+REQUIRED_COLUMNS = [
+    'usage_account_id',
+    'total_mbm_emissions_value',
+    'total_lbm_emissions_value',
+    'product_code',
+    'location',
+    'usage_month',
+]
+
+STAGING_COLUMNS = """
+    row_number, usage_account_id, total_mbm_emissions_value, total_mbm_emissions_unit,
+    total_lbm_emissions_value, total_lbm_emissions_unit, product_code, location,
+    usage_month, model_version
+"""
+
+STAGING_DDL = """
+    CREATE TEMP TABLE IF NOT EXISTS ccft_staging (
+        row_number BIGINT NOT NULL,
+        usage_account_id TEXT NOT NULL,
+        total_mbm_emissions_value DOUBLE PRECISION NOT NULL,
+        total_mbm_emissions_unit TEXT NOT NULL,
+        total_lbm_emissions_value DOUBLE PRECISION NOT NULL,
+        total_lbm_emissions_unit TEXT NOT NULL,
+        product_code TEXT NOT NULL,
+        location TEXT NOT NULL,
+        usage_month DATE NOT NULL,
+        model_version TEXT
+    ) ON COMMIT DELETE ROWS
+"""
+
+# Same upsert as the aws-tracker route; within a chunk the last row for a key wins
+UPSERT_FROM_STAGING = """
+    INSERT INTO aws_carbon_footprint
+        (user_id, usage_account_id, total_mbm_emissions_value, total_mbm_emissions_unit,
+         total_lbm_emissions_value, total_lbm_emissions_unit, product_code, location,
+         usage_month, model_version, file_name)
+    SELECT DISTINCT ON (usage_account_id, product_code, location, usage_month)
+        %(user_id)s, usage_account_id, total_mbm_emissions_value, total_mbm_emissions_unit,
+        total_lbm_emissions_value, total_lbm_emissions_unit, product_code, location,
+        usage_month, model_version, %(file_name)s
+    FROM ccft_staging
+    {where}
+    ORDER BY usage_account_id, product_code, location, usage_month, row_number DESC
+    ON CONFLICT (user_id, usage_account_id, product_code, location, usage_month)
+    DO UPDATE SET
+        total_mbm_emissions_value = EXCLUDED.total_mbm_emissions_value,
+        total_lbm_emissions_value = EXCLUDED.total_lbm_emissions_value,
+        model_version = EXCLUDED.model_version,
+        updated_at = NOW()
+"""
+
+
+class UploadError(Exception):
+    """The file as a whole cannot be ingested (not a CCFT CSV, unreadable, empty)"""
+
+
+class CountingReader(io.RawIOBase):
+    """Binary file wrapper that counts bytes read, for progress reporting"""
+
+    def __init__(self, raw):
+        self._raw = raw
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._raw.read(len(buffer))
+        self.bytes_read += len(data)
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def open_text(counter):
+    """Text stream over a (possibly gzip-compressed) CSV file"""
+    stream = io.BufferedReader(counter, buffer_size=1 << 20)
+    if stream.peek(2)[:2] == b'\x1f\x8b':
+        stream = gzip.GzipFile(fileobj=stream)
+    # utf-8-sig drops the BOM Excel puts in front of the header
+    return io.TextIOWrapper(stream, encoding='utf-8-sig', errors='replace', newline='')
+
+
+def parse_usage_month(value):
+    """'YYYY-MM' or 'YYYY-MM-DD' -> first day of that month, or None"""
+    parts = value.split('-')
+    if len(parts) < 2:
+        return None
+    try:
+        return date(int(parts[0]), int(parts[1]), 1)
+    except ValueError:
+        return None
+
+
+def _parse_number(record, column, problems):
+    try:
+        value = float(record[column])
+    except ValueError:
+        problems.append(f'Invalid {column}')
+        return None
+    if value != value or value in (float('inf'), float('-inf')):
+        problems.append(f'Invalid {column}')
+        return None
+    return value
+
+
+def validate_row(record):
+    """Returns (staging values, None) or (None, error message)"""
+    problems = [f'Missing {column}' for column in REQUIRED_COLUMNS if not record.get(column)]
+    if problems:
+        return None, ', '.join(problems)
+
+    mbm = _parse_number(record, 'total_mbm_emissions_value', problems)
+    lbm = _parse_number(record, 'total_lbm_emissions_value', problems)
+    usage_month = parse_usage_month(record['usage_month'])
+    if usage_month is None:
+        problems.append('Invalid usage_month format')
+    if problems:
+        return None, ', '.join(problems)
+
+    return (
+        record['usage_account_id'],
+        mbm,
+        record.get('total_mbm_emissions_unit') or DEFAULT_UNIT,
+        lbm,
+        record.get('total_lbm_emissions_unit') or DEFAULT_UNIT,
+        record['product_code'],
+        record['location'],
+        usage_month,
+        record.get('model_version') or None,
+    ), None
+
+
+def iter_chunks(text, chunk_rows=CHUNK_ROWS):
+    """Yield lists of (row_number, record) with trimmed values; row 1 is the first data row"""
+    reader = csv.DictReader(text)
+    header = [name.strip() for name in (reader.fieldnames or [])]
+    if not header:
+        raise UploadError('CSV file is empty')
+    missing = [column for column in REQUIRED_COLUMNS if column not in header]
+    if missing:
+        raise UploadError(f"Not a CCFT export, missing columns: {', '.join(missing)}")
+    reader.fieldnames = header
+
+    chunk = []
+    row_number = 0
+    try:
+        for record in reader:
+            row_number += 1
+            chunk.append((row_number, {
+                key: (value or '').strip() if isinstance(value, str) else ''
+                for key, value in record.items() if key is not None
+            }))
+            if len(chunk) >= chunk_rows:
+                yield chunk
+                chunk = []
+    except csv.Error as e:
+        raise UploadError(f'Malformed CSV near line {reader.line_num}: {e}')
+    if chunk:
+        yield chunk
+
+
+def _copy_to_staging(cursor, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row_number, values in rows:
+        writer.writerow((row_number,) + tuple(
+            value.isoformat() if isinstance(value, date) else value
+            for value in values
+        ))
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY ccft_staging ({STAGING_COLUMNS}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def write_chunk(cursor, user_id, file_name, rows):
+    """
+    Upsert validated rows [(row_number, values)] through the staging table.
+    Returns [(row_number, error)] for rows the database rejected; if the
+    chunk as a whole fails, it is retried row by row to isolate them.
+    """
+    params = {'user_id': str(user_id), 'file_name': file_name}
+    cursor.execute("SAVEPOINT ccft_chunk")
+    try:
+        _copy_to_staging(cursor, rows)
+        cursor.execute(UPSERT_FROM_STAGING.format(where=''), params)
+        cursor.execute("RELEASE SAVEPOINT ccft_chunk")
+        return []
+    except Exception:
+        cursor.execute("ROLLBACK TO SAVEPOINT ccft_chunk")
+
+    # Slow path, only for chunks holding a row the database rejects (e.g. too long)
+    _copy_to_staging(cursor, rows)
+    failed = []
+    for row_number, _ in rows:
+        cursor.execute("SAVEPOINT ccft_row")
+        try:
+            cursor.execute(
+                UPSERT_FROM_STAGING.format(where='WHERE row_number = %(row_number)s'),
+                dict(params, row_number=row_number)
+            )
+            cursor.execute("RELEASE SAVEPOINT ccft_row")
+        except Exception as e:
+            cursor.execute("ROLLBACK TO SAVEPOINT ccft_row")
+            failed.append((row_number, f'Database error - {str(e).strip()}'))
+    cursor.execute("DELETE FROM ccft_staging")
+    return failed
+
+
+def create_upload(conn, user_id, file_name, file_size):
+    """Record a new upload in aws_upload_history and return its id"""
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """
+            INSERT INTO aws_upload_history (user_id, file_name, file_size, status)
+            VALUES (%s, %s, %s, 'processing')
+            RETURNING id
+            """,
+            (str(user_id), file_name, file_size)
+        )
+        upload_id = cursor.fetchone()[0]
+    conn.commit()
+    return upload_id
+
+
+def fail_upload(conn, upload_id, message):
+    conn.rollback()
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """
+            UPDATE aws_upload_history
+            SET status = 'failed', error_message = %s,
+                processing_completed_at = NOW(), updated_at = NOW()
+            WHERE id = %s
+            """,
+            (message, upload_id)
+        )
+    conn.commit()
+
+
+def fail_stale_uploads(conn, stale_minutes):
+    """
+    Mark uploads still 'processing' without progress for `stale_minutes` as
+    failed: the process ingesting them stopped. Returns how many were marked.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """
+            UPDATE aws_upload_history
+            SET status = 'failed',
+                error_message = 'Interrupted: the service stopped while ingesting this file, please upload it again',
+                processing_completed_at = NOW(), updated_at = NOW()
+            WHERE status = 'processing'
+              AND updated_at < NOW() - make_interval(mins => %s)
+            """,
+            (stale_minutes,)
+        )
+        marked = cursor.rowcount
+    conn.commit()
+    return marked
+
+
+def ingest_upload(conn, upload_id, user_id, file_name, fileobj, chunk_rows=CHUNK_ROWS, on_progress=None):
+    """
+    Ingest an open binary CCFT file into an aws_upload_history row created
+    with create_upload(). Raises UploadError if the file can't be ingested at
+    all; the caller records that with fail_upload().
+    """
+    counter = CountingReader(fileobj)
+    text = open_text(counter)
+
+    processed = failed = rows_read = stored_errors = 0
+    first_errors = []
+    months = set()
+    service_totals = {}
+    region_totals = {}
+
+    with conn.cursor() as cursor:
+        cursor.execute(STAGING_DDL)
+    conn.commit()
+
+    for chunk in iter_chunks(text, chunk_rows):
+        valid = []
+        errors = []
+        for row_number, record in chunk:
+            values, error = validate_row(record)
+            if error:
+                errors.append((row_number, error))
+            else:
+                valid.append((row_number, values))
+        rows_read += len(chunk)
+
+        with conn.cursor() as cursor:
+            if valid:
+                rejected = write_chunk(cursor, user_id, file_name, valid)
+                if rejected:
+                    errors.extend(rejected)
+                    rejected_rows = {row_number for row_number, _ in rejected}
+                    valid = [row for row in valid if row[0] not in rejected_rows]
+
+            for _, values in valid:
+                emissions = values[1]
+                months.add(values[7])
+                service_totals[values[5]] = service_totals.get(values[5], 0) + emissions
+                region_totals[values[6]] = region_totals.get(values[6], 0) + emissions
+            processed += len(valid)
+            failed += len(errors)
+
+            errors.sort()
+            keep = errors[:max(0, MAX_STORED_ERRORS - stored_errors)]
+            if keep:
+                cursor.executemany(
+                    "INSERT INTO aws_upload_errors (upload_id, row_number, error) VALUES (%s, %s, %s)",
+                    [(str(upload_id), row_number, error) for row_number, error in keep]
+                )
+                stored_errors += len(keep)
+            first_errors.extend(
+                f'Row {row_number}: {error}' for row_number, error in errors[:10 - len(first_errors)]
+            )
+
+            cursor.execute(
+                """
+                UPDATE aws_upload_history
+                SET records_processed = %s, records_failed = %s,
+                    rows_read = %s, bytes_read = %s, updated_at = NOW()
+                WHERE id = %s
+                """,
+                (processed, failed, rows_read, counter.bytes_read, upload_id)
+            )
+        conn.commit()
+        if on_progress:
+            on_progress(rows_read, processed, failed, counter.bytes_read)
+
+    if rows_read == 0:
+        raise UploadError('CSV file is empty or contains only headers')
+
+    with conn.cursor() as cursor:
+        for month in sorted(months):
+            cursor.execute("SELECT calculate_aws_carbon_metrics(%s, %s)", (str(user_id), month))
+        insert_recommendations(cursor, user_id, build_recommendations(service_totals, region_totals))
+        status = 'completed_with_errors' if failed else 'completed'
+        cursor.execute(
+            """
+            UPDATE aws_upload_history
+            SET status = %s, error_message = %s,
+                processing_completed_at = NOW(), updated_at = NOW()
+            WHERE id = %s
+            """,
+            (status, '; '.join(first_errors) or None, upload_id)
+        )
+    conn.commit()
+
+    return {
+        'uploadId': str(upload_id),
+        'status': status,
+        'recordsProcessed': processed,
+        'recordsFailed': failed,
+        'rowsRead': rows_read,
+        'errors': first_errors,
+    }
+
+
+if __name__ == '__main__':
+    import os
+    import sys
+    import time
+    import psycopg2
+    from dotenv import load_dotenv
+    from schema import ensure_schema
+
+    if len(sys.argv) != 3:
+        print("Usage: python pipeline.py <user_id> <export.csv[.gz]>")
+        sys.exit(1)
+
+    load_dotenv()
+    user, path = sys.argv[1], sys.argv[2]
+    started = time.monotonic()
+
+    def report(rows, ok, bad, read):
+        elapsed = time.monotonic() - started
+        print(f"  {rows} rows ({ok} ok, {bad} failed), {read / 1e6:.1f} MB, {rows / max(elapsed, 1e-9):.0f} rows/s")
+
+    connection = psycopg2.connect(os.getenv('DATABASE_URL'))
+    try:
+        ensure_schema(connection)
+        upload = create_upload(connection, user, os.path.basename(path), os.path.getsize(path))
+        with open(path, 'rb') as f:
+            try:
+                result = ingest_upload(connection, upload, user, os.path.basename(path), f, on_progress=report)
+            except UploadError as e:
+                fail_upload(connection, upload, str(e))
+                print(f"❌ Upload {upload} failed: {e}")
+                sys.exit(1)
+        print(f"✅ Upload {upload}: {result['status']}, {result['recordsProcessed']} records, {result['recordsFailed']} failed")
+        for error in result['errors']:
+            print(f"   {error}")
+    finally:
+        connection.close()
@@ -0,0 +1,124 @@
+"""
+Carbon reduction recommendations for an ingested CCFT upload.
+
+Same rules as generateRecommendations() in the Next.js aws-tracker route,
+computed from per-service and per-region emission totals that the pipeline
+accumulates while streaming, so the upload never has to be held in memory.
+"""
+
+import json
+
+HIGH_CARBON_REGIONS = ['US East (N. Virginia)', 'Asia Pacific (Singapore)', 'Middle East (Bahrain)']
+LOW_CARBON_REGIONS = ['EU (Frankfurt)', 'Canada (Central)', 'US West (Oregon)']
+
+
+def build_recommendations(service_totals, region_totals):
+    """service_totals / region_totals: {product_code or location: total mbm emissions}"""
+    total_emissions = sum(service_totals.values())
+    recommendations = []
+
+    # Service optimization recommendations
+    top_services = sorted(service_totals.items(), key=lambda item: item[1], reverse=True)[:3]
+    for service, emissions in top_services:
+        percentage = emissions / total_emissions * 100 if total_emissions else 0
+        if percentage > 20:
+            recommendations.append({
+                'category': 'service_optimization',
+                'priority': 'high',
+                'title': f'Optimize {service} Usage',
+                'description': (
+                    f'{service} accounts for {percentage:.1f}% of your carbon footprint. '
+                    'Consider optimizing resource usage, implementing auto-scaling, or right-sizing instances.'
+                ),
+                'potential_co2_reduction': emissions * 0.3,  # Estimate 30% reduction potential
+                'action_items': [
+                    'Review instance types and sizes',
+                    'Implement auto-scaling policies',
+                    'Schedule non-critical workloads during off-peak hours',
+                    'Consider reserved instances for predictable workloads'
+                ],
+                'related_service': service
+            })
+
+    # Region-based recommendations
+    for region, emissions in sorted(region_totals.items(), key=lambda item: item[1], reverse=True):
+        if any(high in region for high in HIGH_CARBON_REGIONS):
+            alternative = LOW_CARBON_REGIONS[0]
+            recommendations.append({
+                'category': 'region_migration',
+                'priority': 'medium',
+                'title': f'Consider Migrating from {region}',
+                'description': (
+                    f'{region} has a higher carbon intensity. Migrating to greener regions '
+                    f'like {alternative} could reduce emissions by up to 50%.'
+                ),
+                'potential_co2_reduction': emissions * 0.5,
+                'action_items': [
+                    'Analyze workload latency requirements',
+                    'Evaluate data residency regulations',
+                    'Plan phased migration strategy',
+                    'Test performance in alternative regions'
+                ],
+                'related_region': region
+            })
+
+    # General best practices
+    if total_emissions > 10:
+        recommendations.append({
+            'category': 'cost_saving',
+            'priority': 'medium',
+            'title': 'Implement AWS Compute Optimizer',
+            'description': (
+                'AWS Compute Optimizer provides recommendations for optimal AWS resource configurations, '
+                'which can reduce both costs and carbon emissions.'
+            ),
+            'potential_co2_reduction': total_emissions * 0.15,
+            'action_items': [
+                'Enable AWS Compute Optimizer',
+                'Review EC2 instance recommendations',
+                'Implement Lambda memory optimization',
+                'Consider Graviton-based instances for better efficiency'
+            ]
+        })
+        recommendations.append({
+            'category': 'resource_right_sizing',
+            'priority': 'high',
+            'title': 'Right-Size Storage Resources',
+            'description': (
+                'Optimize EBS volumes and S3 storage classes to reduce unnecessary storage '
+                'and associated emissions.'
+            ),
+            'potential_co2_reduction': total_emissions * 0.1,
+            'action_items': [
+                'Identify and delete unused EBS volumes',
+                'Implement S3 Intelligent-Tiering',
+                'Set lifecycle policies for older data',
+                'Use S3 Glacier for archival data'
+            ]
+        })
+
+    return recommendations
+
+
+def insert_recommendations(cursor, user_id, recommendations):
+    for rec in recommendations:
+        cursor.execute(
+            """
+            INSERT INTO aws_carbon_recommendations
+                (user_id, category, priority, title, description, potential_co2_reduction,
+                 action_items, related_service, related_region, status)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, 'active')
+            ON CONFLICT DO NOTHING
+            """,
+            (
+                str(user_id),
+                rec['category'],
+                rec['priority'],
+                rec['title'],
+                rec['description'],
+                rec['potential_co2_reduction'],
+                json.dumps(rec['action_items']),
+                rec.get('related_service'),
+                rec.get('related_region'),
+            )
+        )
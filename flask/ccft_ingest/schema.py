@@ -0,0 +1,55 @@
+"""
+Idempotent schema additions for the CCFT ingestion service.
+
+aws_upload_history, aws_carbon_footprint and friends are created with the
+web app; this only adds progress columns and the per-row error table.
+Run directly with `python schema.py`, or automatically at startup unless
+DB_AUTO_MIGRATE=false.
+"""
+
+# Arbitrary constant so concurrently starting workers migrate one at a time
+SCHEMA_LOCK_ID = 727274002
+
+SCHEMA_STATEMENTS = [
+    """
+    ALTER TABLE aws_upload_history
+        ADD COLUMN IF NOT EXISTS rows_read BIGINT NOT NULL DEFAULT 0,
+        ADD COLUMN IF NOT EXISTS bytes_read BIGINT NOT NULL DEFAULT 0,
+        ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+    """,
+    # upload_id is stored as text so this does not depend on the history id type
+    """
+    CREATE TABLE IF NOT EXISTS aws_upload_errors (
+        upload_id TEXT NOT NULL,
+        row_number BIGINT NOT NULL,
+        error TEXT NOT NULL,
+        created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_aws_upload_errors_upload
+        ON aws_upload_errors (upload_id, row_number)
+    """,
+]
+
+
+def ensure_schema(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK_ID,))
+        for statement in SCHEMA_STATEMENTS:
+            cursor.execute(statement)
+    conn.commit()
+
+
+if __name__ == '__main__':
+    import os
+    import psycopg2
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    connection = psycopg2.connect(os.getenv('DATABASE_URL'))
+    try:
+        ensure_schema(connection)
+        print("✅ Schema ready")
+    finally:
+        connection.close()
@@ -0,0 +1,441 @@
+"""
+Bulk CO2 worker for llmprompts rows that have not been scored yet.
+
+Replaces the per-row HTTP calls of web-framework/lib/co2-worker.ts: each tick
+claims up to CO2_WORKER_BATCH_SIZE pending rows with FOR UPDATE SKIP LOCKED,
+scores them in-process with EnvironmentalImpactTracker.estimate_many(), and
+writes every result back with one UPDATE ... FROM (VALUES ...). Rows that fail
+get retry_count + 1 and last_error, exactly like the Node worker.
+
+The worker LISTENs on the channel the extension backend NOTIFYs after every
+insert, so new rows are scored as soon as they commit; notifications that
+arrive within CO2_WORKER_COALESCE_MS are folded into the same batch. A slow
+fallback poll (CO2_WORKER_FALLBACK_POLL_MS) catches rows from writers that do
+not notify, and anything missed while the listener was reconnecting.
+
+Ticks only look at rows captured in the last CO2_WORKER_LOOKBACK_DAYS, so the
+claim touches the newest monthly partitions. Older pending rows (a long outage,
+a bulk import of old data) are reached by a catch-up pass over the whole table,
+run whenever the recent backlog is drained, at most once per
+CO2_WORKER_CATCHUP_SECONDS. `--drain` lifts the bound for every tick.
+
+    python co2_worker.py           # run forever
+    python co2_worker.py --once    # drain the backlog and exit
+    python co2_worker.py --drain   # drain the whole table, ignoring the lookback, and exit
+
+Set CO2_WORKER_ENABLED=false for the Next.js app so only one worker runs.
+"""
+
+import os
+import select
+import sys
+import time
+from datetime import timezone
+
+import psycopg2
+import psycopg2.extras
+from dotenv import load_dotenv
+
+from impact_tracker import EnvironmentalImpactTracker
+
+load_dotenv()
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+BATCH_SIZE = int(os.getenv('CO2_WORKER_BATCH_SIZE', 5000))
+MAX_RETRY = int(os.getenv('CO2_WORKER_MAX_RETRY', 3))
+FALLBACK_POLL_SECONDS = float(os.getenv('CO2_WORKER_FALLBACK_POLL_MS', 60000)) / 1000
+COALESCE_SECONDS = float(os.getenv('CO2_WORKER_COALESCE_MS', 50)) / 1000
+LOOKBACK_DAYS = int(os.getenv('CO2_WORKER_LOOKBACK_DAYS', 31))
+# How often the idle worker also scans past the lookback window
+CATCHUP_SECONDS = float(os.getenv('CO2_WORKER_CATCHUP_SECONDS', 3600))
+# Same channel as NOTIFY_CHANNEL in extension_backend/ingest.py
+NOTIFY_CHANNEL = 'llmprompts_pending'
+# Same as WATERMARK_NAME in extension_backend/timeseries.py
+BUCKET_WATERMARK = 'daily_buckets'
+# Grid intensity is hourly data; refetch it per region at most this often
+GRID_TTL_SECONDS = float(os.getenv('CO2_WORKER_GRID_TTL', 3600))
+# After a failed tick, wait 1s, 2s, 4s, ... up to this long before trying again
+RETRY_MAX_SECONDS = float(os.getenv('CO2_WORKER_RETRY_MAX_SECONDS', 60))
+
+SCHEMA_STATEMENTS = [
+    """
+    ALTER TABLE llmprompts
+        ADD COLUMN IF NOT EXISTS co2_calculated BOOLEAN DEFAULT FALSE,
+        ADD COLUMN IF NOT EXISTS retry_count INTEGER NOT NULL DEFAULT 0,
+        ADD COLUMN IF NOT EXISTS last_error TEXT
+    """,
+    "UPDATE llmprompts SET co2_calculated = FALSE WHERE co2_calculated IS NULL",
+    """
+    CREATE INDEX IF NOT EXISTS idx_llmprompts_co2_pending
+        ON llmprompts (id, retry_count)
+        WHERE co2_calculated = FALSE
+    """,
+]
+
+
+class TrackerCache:
+    """One EnvironmentalImpactTracker per (provider, region), refreshed every GRID_TTL_SECONDS"""
+
+    def __init__(self, ttl=GRID_TTL_SECONDS):
+        self.ttl = ttl
+        self._trackers = {}
+
+    def get(self, provider, region):
+        key = (provider or 'gcp', region or 'asia-south1')
+        cached = self._trackers.get(key)
+        if cached is None or time.monotonic() - cached[0] > self.ttl:
+            tracker = EnvironmentalImpactTracker(
+                cloud_provider=key[0],
+                cloud_region=key[1],
+                electricity_maps_api_key=os.getenv('ELECTRICITY_MAPS_API_KEY')
+            )
+            cached = (time.monotonic(), tracker)
+            self._trackers[key] = cached
+        return cached[1]
+
+
+class PendingListener:
+    """Dedicated autocommit connection that LISTENs for newly inserted rows"""
+
+    def __init__(self, dsn, channel=NOTIFY_CHANNEL):
+        self.dsn = dsn
+        self.channel = channel
+        self._conn = None
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn)
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute(f"LISTEN {self.channel}")
+        self._conn = conn
+
+    def _drain(self):
+        self._conn.poll()
+        received = bool(self._conn.notifies)
+        self._conn.notifies.clear()
+        return received
+
+    def wait(self, timeout):
+        """
+        Block until a notification arrives or `timeout` seconds pass.
+        Returns True when woken by a notification (or a lost connection, so the
+        caller catches up), False when the fallback poll is due.
+        """
+        try:
+            if self._conn is None or self._conn.closed:
+                self._connect()
+            if not self._drain():
+                readable, _, _ = select.select([self._conn], [], [], timeout)
+                if not readable or not self._drain():
+                    return False
+
+            # Coalesce a burst of commits into one batch
+            deadline = time.monotonic() + COALESCE_SECONDS
+            while (remaining := deadline - time.monotonic()) > 0:
+                readable, _, _ = select.select([self._conn], [], [], remaining)
+                if not readable:
+                    break
+                self._drain()
+            return True
+        except psycopg2.OperationalError as e:
+            print(f"[CO2Worker] ⚠️  Listener connection lost: {e}")
+            self.close()
+            time.sleep(min(timeout, 5))
+            return True
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def ensure_schema(conn):
+    """Same idempotent columns and partial index the Node worker creates"""
+    with conn.cursor() as cursor:
+        for statement in SCHEMA_STATEMENTS:
+            cursor.execute(statement)
+    conn.commit()
+
+
+def claim_pending(cursor, limit, lookback_days=LOOKBACK_DAYS):
+    """Lock up to `limit` pending rows; `lookback_days=None` scans the whole table"""
+    window = "AND captured_at >= CURRENT_TIMESTAMP - make_interval(days => %s)" if lookback_days is not None else ""
+    cursor.execute(
+        f"""
+        SELECT id, captured_at, user_id, model, llm, input_tokens, output_tokens, is_cached,
+               cloud_provider, cloud_region, energy_kwh, co2_grams, water_liters
+        FROM llmprompts
+        -- ensure_schema() turns NULL into FALSE, so this matches the partial index
+        WHERE co2_calculated = FALSE
+          AND retry_count < %s
+          AND input_tokens IS NOT NULL
+          AND output_tokens IS NOT NULL
+          AND model IS NOT NULL
+          {window}
+        ORDER BY id
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+        """,
+        (MAX_RETRY, lookback_days, limit) if lookback_days is not None else (MAX_RETRY, limit)
+    )
+    return cursor.fetchall()
+
+
+def score_rows(rows, trackers):
+    """Return (updates, failures) for the claimed rows, scored per region"""
+    by_region = {}
+    for row in rows:
+        by_region.setdefault((row['cloud_provider'], row['cloud_region']), []).append(row)
+
+    updates, failures = [], []
+    for (provider, region), group in by_region.items():
+        try:
+            tracker = trackers.get(provider, region)
+        except Exception as e:
+            failures.extend((row, str(e)) for row in group)
+            continue
+        results, errors = tracker.estimate_many([
+            (row['model'], row['input_tokens'], row['output_tokens'], bool(row['is_cached']))
+            for row in group
+        ])
+        for index, energy, co2, water in results:
+            updates.append((group[index], energy, co2, water,
+                            tracker.grid.grid_zone, tracker.grid.carbon_intensity_g_per_kwh))
+        failures.extend((group[index], message) for index, message in errors)
+    return updates, failures
+
+
+def write_results(cursor, updates, failures, sync_rollups=True):
+    """Persist a tick's results in two set-based statements"""
+    if updates:
+        psycopg2.extras.execute_values(
+            cursor,
+            """
+            UPDATE llmprompts p SET
+                energy_kwh = v.energy_kwh,
+                co2_grams = v.co2_grams,
+                water_liters = v.water_liters,
+                grid_zone = v.grid_zone,
+                carbon_intensity_g_per_kwh = v.intensity,
+                co2_calculated = TRUE,
+                retry_count = 0,
+                last_error = NULL
+            FROM (VALUES %s) AS v(id, captured_at, energy_kwh, co2_grams, water_liters, grid_zone, intensity)
+            WHERE p.id = v.id AND p.captured_at = v.captured_at
+            """,
+            [
+                (row['id'], row['captured_at'], energy, co2, water, zone, round(intensity))
+                for row, energy, co2, water, zone, intensity in updates
+            ],
+            template='(%s, %s::timestamptz, %s::numeric, %s::numeric, %s::numeric, %s, %s::integer)',
+            page_size=len(updates)
+        )
+        if sync_rollups:
+            apply_rollup_deltas(cursor, updates)
+
+    if failures:
+        psycopg2.extras.execute_values(
+            cursor,
+            """
+            UPDATE llmprompts p SET
+                retry_count = p.retry_count + 1,
+                last_error = v.last_error
+            FROM (VALUES %s) AS v(id, captured_at, last_error)
+            WHERE p.id = v.id AND p.captured_at = v.captured_at
+            """,
+            [(row['id'], row['captured_at'], message[:500]) for row, message in failures],
+            template='(%s, %s::timestamptz, %s)',
+            page_size=len(failures)
+        )
+
+
+def apply_rollup_deltas(cursor, updates):
+    """
+    Rows that were already scored at ingest are counted in the extension
+    backend's rollups and time buckets; move those totals by the difference.
+    Rows that were never scored are not in them yet (see `rollups.py rebuild`).
+    """
+    deltas = {}
+    hourly = {}
+    daily = {}
+    for row, energy, co2, water, _, _ in updates:
+        if row['energy_kwh'] is None:
+            continue
+        change = (
+            energy - float(row['energy_kwh']),
+            co2 - float(row['co2_grams'] or 0),
+            water - float(row['water_liters'] or 0),
+        )
+        user_id = str(row['user_id'])
+        hour = row['captured_at'].astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+        # Same key and defaults as timeseries.apply_buckets at ingest
+        group = (row['model'] or 'Unknown', row['llm'] or 'Unknown', row['cloud_region'] or 'unknown')
+        for totals, key in ((deltas, user_id),
+                            (hourly, (user_id, hour) + group),
+                            (daily, (user_id, hour.replace(hour=0)) + group)):
+            current = totals.setdefault(key, [0.0, 0.0, 0.0])
+            for index, value in enumerate(change):
+                current[index] += value
+    if not deltas:
+        return
+
+    # One user at a time, sorted, to lock rollup rows in the same order as ingestion
+    for user_id in sorted(deltas):
+        cursor.execute(
+            """
+            UPDATE llmprompt_user_rollups SET
+                total_energy_kwh = total_energy_kwh + %s,
+                total_co2_grams = total_co2_grams + %s,
+                total_water_liters = total_water_liters + %s,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE user_id = %s
+            """,
+            tuple(deltas[user_id]) + (user_id,)
+        )
+
+    # Holding the watermark (shared) keeps `timeseries.py rollup` from folding
+    # hours into days between the two updates below
+    cursor.execute(
+        "SELECT rolled_up_to FROM llmprompt_bucket_watermarks WHERE name = %s FOR SHARE",
+        (BUCKET_WATERMARK,)
+    )
+    watermark = cursor.fetchone()
+    watermark = watermark['rolled_up_to'] if watermark else None
+
+    _apply_bucket_deltas(cursor, 'llmprompt_hourly_buckets', hourly)
+    if watermark is not None:
+        # Days before the watermark were already folded from the hourly rows
+        _apply_bucket_deltas(cursor, 'llmprompt_daily_buckets',
+                             {key: change for key, change in daily.items() if key[1] < watermark})
+
+
+def _apply_bucket_deltas(cursor, table, deltas):
+    if not deltas:
+        return
+    psycopg2.extras.execute_values(
+        cursor,
+        f"""
+        UPDATE {table} b SET
+            energy_kwh = b.energy_kwh + v.energy_kwh,
+            co2_grams = b.co2_grams + v.co2_grams,
+            water_liters = b.water_liters + v.water_liters
+        FROM (VALUES %s) AS v(user_id, bucket_start, model, llm, cloud_region,
+                              energy_kwh, co2_grams, water_liters)
+        WHERE b.user_id = v.user_id AND b.bucket_start = v.bucket_start
+          AND b.model = v.model AND b.llm = v.llm AND b.cloud_region = v.cloud_region
+        """,
+        # Sorted, like ingestion, so concurrent writers lock bucket rows in the same order
+        [key + tuple(deltas[key]) for key in sorted(deltas)],
+        template='(%s::uuid, %s::timestamptz, %s, %s, %s, %s::numeric, %s::numeric, %s::numeric)',
+        page_size=len(deltas)
+    )
+
+
+def tick(conn, trackers, batch_size=BATCH_SIZE, sync_rollups=True, lookback_days=LOOKBACK_DAYS):
+    """Claim, score and persist one batch; returns the number of rows claimed"""
+    try:
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            rows = claim_pending(cursor, batch_size, lookback_days)
+            if not rows:
+                conn.rollback()
+                return 0
+            updates, failures = score_rows(rows, trackers)
+            write_results(cursor, updates, failures, sync_rollups)
+        conn.commit()
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+
+    print(f"[CO2Worker] ✅ {len(updates)} scored, {len(failures)} failed")
+    return len(rows)
+
+
+def _has_rollups(conn):
+    """Whether the extension backend's rollup and bucket tables exist"""
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT to_regclass('llmprompt_user_rollups') IS NOT NULL"
+            " AND to_regclass('llmprompt_hourly_buckets') IS NOT NULL"
+            " AND to_regclass('llmprompt_bucket_watermarks') IS NOT NULL"
+        )
+        present = cursor.fetchone()[0]
+    conn.commit()
+    return present
+
+
+def connect():
+    """Open the worker's connection; returns (conn, sync_rollups)"""
+    conn = psycopg2.connect(DATABASE_URL)
+    try:
+        ensure_schema(conn)
+        # Without the extension backend's tables there are no rollups to keep in sync
+        return conn, _has_rollups(conn)
+    except Exception:
+        conn.close()
+        raise
+
+
+def run(once=False, drain=False):
+    """
+    Score pending rows until stopped. `once` returns when the backlog is
+    drained; `drain` also ignores the lookback window on every tick.
+    """
+    trackers = TrackerCache()
+    listener = PendingListener(DATABASE_URL)
+    conn = None
+    sync_rollups = False
+    retry_delay = 1.0
+    lookback = None if drain else LOOKBACK_DAYS
+    # The first idle moment after startup runs a catch-up pass
+    next_catchup = time.monotonic()
+
+    print(f"[CO2Worker] Starting: batch {BATCH_SIZE}, max retries {MAX_RETRY}, "
+          f"lookback {'none' if drain else f'{LOOKBACK_DAYS}d'}, fallback poll {FALLBACK_POLL_SECONDS:g}s")
+    try:
+        while True:
+            started = time.monotonic()
+            try:
+                if conn is None:
+                    conn, sync_rollups = connect()
+                claimed = tick(conn, trackers, sync_rollups=sync_rollups, lookback_days=lookback)
+            except Exception as e:
+                if once:
+                    raise
+                # A failover or dropped connection must not end the worker:
+                # reconnect when the connection is gone and try again later
+                lost = isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+                if conn is not None and (lost or conn.closed):
+                    conn.close()
+                    conn = None
+                print(f"[CO2Worker] ❌ Tick failed, retrying in {retry_delay:g}s: {e}")
+                time.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, RETRY_MAX_SECONDS)
+                continue
+            retry_delay = 1.0
+
+            if claimed:
+                rate = claimed / max(time.monotonic() - started, 1e-6)
+                print(f"[CO2Worker] ⚙️  {claimed} rows in one tick ({rate:,.0f} rows/s)")
+            if claimed < BATCH_SIZE:
+                # Backlog drained; otherwise go straight to the next batch
+                if lookback is not None and time.monotonic() >= next_catchup:
+                    # Rows older than the window would never be claimed by the
+                    # bounded query; sweep the whole table until it runs dry
+                    lookback = None
+                    next_catchup = time.monotonic() + CATCHUP_SECONDS
+                    continue
+                if not drain:
+                    lookback = LOOKBACK_DAYS
+                if once:
+                    return
+                listener.wait(FALLBACK_POLL_SECONDS)
+    finally:
+        listener.close()
+        if conn is not None:
+            conn.close()
+
+
+if __name__ == '__main__':
+    drain = '--drain' in sys.argv[1:]
+    run(once=drain or '--once' in sys.argv[1:], drain=drain)
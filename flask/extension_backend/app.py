@@ -1,27 +1,64 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 from datetime import datetime, timedelta
-import psycopg2
-from psycopg2.extras import RealDictCursor
 import os
 from dotenv import load_dotenv
 import jwt
 from functools import wraps
-import bcrypt
 import re
 import uuid
+import atexit
+import sys
+
+import psycopg2
+
+# Shared instrumentation lives in flask/gaia_common (also used by db.py)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from gaia_common.metrics import BATCH_SIZE, CACHE_EVENTS, StatsCollector, instrument_app
+from gaia_common.tracing import debug_authorized, span, trace_app
+
+from db import ConnectionPool, PoolTimeoutError, ReadRouter
+from query_log import QueryLog
+from ingest import (
+    PayloadError,
+    validate_event,
+    validate_events,
+    decode_batch_payload,
+    compute_impacts,
+    impact_summary,
+    insert_metrics,
+    insert_queued_metrics,
+)
+from write_behind import WriteBehindQueue, QueueFullError
+from schema import ensure_schema
+from partitions import PartitionKeeper
+from rollups import read_summary, rebuild_user_rollups
+from history import InvalidCursorError, decode_cursor, fetch_history_page, count_history
+from export import EXPORT_FORMATS, iter_history, encode_rows, gzip_stream
+from timeseries import parse_range, fetch_timeseries, BUCKET_SIZES
+from auth_cache import AuthCache
+from passwords import PasswordHasher, HasherBusyError
+from ratelimit import Limit, RedisBuckets, RateLimiter, retry_after_header
 
 # Load environment variables
 load_dotenv()
 
 app = Flask(__name__)
 
+# Prometheus-style metrics at /metrics (bearer token required when METRICS_TOKEN is set)
+instrument_app(app, token=os.getenv('METRICS_TOKEN'))
+
+# Request IDs, span timing (sampled, or X-Gaia-Trace: 1 with the DEBUG_TOKEN),
+# per-request profiling, /debug/traces and /debug/queries
+DEBUG_TOKEN = os.getenv('DEBUG_TOKEN')
+trace_app(app, sample_rate=float(os.getenv('TRACE_SAMPLE_RATE', 0)), debug_token=DEBUG_TOKEN)
+
 # CORS Configuration - Allow Chrome extension
 CORS(app, resources={
     r"/api/*": {
         "origins": ["chrome-extension://*", "http://localhost:*"],
         "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-        "allow_headers": ["Content-Type", "Authorization"],
+        "allow_headers": ["Content-Type", "Authorization", "Content-Encoding"],
         "expose_headers": ["Content-Type", "Authorization"],
         "supports_credentials": True
     }
@@ -32,17 +69,211 @@ JWT_SECRET = os.getenv('JWT_SECRET', 'your-secret-key-change-this-in-production'
 JWT_ALGORITHM = 'HS256'
 JWT_EXPIRATION_HOURS = 720  # 30 days
 
+# Validated token claims and /api/auth/verify user records, cached per process.
+# Claims never outlive the token's exp. Every write to `users` here calls
+# auth_cache.invalidate_user; records changed elsewhere (the web app, other
+# workers) are at most AUTH_USER_CACHE_TTL seconds stale.
+auth_cache = AuthCache(
+    max_tokens=int(os.getenv('AUTH_CACHE_MAX_TOKENS', 10000)),
+    claims_ttl=float(os.getenv('AUTH_CACHE_TTL', 300)),
+    max_users=int(os.getenv('AUTH_CACHE_MAX_USERS', 10000)),
+    user_ttl=float(os.getenv('AUTH_USER_CACHE_TTL', 60))
+)
+
+# bcrypt runs in its own process pool so a login burst can't starve ingestion.
+# At most BCRYPT_MAX_PENDING hashes are queued or running per process; callers
+# that wait longer than BCRYPT_QUEUE_TIMEOUT seconds get a 503.
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', 12))
+BCRYPT_REHASH_ON_LOGIN = os.getenv('BCRYPT_REHASH_ON_LOGIN', 'true').lower() == 'true'
+
+password_hasher = PasswordHasher(
+    workers=int(os.getenv('BCRYPT_WORKERS', 2)),
+    max_pending=int(os.getenv('BCRYPT_MAX_PENDING', 8)),
+    queue_timeout=float(os.getenv('BCRYPT_QUEUE_TIMEOUT', 2)),
+    rounds=BCRYPT_ROUNDS
+)
+atexit.register(password_hasher.shutdown)
+
 # Database connection configuration
 DATABASE_URL = os.getenv('DATABASE_URL')
 
+# Connection pool sizing (per process; multiply by gunicorn workers for the DB total)
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 5))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', 15000))
+DB_AUTO_MIGRATE = os.getenv('DB_AUTO_MIGRATE', 'true').lower() == 'true'
+
+# Monthly partitions of llmprompts are created this far ahead, checked from
+# the ingest path at most every PARTITION_CHECK_SECONDS per process
+PARTITION_MONTHS_AHEAD = int(os.getenv('PARTITION_MONTHS_AHEAD', 3))
+PARTITION_CHECK_SECONDS = float(os.getenv('PARTITION_CHECK_SECONDS', 3600))
+
+# Slow-query log: latency per query shape, the slowest statements and
+# EXPLAIN (ANALYZE, BUFFERS) plans of slow reads (see /debug/queries)
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', 250))
+SLOW_QUERY_TOP = int(os.getenv('SLOW_QUERY_TOP', 50))
+SLOW_QUERY_EXPLAIN = os.getenv('SLOW_QUERY_EXPLAIN', 'true').lower() == 'true'
+SLOW_QUERY_EXPLAIN_INTERVAL = float(os.getenv('SLOW_QUERY_EXPLAIN_INTERVAL', 300))
+
+query_log = QueryLog(
+    slow_ms=SLOW_QUERY_MS,
+    top=SLOW_QUERY_TOP,
+    explain=SLOW_QUERY_EXPLAIN,
+    explain_interval=SLOW_QUERY_EXPLAIN_INTERVAL
+)
+
+db_pool = ConnectionPool(
+    DATABASE_URL,
+    minconn=DB_POOL_MIN,
+    maxconn=DB_POOL_MAX,
+    timeout=DB_POOL_TIMEOUT,
+    statement_timeout_ms=DB_STATEMENT_TIMEOUT_MS,
+    query_log=query_log
+)
+atexit.register(db_pool.closeall)
+
+# Optional read replica for dashboard reads (falls back to the primary when
+# unreachable or lagging, and for users who wrote in the last few seconds)
+DATABASE_READ_URL = os.getenv('DATABASE_READ_URL')
+DB_READ_POOL_MAX = int(os.getenv('DB_READ_POOL_MAX', DB_POOL_MAX))
+DB_REPLICA_MAX_LAG = float(os.getenv('DB_REPLICA_MAX_LAG', 5))
+DB_READ_YOUR_WRITES_SECONDS = float(os.getenv('DB_READ_YOUR_WRITES_SECONDS', 10))
+
+read_pool = None
+if DATABASE_READ_URL:
+    read_pool = ConnectionPool(
+        DATABASE_READ_URL,
+        minconn=DB_POOL_MIN,
+        maxconn=DB_READ_POOL_MAX,
+        timeout=DB_POOL_TIMEOUT,
+        statement_timeout_ms=DB_STATEMENT_TIMEOUT_MS,
+        query_log=query_log
+    )
+    atexit.register(read_pool.closeall)
+
+db_router = ReadRouter(
+    db_pool,
+    read_pool,
+    max_lag=DB_REPLICA_MAX_LAG,
+    read_your_writes=DB_READ_YOUR_WRITES_SECONDS
+)
+
+# Batch ingestion limits
+METRICS_BATCH_MAX_EVENTS = int(os.getenv('METRICS_BATCH_MAX_EVENTS', 1000))
+METRICS_BATCH_MAX_BYTES = int(os.getenv('METRICS_BATCH_MAX_BYTES', 10 * 1024 * 1024))
+
+# Largest page /api/metrics/user will return
+METRICS_PAGE_MAX = int(os.getenv('METRICS_PAGE_MAX', 1000))
+
+# Optional write-behind mode for /api/extension/metrics (202 + background bulk flush)
+METRICS_WRITE_BEHIND = os.getenv('METRICS_WRITE_BEHIND', 'false').lower() == 'true'
+METRICS_QUEUE_MAX = int(os.getenv('METRICS_QUEUE_MAX', 10000))
+METRICS_FLUSH_BATCH = int(os.getenv('METRICS_FLUSH_BATCH', 500))
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', 1.0))
+METRICS_SPILL_DIR = os.getenv('METRICS_SPILL_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spill'))
+METRICS_MAX_ATTEMPTS = int(os.getenv('METRICS_MAX_ATTEMPTS', 3))
+
+# Token-bucket rate limits (requests or events per second, and burst size).
+# In-process by default (global limits are then per worker); set
+# RATE_LIMIT_REDIS_URL to share every bucket across workers and hosts.
+RATE_LIMITS_ENABLED = os.getenv('RATE_LIMITS_ENABLED', 'true').lower() == 'true'
+RATE_LIMIT_REDIS_URL = os.getenv('RATE_LIMIT_REDIS_URL')
+
+def _limit_from_env(name, rate, burst):
+    rate = float(os.getenv(f'{name}_RATE', rate))
+    return Limit(rate, float(os.getenv(f'{name}_BURST', burst))) if rate > 0 else None
+
+rate_limiter = None
+if RATE_LIMITS_ENABLED:
+    rate_limiter = RateLimiter({
+        # ingest is charged per event, so a full batch fits in one burst
+        'ingest': (
+            _limit_from_env('RATE_LIMIT_INGEST_USER', 20, 1000),
+            _limit_from_env('RATE_LIMIT_INGEST_GLOBAL', 2000, 5000)
+        ),
+        'read': (
+            _limit_from_env('RATE_LIMIT_READ_USER', 5, 30),
+            _limit_from_env('RATE_LIMIT_READ_GLOBAL', 500, 1000)
+        ),
+    })
+    if RATE_LIMIT_REDIS_URL:
+        try:
+            rate_limiter.backend = RedisBuckets(RATE_LIMIT_REDIS_URL)
+        except ImportError:
+            print("⚠️  RATE_LIMIT_REDIS_URL is set but the redis package is not installed; using in-process limits")
+
 def get_db_connection():
-    """Create and return a database connection"""
+    """
+    Check a connection out of the shared pool.
+    Use as a context manager so the connection is always returned:
+
+        with get_db_connection() as conn:
+            ...
+    """
+    return db_pool.connection()
+
+def get_read_connection(user_id=None):
+    """
+    Check out a connection for read-only queries on behalf of `user_id`:
+    the read replica when configured and fresh enough, otherwise the primary
+    """
+    return db_router.connection(user_id)
+
+def write_queued_metrics(items):
+    """Flush write-behind events to the database in a single transaction"""
+    BATCH_SIZE.labels('write_behind_flush').observe(len(items))
+    partition_keeper.check()
+    with get_db_connection() as conn, conn.cursor() as cursor:
+        insert_queued_metrics(cursor, items)
+        conn.commit()
+    print(f"✅ Write-behind flushed {len(items)} events")
+
+# Create derived tables (rollups, ...) on startup
+if DB_AUTO_MIGRATE and DATABASE_URL:
     try:
-        conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
-        return conn
+        with get_db_connection() as conn:
+            ensure_schema(conn, PARTITION_MONTHS_AHEAD)
     except Exception as e:
-        print(f"❌ Database connection error: {e}")
-        raise
+        print(f"⚠️  Schema setup skipped: {e}")
+
+partition_keeper = PartitionKeeper(get_db_connection, PARTITION_MONTHS_AHEAD, PARTITION_CHECK_SECONDS)
+
+metrics_queue = None
+if METRICS_WRITE_BEHIND:
+    metrics_queue = WriteBehindQueue(
+        write_queued_metrics,
+        max_size=METRICS_QUEUE_MAX,
+        batch_size=METRICS_FLUSH_BATCH,
+        flush_interval=METRICS_FLUSH_INTERVAL,
+        spill_dir=METRICS_SPILL_DIR or None,
+        max_attempts=METRICS_MAX_ATTEMPTS,
+        # Database unreachable: keep the batch and retry it whole
+        transient_errors=(psycopg2.OperationalError, psycopg2.InterfaceError, PoolTimeoutError)
+    )
+    # Start now so spill files of crashed processes are replayed without
+    # waiting for the next event
+    metrics_queue.start()
+    # Registered after the pool so it runs first and can still use it
+    atexit.register(metrics_queue.stop)
+
+CLAIMS_HIT = CACHE_EVENTS.labels('auth_claims', 'hit')
+CLAIMS_MISS = CACHE_EVENTS.labels('auth_claims', 'miss')
+USER_HIT = CACHE_EVENTS.labels('auth_user', 'hit')
+USER_MISS = CACHE_EVENTS.labels('auth_user', 'miss')
+
+# Pools, queues and limiters already keep stats; export them as gauges
+StatsCollector('gaia_db_pool', 'Primary connection pool usage', db_pool.stats)
+if read_pool is not None:
+    StatsCollector('gaia_db_read_pool', 'Read replica connection pool usage', read_pool.stats)
+StatsCollector('gaia_db_read_routing', 'Reads routed to the replica or primary', db_router.stats)
+StatsCollector('gaia_db_queries', 'SQL statements, slow statements and captured plans', query_log.stats)
+StatsCollector('gaia_partition_checks', 'Partition checks from the ingest path', partition_keeper.stats)
+StatsCollector('gaia_password_hashing', 'bcrypt process pool usage', password_hasher.stats)
+if rate_limiter is not None:
+    StatsCollector('gaia_rate_limits', 'Rate limiter decisions per scope', rate_limiter.stats)
+if metrics_queue is not None:
+    StatsCollector('gaia_write_behind', 'Write-behind queue state', metrics_queue.stats)
 
 def token_required(f):
     """Decorator to validate JWT tokens"""
@@ -61,19 +292,51 @@ def token_required(f):
         if not token:
             return jsonify({'error': 'Token is missing'}), 401
         
-        try:
-            # Decode JWT token
-            data = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-            current_user_id = data['user_id']
-        except jwt.ExpiredSignatureError:
-            return jsonify({'error': 'Token has expired'}), 401
-        except jwt.InvalidTokenError:
-            return jsonify({'error': 'Invalid token'}), 401
+        # Tokens seen recently skip signature verification (entries expire with the token)
+        data = auth_cache.get_claims(token)
+        (CLAIMS_HIT if data is not None else CLAIMS_MISS).inc()
+        if data is None:
+            try:
+                # Decode JWT token
+                data = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+            except jwt.ExpiredSignatureError:
+                return jsonify({'error': 'Token has expired'}), 401
+            except jwt.InvalidTokenError:
+                return jsonify({'error': 'Invalid token'}), 401
+            if 'user_id' not in data:
+                return jsonify({'error': 'Invalid token'}), 401
+            auth_cache.put_claims(token, data)
+        current_user_id = data['user_id']
         
         return f(current_user_id, *args, **kwargs)
     
     return decorated
 
+def rate_limit_response(scope, user_id, cost=1):
+    """Return a 429 response if the user or the service is over its `scope` limit, else None"""
+    if rate_limiter is None:
+        return None
+    allowed, retry_after = rate_limiter.check(scope, user_id, cost)
+    if allowed:
+        return None
+    return jsonify({
+        'error': 'Rate limit exceeded, retry later',
+        'retry_after': round(retry_after, 3)
+    }), 429, {'Retry-After': retry_after_header(retry_after)}
+
+def rate_limited(scope):
+    """Decorator (below token_required) that applies the `scope` rate limit before the handler runs"""
+    def decorator(f):
+        @wraps(f)
+        def decorated(current_user_id, *args, **kwargs):
+            if request.method != 'OPTIONS':
+                limited = rate_limit_response(scope, current_user_id)
+                if limited is not None:
+                    return limited
+            return f(current_user_id, *args, **kwargs)
+        return decorated
+    return decorator
+
 def validate_email(email):
     """Validate email format"""
     pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
@@ -115,28 +378,39 @@ def login():
             return jsonify({'error': 'Invalid email format'}), 400
         
         # Get user from database
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            "SELECT id, name, email, password_hash FROM users WHERE email = %s",
-            (email,)
-        )
-        
-        user = cursor.fetchone()
-        cursor.close()
-        conn.close()
+        with get_db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT id, name, email, password_hash FROM users WHERE email = %s",
+                (email,)
+            )
+            user = cursor.fetchone()
         
         if not user:
             return jsonify({'error': 'Invalid credentials'}), 401
         
         # Verify password
-        if not bcrypt.checkpw(password.encode('utf-8'), user['password_hash'].encode('utf-8')):
+        if not password_hasher.check(password, user['password_hash']):
             return jsonify({'error': 'Invalid credentials'}), 401
         
         # Convert UUID to string for JSON serialization
         user_id = str(user['id'])
         
+        # Upgrade hashes made with an older BCRYPT_ROUNDS while we have the password
+        if BCRYPT_REHASH_ON_LOGIN and password_hasher.needs_rehash(user['password_hash']):
+            try:
+                new_hash = password_hasher.hash(password)
+                with get_db_connection() as conn, conn.cursor() as cursor:
+                    # Only replace the hash we checked (a concurrent password change wins)
+                    cursor.execute(
+                        "UPDATE users SET password_hash = %s WHERE id = %s AND password_hash = %s",
+                        (new_hash, user_id, user['password_hash'])
+                    )
+                    conn.commit()
+                auth_cache.invalidate_user(user_id)
+                password_hasher.note_rehash()
+            except Exception as e:
+                print(f"⚠️  Password rehash skipped for {email}: {e}")
+        
         # Generate JWT token
         token_payload = {
             'user_id': user_id,
@@ -159,6 +433,8 @@ def login():
             }
         }), 200
         
+    except HasherBusyError as e:
+        return jsonify({'error': 'Too many logins in progress, retry later', 'details': str(e)}), 503, {'Retry-After': '1'}
     except Exception as e:
         print(f"❌ Login error: {e}")
         return jsonify({'error': 'Login failed', 'details': str(e)}), 500
@@ -198,37 +474,32 @@ def register():
             return jsonify({'error': 'Password must be at least 6 characters'}), 400
         
         # Check if user exists
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT id FROM users WHERE email = %s", (email,))
-        existing_user = cursor.fetchone()
+        with get_db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute("SELECT id FROM users WHERE email = %s", (email,))
+            existing_user = cursor.fetchone()
         
         if existing_user:
-            cursor.close()
-            conn.close()
             return jsonify({'error': 'User already exists'}), 409
         
-        # Hash password
-        password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        # Hash password (outside the connection checkout - bcrypt is slow)
+        password_hash = password_hasher.hash(password)
         
         # Create user (UUID generated automatically by database)
-        cursor.execute(
-            """
-            INSERT INTO users (name, email, password_hash)
-            VALUES (%s, %s, %s)
-            RETURNING id, name, email
-            """,
-            (name, email, password_hash)
-        )
-        
-        new_user = cursor.fetchone()
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with get_db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO users (name, email, password_hash)
+                VALUES (%s, %s, %s)
+                RETURNING id, name, email
+                """,
+                (name, email, password_hash)
+            )
+            new_user = cursor.fetchone()
+            conn.commit()
         
         # Convert UUID to string for JSON serialization
         user_id = str(new_user['id'])
+        db_router.note_write(user_id)
         
         # Generate JWT token
         token_payload = {
@@ -252,41 +523,41 @@ def register():
             }
         }), 201
         
+    except HasherBusyError as e:
+        return jsonify({'error': 'Too many registrations in progress, retry later', 'details': str(e)}), 503, {'Retry-After': '1'}
     except Exception as e:
         print(f"❌ Registration error: {e}")
         return jsonify({'error': 'Registration failed', 'details': str(e)}), 500
 
 @app.route('/api/auth/verify', methods=['GET', 'OPTIONS'])
 @token_required
+@rate_limited('read')
 def verify_token(current_user_id):
     """Verify if token is valid"""
     if request.method == 'OPTIONS':
         return '', 204
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            "SELECT id, name, email FROM users WHERE id = %s",
-            (str(current_user_id),)
-        )
-        
-        user = cursor.fetchone()
-        cursor.close()
-        conn.close()
-        
-        if not user:
-            return jsonify({'error': 'User not found'}), 404
+        user = auth_cache.get_user(current_user_id)
+        (USER_HIT if user is not None else USER_MISS).inc()
+        if user is None:
+            with get_read_connection(current_user_id) as conn, conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT id, name, email FROM users WHERE id = %s",
+                    (str(current_user_id),)
+                )
+                row = cursor.fetchone()
+            
+            if not row:
+                return jsonify({'error': 'User not found'}), 404
+            
+            user = {'id': str(row['id']), 'name': row['name'], 'email': row['email']}
+            auth_cache.put_user(current_user_id, user)
         
         return jsonify({
             'success': True,
             'valid': True,
-            'user': {
-                'id': str(user['id']),
-                'name': user['name'],
-                'email': user['email']
-            }
+            'user': user
         }), 200
         
     except Exception as e:
@@ -299,24 +570,45 @@ def verify_token(current_user_id):
 def health_check():
     """Health check endpoint"""
     try:
-        conn = get_db_connection()
-        conn.close()
+        with get_db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
         return jsonify({
             'status': 'healthy',
             'database': 'connected',
+            'pool': db_pool.stats(),
+            'read_pool': read_pool.stats() if read_pool is not None else None,
+            'read_routing': db_router.stats(),
+            'queries': query_log.stats(),
+            'rate_limits': rate_limiter.stats() if rate_limiter is not None else None,
+            'auth_cache': auth_cache.stats(),
+            'password_hashing': password_hasher.stats(),
+            'write_behind': metrics_queue.stats() if metrics_queue is not None else None,
             'timestamp': datetime.utcnow().isoformat()
         }), 200
     except Exception as e:
         return jsonify({
             'status': 'unhealthy',
             'database': 'disconnected',
+            'pool': db_pool.stats(),
             'error': str(e)
         }), 500
 
+@app.route('/debug/queries', methods=['GET'])
+def debug_queries():
+    """Slow-query log of this worker: slowest statements, time per query shape and plans"""
+    if not debug_authorized(DEBUG_TOKEN):
+        return jsonify({'error': 'Not found'}), 404
+    try:
+        limit = min(max(int(request.args.get('limit', 20)), 1), 500)
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    return jsonify(dict(query_log.report(limit=limit), pid=os.getpid())), 200
+
 # ==================== METRICS ENDPOINTS ====================
 
 @app.route('/api/extension/metrics', methods=['POST', 'OPTIONS'])
 @token_required
+@rate_limited('ingest')
 def save_metrics(current_user_id):
     """
     Save LLM metrics from browser extension
@@ -328,88 +620,75 @@ def save_metrics(current_user_id):
         "input_tokens_after": 200,
         "output_tokens": 350,
         "timestamp": 1234567890,
-        "session_id": "session_xxx"
+        "session_id": "session_xxx",
+        "event_id": "optional client id; retries with the same id are saved once"
     }
     """
     if request.method == 'OPTIONS':
         return '', 204
     
     try:
-        data = request.get_json()
+        data = request.get_json(silent=True)
+        
+        if not data:
+            return jsonify({'error': 'No data provided'}), 400
         
         # Validate required fields
-        required_fields = ['site', 'model', 'input_tokens_after', 'output_tokens']
-        for field in required_fields:
-            if field not in data:
-                return jsonify({'error': f'Missing required field: {field}'}), 400
-        
-        # Extract metrics from payload
-        llm = data.get('site', 'Unknown')
-        model = data.get('model', 'Unknown')
-        input_raw = data.get('input_tokens_before', 0)
-        input_tokens = data.get('input_tokens_after', 0)
-        output_tokens = data.get('output_tokens', 0)
-        
-        # Optional fields with defaults
-        is_cached = data.get('is_cached', False)
-        cloud_provider = data.get('cloud_provider', 'unknown')
-        cloud_region = data.get('cloud_region', 'unknown')
+        try:
+            event = validate_event(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
         # Calculate environmental impact
-        energy_kwh = calculate_energy(input_tokens, output_tokens, model)
-        carbon_intensity = get_carbon_intensity(cloud_region)
-        co2_grams = calculate_co2(energy_kwh, carbon_intensity)
-        water_liters = calculate_water(input_tokens, output_tokens)
-        grid_zone = get_grid_zone(cloud_region)
+        with span('scoring'):
+            compute_impacts([event])
+        
+        # Write-behind mode: queue the event and return without waiting for a commit
+        if metrics_queue is not None:
+            ingest_id = str(data.get('event_id') or uuid.uuid4())
+            # Also makes replays of the crash-recovery spill file idempotent
+            event['event_key'] = event['event_key'] or f'id:{ingest_id}'
+            try:
+                metrics_queue.submit(ingest_id, current_user_id, event)
+            except QueueFullError as e:
+                return jsonify({'error': 'Ingestion queue is full, retry later', 'details': str(e)}), 429, {'Retry-After': '1'}
+            db_router.note_write(current_user_id)
+            
+            return jsonify({
+                'success': True,
+                'queued': True,
+                'id': ingest_id,
+                'message': 'Metrics accepted',
+                'environmental_impact': impact_summary(event),
+                'total_tokens': event['input_tokens'] + event['output_tokens']
+            }), 202
         
         # Insert into database (total_tokens is computed automatically)
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        insert_query = """
-            INSERT INTO llmprompts (
-                user_id, input_raw, input_tokens, output_tokens,
-                is_cached, model, llm, energy_kwh, co2_grams,
-                water_liters, cloud_provider, cloud_region,
-                grid_zone, carbon_intensity_g_per_kwh
-            ) VALUES (
-                %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
-            ) RETURNING id, total_tokens;
-        """
-        
-        cursor.execute(insert_query, (
-            str(current_user_id),
-            input_raw,
-            input_tokens,
-            output_tokens,
-            is_cached,
-            model,
-            llm,
-            energy_kwh,
-            co2_grams,
-            water_liters,
-            cloud_provider,
-            cloud_region,
-            grid_zone,
-            carbon_intensity
-        ))
-        
-        result = cursor.fetchone()
-        conn.commit()
-        cursor.close()
-        conn.close()
+        partition_keeper.check()
+        with get_db_connection() as conn, conn.cursor() as cursor:
+            result = insert_metrics(cursor, current_user_id, [event])[0]
+            conn.commit()
+        db_router.note_write(current_user_id)
+        
+        if result['duplicate']:
+            # A retry of an event that is already stored: nothing was written
+            return jsonify({
+                'success': True,
+                'duplicate': True,
+                'id': result['id'],
+                'message': 'Metrics already saved',
+                'environmental_impact': impact_summary(event),
+                'total_tokens': result['total_tokens']
+            }), 200
         
         print(f"✅ Metrics saved for user {current_user_id}")
         
         return jsonify({
             'success': True,
+            'duplicate': False,
             'id': result['id'],
             'message': 'Metrics saved successfully',
-            'environmental_impact': {
-                'energy_kwh': float(energy_kwh),
-                'co2_grams': float(co2_grams),
-                'water_liters': float(water_liters)
-            },
+            'environmental_impact': impact_summary(event),
             'total_tokens': result['total_tokens']
         }), 201
         
@@ -417,47 +696,132 @@ def save_metrics(current_user_id):
         print(f"❌ Error saving metrics: {e}")
         return jsonify({'error': 'Failed to save metrics', 'details': str(e)}), 500
 
-@app.route('/api/metrics/user', methods=['GET', 'OPTIONS'])
+@app.route('/api/extension/metrics/batch', methods=['POST', 'OPTIONS'])
 @token_required
-def get_user_metrics(current_user_id):
-    """Get all metrics for the current user"""
+@rate_limited('ingest')
+def save_metrics_batch(current_user_id):
+    """
+    Save many LLM metric events in one request and one transaction
+    Expected payload: a JSON array of events (same shape as /api/extension/metrics),
+    or {"events": [...]}. The body may be sent with "Content-Encoding: gzip".
+    Results are returned per item, in request order.
+    """
     if request.method == 'OPTIONS':
         return '', 204
     
     try:
-        # Optional query parameters
-        limit = request.args.get('limit', 100, type=int)
-        offset = request.args.get('offset', 0, type=int)
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        try:
+            items = decode_batch_payload(
+                request.get_data(cache=False),
+                request.headers.get('Content-Encoding'),
+                max_bytes=METRICS_BATCH_MAX_BYTES
+            )
+        except PayloadError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        if not items:
+            return jsonify({'error': 'No events provided'}), 400
+        
+        if len(items) > METRICS_BATCH_MAX_EVENTS:
+            return jsonify({'error': f'Maximum {METRICS_BATCH_MAX_EVENTS} events per batch'}), 413
+        BATCH_SIZE.labels('extension_metrics_batch').observe(len(items))
+        
+        # Charged per event, before any database work; the first was taken
+        # by @rate_limited before the body was decompressed
+        if len(items) > 1:
+            limited = rate_limit_response('ingest', current_user_id, cost=len(items) - 1)
+            if limited is not None:
+                return limited
+        
+        valid, errors = validate_events(items)
+        with span('scoring'):
+            events = compute_impacts([event for _, event in valid])
+        
+        inserted = []
+        if events:
+            partition_keeper.check()
+            with get_db_connection() as conn, conn.cursor() as cursor:
+                inserted = insert_metrics(cursor, current_user_id, events)
+                conn.commit()
+            db_router.note_write(current_user_id)
+        
+        results = [None] * len(items)
+        for (index, event), row in zip(valid, inserted):
+            results[index] = {
+                'index': index,
+                'success': True,
+                'id': row['id'],
+                'total_tokens': row['total_tokens'],
+                'duplicate': row['duplicate'],
+                'environmental_impact': impact_summary(event)
+            }
+        for index, message in errors:
+            results[index] = {'index': index, 'success': False, 'error': message}
         
-        query = """
-            SELECT 
-                id, input_raw, input_tokens, output_tokens, total_tokens,
-                is_cached, model, llm, energy_kwh, co2_grams, water_liters,
-                cloud_provider, cloud_region, captured_at
-            FROM llmprompts
-            WHERE user_id = %s
-            ORDER BY captured_at DESC
-            LIMIT %s OFFSET %s;
-        """
+        duplicates = sum(1 for row in inserted if row['duplicate'])
+        print(f"✅ Batch saved for user {current_user_id}: {len(inserted) - duplicates} saved, "
+              f"{duplicates} duplicates, {len(errors)} rejected")
         
-        cursor.execute(query, (str(current_user_id), limit, offset))
-        metrics = cursor.fetchall()
+        return jsonify({
+            'success': bool(inserted),
+            'total': len(items),
+            'saved': len(inserted) - duplicates,
+            'duplicates': duplicates,
+            'failed': len(errors),
+            'results': results
+        }), 201 if inserted else 400
         
-        # Get total count
-        cursor.execute("SELECT COUNT(*) as count FROM llmprompts WHERE user_id = %s", (str(current_user_id),))
-        total_count = cursor.fetchone()['count']
+    except Exception as e:
+        print(f"❌ Error saving metrics batch: {e}")
+        return jsonify({'error': 'Failed to save metrics batch', 'details': str(e)}), 500
+
+@app.route('/api/metrics/user', methods=['GET', 'OPTIONS'])
+@token_required
+@rate_limited('read')
+def get_user_metrics(current_user_id):
+    """
+    Get metrics for the current user, newest first
+    Query parameters:
+        limit  - page size (default 100)
+        cursor - opaque cursor from a previous page's next_cursor (preferred)
+        offset - legacy offset paging, ignored when cursor is given
+    """
+    if request.method == 'OPTIONS':
+        return '', 204
+    
+    try:
+        # Optional query parameters
+        limit = max(1, min(request.args.get('limit', 100, type=int), METRICS_PAGE_MAX))
+        offset = max(0, request.args.get('offset', 0, type=int))
+        cursor_token = request.args.get('cursor')
         
-        cursor.close()
-        conn.close()
+        after = None
+        if cursor_token:
+            try:
+                after = decode_cursor(cursor_token)
+            except InvalidCursorError as e:
+                return jsonify({'error': str(e)}), 400
+            offset = 0
+        
+        with get_read_connection(current_user_id) as conn, conn.cursor() as cursor:
+            metrics, next_cursor = fetch_history_page(cursor, current_user_id, limit, offset, after)
+            
+            # Totals from the rollup counters instead of a per-page COUNT(*);
+            # `aggregated` describes rows already compacted into hourly aggregates
+            total_count, lifetime_total, total_estimated, aggregated = count_history(cursor, current_user_id)
         
         return jsonify({
             'success': True,
             'total': total_count,
+            'lifetime_total': lifetime_total,
+            'total_estimated': total_estimated,
             'limit': limit,
             'offset': offset,
+            'next_cursor': next_cursor,
+            'has_more': next_cursor is not None,
+            'history_aggregated': aggregated is not None,
+            'aggregated_before': aggregated['before'].isoformat() if aggregated else None,
+            'aggregated_prompts': aggregated['prompts'] if aggregated else 0,
             'metrics': metrics
         }), 200
         
@@ -467,49 +831,25 @@ def get_user_metrics(current_user_id):
 
 @app.route('/api/metrics/summary', methods=['GET', 'OPTIONS'])
 @token_required
+@rate_limited('read')
 def get_metrics_summary(current_user_id):
-    """Get aggregated metrics summary for the current user"""
+    """Get aggregated metrics summary for the current user (served from rollups)"""
     if request.method == 'OPTIONS':
         return '', 204
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        query = """
-            SELECT 
-                COUNT(*) as total_prompts,
-                COALESCE(SUM(input_tokens), 0) as total_input_tokens,
-                COALESCE(SUM(output_tokens), 0) as total_output_tokens,
-                COALESCE(SUM(total_tokens), 0) as total_tokens,
-                COALESCE(SUM(energy_kwh), 0) as total_energy_kwh,
-                COALESCE(SUM(co2_grams), 0) as total_co2_grams,
-                COALESCE(SUM(water_liters), 0) as total_water_liters,
-                COALESCE(AVG(input_tokens), 0) as avg_input_tokens,
-                COALESCE(AVG(output_tokens), 0) as avg_output_tokens
-            FROM llmprompts
-            WHERE user_id = %s;
-        """
-        
-        cursor.execute(query, (str(current_user_id),))
-        summary = cursor.fetchone()
-        
-        # Get breakdown by LLM
-        cursor.execute("""
-            SELECT 
-                llm,
-                COUNT(*) as count,
-                SUM(total_tokens) as tokens
-            FROM llmprompts
-            WHERE user_id = %s
-            GROUP BY llm
-            ORDER BY count DESC;
-        """, (str(current_user_id),))
-        
-        llm_breakdown = cursor.fetchall()
-        
-        cursor.close()
-        conn.close()
+        with get_read_connection(current_user_id) as conn, conn.cursor() as cursor:
+            result = read_summary(cursor, current_user_id)
+        
+        if result is None:
+            # First summary for this user: seed the rollups from raw rows once (on the primary)
+            with get_db_connection() as conn, conn.cursor() as cursor:
+                rebuild_user_rollups(cursor, current_user_id)
+                conn.commit()
+                result = read_summary(cursor, current_user_id)
+            db_router.note_write(current_user_id)
+        
+        summary, llm_breakdown = result
         
         return jsonify({
             'success': True,
@@ -521,63 +861,91 @@ def get_metrics_summary(current_user_id):
         print(f"❌ Error fetching summary: {e}")
         return jsonify({'error': 'Failed to fetch summary', 'details': str(e)}), 500
 
-# ==================== HELPER FUNCTIONS ====================
-
-def calculate_energy(input_tokens: int, output_tokens: int, model: str) -> float:
+@app.route('/api/metrics/timeseries', methods=['GET', 'OPTIONS'])
+@token_required
+@rate_limited('read')
+def get_metrics_timeseries(current_user_id):
     """
-    Calculate energy consumption in kWh
-    Based on research: https://arxiv.org/abs/2311.16863
+    Get the current user's metrics bucketed over time
+    Query parameters:
+        bucket   - hour | day | week (default: day)
+        group_by - model | llm | region (optional)
+        from, to - ISO 8601 range (default: a window that suits the bucket size)
     """
-    energy_per_token = {
-        'GPT-4': 0.000001,
-        'GPT-3.5': 0.0000005,
-        'Claude': 0.0000008,
-        'ChatGPT': 0.0000007,
-        'Gemini': 0.0000006,
-        'Copilot': 0.0000007,
-        'default': 0.0000007
-    }
+    if request.method == 'OPTIONS':
+        return '', 204
     
-    rate = energy_per_token.get(model, energy_per_token['default'])
-    total_tokens = input_tokens + output_tokens
-    return round(total_tokens * rate, 8)
-
-def calculate_co2(energy_kwh: float, carbon_intensity: int = 475) -> float:
-    """
-    Calculate CO2 emissions in grams
-    """
-    return round(energy_kwh * carbon_intensity, 4)
-
-def calculate_water(input_tokens: int, output_tokens: int) -> float:
-    """
-    Calculate water consumption in liters
-    """
-    total_tokens = input_tokens + output_tokens
-    return round((total_tokens / 1000) * 0.5, 4)
+    try:
+        bucket = request.args.get('bucket', 'day')
+        group_by = request.args.get('group_by') or None
+        
+        if bucket not in BUCKET_SIZES:
+            return jsonify({'error': f"bucket must be one of: {', '.join(BUCKET_SIZES)}"}), 400
+        
+        try:
+            start, end = parse_range(bucket, request.args.get('from'), request.args.get('to'))
+        except ValueError as e:
+            return jsonify({'error': f'Invalid range: {e}'}), 400
+        
+        with get_read_connection(current_user_id) as conn, conn.cursor() as cursor:
+            try:
+                points = fetch_timeseries(cursor, current_user_id, bucket, group_by, start, end)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+        
+        return jsonify({
+            'success': True,
+            'bucket': bucket,
+            'group_by': group_by,
+            'from': start.isoformat(),
+            'to': end.isoformat(),
+            'points': points
+        }), 200
+        
+    except Exception as e:
+        print(f"❌ Error fetching timeseries: {e}")
+        return jsonify({'error': 'Failed to fetch timeseries', 'details': str(e)}), 500
 
-def get_carbon_intensity(region: str) -> int:
+@app.route('/api/metrics/export', methods=['GET', 'OPTIONS'])
+@token_required
+@rate_limited('read')
+def export_metrics(current_user_id):
     """
-    Get carbon intensity for a region (g CO2/kWh)
+    Stream the current user's full raw history, oldest first
+    Query parameters:
+        format - csv | ndjson (default: csv)
+    Gzipped when the client sends Accept-Encoding: gzip
     """
-    intensities = {
-        'us-east-1': 415,
-        'us-west-2': 250,
-        'eu-west-1': 300,
-        'ap-south-1': 700,
-        'unknown': 475
-    }
-    return intensities.get(region, intensities['unknown'])
-
-def get_grid_zone(region: str) -> str:
-    """Map cloud region to grid zone"""
-    zones = {
-        'us-east-1': 'US-EAST',
-        'us-west-2': 'US-WEST',
-        'eu-west-1': 'EU-WEST',
-        'ap-south-1': 'ASIA-PAC',
-        'unknown': 'GLOBAL'
-    }
-    return zones.get(region, zones['unknown'])
+    if request.method == 'OPTIONS':
+        return '', 204
+    
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': f"format must be one of: {', '.join(EXPORT_FORMATS)}"}), 400
+    
+    try:
+        chunks = encode_rows(iter_history(lambda: get_read_connection(current_user_id), current_user_id), fmt)
+        # Run the first query before committing to a 200 so failures still get a JSON error
+        first = next(chunks, '')
+        
+        def body():
+            yield first
+            yield from chunks
+        
+        stream = body()
+        headers = {
+            'Content-Disposition': f'attachment; filename="gaia-metrics.{fmt}"',
+            'Vary': 'Accept-Encoding',
+        }
+        if 'gzip' in request.headers.get('Accept-Encoding', ''):
+            stream = gzip_stream(stream)
+            headers['Content-Encoding'] = 'gzip'
+        
+        return Response(stream_with_context(stream), mimetype=EXPORT_FORMATS[fmt], headers=headers)
+        
+    except Exception as e:
+        print(f"❌ Error exporting metrics: {e}")
+        return jsonify({'error': 'Failed to export metrics', 'details': str(e)}), 500
 
 # ==================== ERROR HANDLERS ====================
 
@@ -593,4 +961,5 @@ if __name__ == '__main__':
     print("🚀 Starting GAIA Flask Backend on port 3001...")
     print("📍 Authentication endpoint: http://localhost:3001/api/auth/exbackend")
     print("📍 Metrics endpoint: http://localhost:3001/api/extension/metrics")
+    print("📍 Batch metrics endpoint: http://localhost:3001/api/extension/metrics/batch")
     app.run(host='0.0.0.0', port=3001, debug=True)
\ No newline at end of file
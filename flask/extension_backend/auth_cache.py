@@ -0,0 +1,88 @@
+"""
+In-process caches for the authentication hot path.
+
+Validated JWT claims are cached by a hash of the token (the raw token is
+never kept as a key) and expire no later than the token's own `exp`, so a
+cached entry can never accept an expired token. User records served by
+/api/auth/verify are cached per user id for a short TTL and must be
+invalidated explicitly by every path that writes to the user's row.
+"""
+
+import hashlib
+import threading
+import time
+
+from cachetools import TLRUCache, TTLCache
+
+
+def _token_key(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+class AuthCache:
+    """Bounded, thread-safe caches of token claims and user records"""
+
+    def __init__(self, max_tokens=10000, claims_ttl=300, max_users=10000, user_ttl=60):
+        self.claims_ttl = claims_ttl
+
+        def claims_expiry(key, claims, now):
+            # Wall-clock timer, so the token's `exp` (epoch seconds) caps the entry
+            expires = now + self.claims_ttl
+            exp = claims.get('exp')
+            return min(expires, exp) if isinstance(exp, (int, float)) else expires
+
+        self._claims = TLRUCache(maxsize=max_tokens, ttu=claims_expiry, timer=time.time)
+        self._users = TTLCache(maxsize=max_users, ttl=user_ttl)
+        # cachetools caches are not thread-safe
+        self._lock = threading.Lock()
+
+        self._claims_hits = 0
+        self._claims_misses = 0
+        self._user_hits = 0
+        self._user_misses = 0
+
+    # ---------------- token claims ----------------
+
+    def get_claims(self, token):
+        with self._lock:
+            claims = self._claims.get(_token_key(token))
+            if claims is None:
+                self._claims_misses += 1
+            else:
+                self._claims_hits += 1
+            return claims
+
+    def put_claims(self, token, claims):
+        with self._lock:
+            self._claims[_token_key(token)] = claims
+
+    # ---------------- user records ----------------
+
+    def get_user(self, user_id):
+        with self._lock:
+            user = self._users.get(str(user_id))
+            if user is None:
+                self._user_misses += 1
+            else:
+                self._user_hits += 1
+            return user
+
+    def put_user(self, user_id, user):
+        with self._lock:
+            self._users[str(user_id)] = user
+
+    def invalidate_user(self, user_id):
+        """Drop a cached user record; call after any change to the user's profile"""
+        with self._lock:
+            self._users.pop(str(user_id), None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'claims_size': len(self._claims),
+                'claims_hits': self._claims_hits,
+                'claims_misses': self._claims_misses,
+                'users_size': len(self._users),
+                'user_hits': self._user_hits,
+                'user_misses': self._user_misses,
+            }
@@ -0,0 +1,208 @@
+"""
+Compaction of old per-prompt rows into per-user, per-model, per-hour aggregates.
+
+    python compaction.py run [days]   # compact scored rows older than N days (default 90)
+    python compaction.py keys [days]  # forget idempotency keys older than N days (default 7)
+
+Each batch deletes up to `batch_size` of the oldest eligible rows from
+llmprompts and adds them to `llmprompt_compacted_hourly` in the same short
+transaction, so sums of tokens, energy, CO2 and water are preserved exactly
+(summaries and rollup rebuilds read both tables) and ingestion is never
+blocked for long. The same transaction adds the batch to each user's
+`compacted_prompts` / `compacted_before` in llmprompt_user_rollups, which the
+history endpoint reads instead of summing the aggregates. Rows that have not been scored yet are left alone: with a
+CO2 worker's `co2_calculated` column present that means rows it has not
+marked as calculated (including ones that ran out of retries), otherwise rows
+without an energy figure.
+"""
+
+from psycopg2.extras import execute_values
+
+MEASURE_COLUMNS = (
+    'prompt_count', 'input_tokens', 'output_tokens', 'total_tokens',
+    'energy_kwh', 'co2_grams', 'water_liters'
+)
+
+
+def _scored_condition(cursor):
+    """SQL condition matching rows whose impact figures are final"""
+    cursor.execute(
+        """
+        SELECT EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = current_schema()
+              AND table_name = 'llmprompts'
+              AND column_name = 'co2_calculated'
+        )
+        """
+    )
+    row = cursor.fetchone()
+    has_flag = row[0] if isinstance(row, tuple) else row['exists']
+    # The workers rescore every row, including ones with an inline estimate
+    return 'co2_calculated IS TRUE' if has_flag else 'energy_kwh IS NOT NULL'
+
+
+def compact_batch(conn, older_than_days, batch_size=5000):
+    """Compact one batch; returns the number of raw rows folded into aggregates"""
+    with conn.cursor() as cursor:
+        scored = _scored_condition(cursor)
+        cursor.execute(
+            f"""
+            WITH doomed AS (
+                SELECT id, captured_at
+                FROM llmprompts
+                WHERE captured_at < CURRENT_TIMESTAMP - make_interval(days => %(days)s)
+                  AND {scored}
+                ORDER BY captured_at, id
+                LIMIT %(limit)s
+                FOR UPDATE SKIP LOCKED
+            ),
+            deleted AS (
+                DELETE FROM llmprompts p
+                USING doomed d
+                WHERE p.id = d.id AND p.captured_at = d.captured_at
+                RETURNING p.user_id, p.captured_at, p.model, p.llm,
+                          p.input_tokens, p.output_tokens, p.total_tokens,
+                          p.energy_kwh, p.co2_grams, p.water_liters
+            ),
+            folded AS (
+                INSERT INTO llmprompt_compacted_hourly AS c (
+                    user_id, hour_start, model, llm, {', '.join(MEASURE_COLUMNS)}
+                )
+                SELECT user_id,
+                       date_trunc('hour', captured_at AT TIME ZONE 'UTC') AT TIME ZONE 'UTC',
+                       COALESCE(model, 'Unknown'), COALESCE(llm, 'Unknown'),
+                       COUNT(*),
+                       COALESCE(SUM(input_tokens), 0), COALESCE(SUM(output_tokens), 0),
+                       COALESCE(SUM(total_tokens), 0), SUM(energy_kwh),
+                       COALESCE(SUM(co2_grams), 0), COALESCE(SUM(water_liters), 0)
+                FROM deleted
+                GROUP BY 1, 2, 3, 4
+                ON CONFLICT (user_id, hour_start, model, llm) DO UPDATE SET
+                    {', '.join(f'{c} = c.{c} + EXCLUDED.{c}' for c in MEASURE_COLUMNS)}
+            )
+            SELECT user_id, COUNT(*) AS prompts,
+                   date_trunc('hour', MAX(captured_at) AT TIME ZONE 'UTC') AT TIME ZONE 'UTC'
+                       + INTERVAL '1 hour' AS compacted_before
+            FROM deleted
+            GROUP BY user_id
+            ORDER BY user_id
+            """,
+            {'days': older_than_days, 'limit': batch_size}
+        )
+        per_user = [tuple(row.values()) if isinstance(row, dict) else tuple(row) for row in cursor.fetchall()]
+        if per_user:
+            _count_compacted(cursor, per_user)
+    conn.commit()
+    return sum(row[1] for row in per_user)
+
+
+def _count_compacted(cursor, per_user):
+    """Add (user_id, prompts, compacted_before) rows to the users' rollup rows"""
+    # Lock in user order first, like ingestion, so concurrent batches cannot deadlock
+    cursor.execute(
+        "SELECT 1 FROM llmprompt_user_rollups WHERE user_id = ANY(%s::uuid[]) ORDER BY user_id FOR UPDATE",
+        ([str(row[0]) for row in per_user],)
+    )
+    # Users without a rollup row get one from rollups.rebuild_user_rollups,
+    # which also recounts their compacted history
+    execute_values(
+        cursor,
+        """
+        UPDATE llmprompt_user_rollups r SET
+            compacted_prompts = r.compacted_prompts + v.prompts,
+            compacted_before = GREATEST(r.compacted_before, v.compacted_before)
+        FROM (VALUES %s) AS v(user_id, prompts, compacted_before)
+        WHERE r.user_id = v.user_id
+        """,
+        [(str(user_id), prompts, before) for user_id, prompts, before in per_user],
+        template='(%s::uuid, %s::bigint, %s::timestamptz)',
+        page_size=len(per_user)
+    )
+
+
+def compact_history(conn, older_than_days=90, batch_size=5000, max_batches=None):
+    """Compact batches until nothing eligible is left; returns rows compacted"""
+    total = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        try:
+            compacted = compact_batch(conn, older_than_days, batch_size)
+        except Exception:
+            conn.rollback()
+            raise
+        total += compacted
+        batches += 1
+        if compacted < batch_size:
+            break
+    return total
+
+
+def prune_event_keys(conn, keep_days=7, batch_size=10000):
+    """
+    Delete idempotency keys older than `keep_days` (clients only retry for
+    minutes), in bounded batches. Returns the number of keys deleted.
+    """
+    total = 0
+    while True:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                DELETE FROM llmprompt_event_keys
+                WHERE ctid = ANY(ARRAY(
+                    SELECT ctid FROM llmprompt_event_keys
+                    WHERE created_at < CURRENT_TIMESTAMP - make_interval(days => %s)
+                    LIMIT %s
+                ))
+                """,
+                (keep_days, batch_size)
+            )
+            deleted = cursor.rowcount
+        conn.commit()
+        total += deleted
+        if deleted < batch_size:
+            return total
+
+
+def compaction_info(cursor, user_id):
+    """
+    Return {'prompts', 'before'} describing the user's compacted history,
+    or None if none of it has been compacted. Sums the aggregates; only for
+    users without a rollup row (history.count_history reads the counters).
+    """
+    cursor.execute(
+        """
+        SELECT SUM(prompt_count)::bigint AS prompts, MAX(hour_start) + INTERVAL '1 hour' AS compacted_before
+        FROM llmprompt_compacted_hourly
+        WHERE user_id = %s
+        """,
+        (str(user_id),)
+    )
+    row = cursor.fetchone()
+    if row is None or not row['prompts']:
+        return None
+    return {'prompts': row['prompts'], 'before': row['compacted_before']}
+
+
+if __name__ == '__main__':
+    import os
+    import sys
+    import psycopg2
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    if len(sys.argv) < 2 or sys.argv[1] not in ('run', 'keys'):
+        print(__doc__)
+        sys.exit(1)
+
+    connection = psycopg2.connect(os.getenv('DATABASE_URL'))
+    try:
+        if sys.argv[1] == 'keys':
+            days = int(sys.argv[2]) if len(sys.argv) > 2 else 7
+            print(f"✅ Deleted {prune_event_keys(connection, days)} idempotency keys older than {days} days")
+        else:
+            days = int(sys.argv[2]) if len(sys.argv) > 2 else int(os.getenv('COMPACT_AFTER_DAYS', 90))
+            count = compact_history(connection, days, int(os.getenv('COMPACT_BATCH_SIZE', 5000)))
+            print(f"✅ Compacted {count} prompts older than {days} days")
+    finally:
+        connection.close()
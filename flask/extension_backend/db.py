@@ -0,0 +1,429 @@
+"""
+Process-wide PostgreSQL connection pool for the extension backend.
+
+psycopg2's built-in ThreadedConnectionPool raises as soon as it is exhausted,
+so this pool blocks (up to a timeout) for a free connection instead, validates
+connections on checkout and keeps wait statistics.
+
+ReadRouter sends read-only work to an optional replica pool when it is
+reachable, not lagging, and the user has not written very recently.
+
+Connections hand out TracedCursor, so every statement of a traced request is
+a 'db_query' span, and a pool given a QueryLog (query_log.py) reports every
+statement's latency to it.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+from gaia_common.tracing import span
+
+# Statement text kept on a span
+SPAN_SQL_CHARS = 120
+
+
+def _sql_preview(query):
+    if isinstance(query, bytes):
+        query = query[:SPAN_SQL_CHARS * 2].decode('utf-8', 'replace')
+    elif not isinstance(query, str):
+        query = str(query)
+    return ' '.join(query.split())[:SPAN_SQL_CHARS]
+
+
+class TracedCursor(RealDictCursor):
+    """
+    RealDictCursor whose statements are timed as spans of the current trace
+    and, when `query_log` is set, recorded in the slow-query log
+    """
+
+    query_log = None
+
+    def _logged(self, run, args, query, vars=None, explainable=False):
+        query_log = self.query_log
+        if query_log is None:
+            return run(*args)
+        started = time.perf_counter()
+        try:
+            result = run(*args)
+        except Exception:
+            query_log.record(query, time.perf_counter() - started, error=True)
+            raise
+        # A named (server-side) cursor's execute only declares it
+        conn = self.connection if explainable and self.name is None else None
+        query_log.record(query, time.perf_counter() - started, conn=conn, vars=vars)
+        return result
+
+    def execute(self, query, vars=None):
+        with span('db_query', sql=_sql_preview(query)):
+            return self._logged(super().execute, (query, vars), query, vars, explainable=True)
+
+    def executemany(self, query, vars_list):
+        with span('db_query', sql=_sql_preview(query)):
+            return self._logged(super().executemany, (query, vars_list), query)
+
+    def copy_expert(self, sql, file, size=8192):
+        with span('db_query', sql=_sql_preview(sql)):
+            return self._logged(super().copy_expert, (sql, file, size), sql)
+
+
+class PoolTimeoutError(Exception):
+    """Raised when no connection becomes available within the checkout timeout"""
+
+
+class ConnectionPool:
+    """Thread-safe, bounded pool of psycopg2 connections"""
+
+    def __init__(self, dsn, minconn=1, maxconn=10, timeout=5.0,
+                 statement_timeout_ms=15000, health_check_after=30.0, query_log=None):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("Invalid pool size: require 0 <= minconn <= maxconn and maxconn >= 1")
+
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.statement_timeout_ms = statement_timeout_ms
+        # Idle connections older than this are pinged before being handed out
+        self.health_check_after = health_check_after
+        # Cursor class bound to this pool's slow-query log, if any
+        self.cursor_factory = TracedCursor
+        if query_log is not None:
+            self.cursor_factory = type('LoggedCursor', (TracedCursor,), {'query_log': query_log})
+
+        self._cond = threading.Condition()
+        self._idle = []          # [(conn, last_used_monotonic)]
+        self._opened = 0         # idle + in use
+        self._in_use = 0
+        self._waiting = 0
+        self._prefilled = False
+
+        self._checkouts = 0
+        self._timeouts = 0
+        self._discarded = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    # ---------------- connection lifecycle ----------------
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, cursor_factory=self.cursor_factory)
+        if self.statement_timeout_ms:
+            # SET (not a startup option) so this also works behind PgBouncer
+            with conn.cursor() as cursor:
+                cursor.execute("SET statement_timeout = %s", (int(self.statement_timeout_ms),))
+            conn.commit()
+        return conn
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.health_check_after:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _close_quietly(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _prefill(self):
+        """Open `minconn` connections on first use rather than at import time"""
+        with self._cond:
+            if self._prefilled:
+                return
+            self._prefilled = True
+            missing = max(0, self.minconn - self._opened)
+            self._opened += missing
+        for _ in range(missing):
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._opened -= 1
+                    self._cond.notify()
+                continue
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def getconn(self):
+        """Check a connection out of the pool, waiting up to `timeout` seconds"""
+        if not self._prefilled:
+            self._prefill()
+
+        started = time.monotonic()
+        deadline = started + self.timeout
+
+        while True:
+            conn = None
+            last_used = None
+            must_open = False
+
+            with self._cond:
+                while not self._idle and self._opened >= self.maxconn:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeoutError(
+                            f"No database connection available after {self.timeout}s "
+                            f"({self._in_use}/{self.maxconn} in use)"
+                        )
+                    self._waiting += 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+
+                if self._idle:
+                    # LIFO keeps the hottest connections in use and lets others age out
+                    conn, last_used = self._idle.pop()
+                else:
+                    self._opened += 1
+                    must_open = True
+                self._in_use += 1
+
+            if must_open:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    self._release_slot()
+                    raise
+            elif not self._is_healthy(conn, last_used):
+                self._close_quietly(conn)
+                self._release_slot()
+                with self._cond:
+                    self._discarded += 1
+                continue
+
+            waited = time.monotonic() - started
+            with self._cond:
+                self._checkouts += 1
+                self._total_wait += waited
+                self._max_wait = max(self._max_wait, waited)
+            return conn
+
+    def _release_slot(self):
+        """Drop a checked-out connection slot without returning it to the pool"""
+        with self._cond:
+            self._opened -= 1
+            self._in_use -= 1
+            self._cond.notify()
+
+    def putconn(self, conn, discard=False):
+        """Return a connection; broken or discarded connections are closed"""
+        if not discard and not conn.closed:
+            try:
+                # Never hand out a connection with an open or aborted transaction
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+
+        if discard or conn.closed:
+            self._close_quietly(conn)
+            with self._cond:
+                self._discarded += 1
+            self._release_slot()
+            return
+
+        with self._cond:
+            self._in_use -= 1
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager that always returns the connection to the pool.
+        The transaction is rolled back if the block raises.
+        """
+        with self.lease(self.getconn()) as conn:
+            yield conn
+
+    @contextmanager
+    def lease(self, conn):
+        """Context manager that returns an already checked-out connection"""
+        try:
+            yield conn
+        except BaseException as e:
+            # BaseException so a streaming response closed mid-way (GeneratorExit)
+            # still returns its connection. A dropped server connection is not
+            # worth keeping around.
+            discard = isinstance(e, psycopg2.OperationalError)
+            if not discard:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    discard = True
+            self.putconn(conn, discard=discard)
+            raise
+        else:
+            self.putconn(conn)
+
+    def closeall(self):
+        """Close all idle connections (checked-out ones close when returned)"""
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._opened -= len(idle)
+            self._prefilled = False
+        for conn, _ in idle:
+            self._close_quietly(conn)
+
+    # ---------------- introspection ----------------
+
+    def stats(self):
+        """Snapshot of pool usage for health/monitoring endpoints"""
+        with self._cond:
+            checkouts = self._checkouts
+            return {
+                'min_size': self.minconn,
+                'max_size': self.maxconn,
+                'open': self._opened,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'waiting': self._waiting,
+                'checkouts': checkouts,
+                'timeouts': self._timeouts,
+                'discarded': self._discarded,
+                'avg_wait_ms': round(self._total_wait / checkouts * 1000, 3) if checkouts else 0.0,
+                'max_wait_ms': round(self._max_wait * 1000, 3),
+            }
+
+
+
+class ReadRouter:
+    """
+    Picks the pool for read-only work: the replica when one is configured,
+    reachable and within `max_lag` seconds of the primary, otherwise the primary.
+    Users who wrote in the last `read_your_writes` seconds read from the primary
+    so they always see their own writes (tracked per process).
+    """
+
+    LAG_QUERY = """
+        SELECT CASE
+            WHEN NOT pg_is_in_recovery() THEN 0
+            -- Fully replayed: an idle primary is not lag
+            WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+        END AS lag_seconds
+    """
+
+    def __init__(self, primary, replica=None, max_lag=5.0, read_your_writes=10.0,
+                 lag_check_interval=1.0, retry_after=5.0):
+        self.primary = primary
+        self.replica = replica
+        self.max_lag = max_lag
+        self.read_your_writes = read_your_writes
+        self.lag_check_interval = lag_check_interval
+        # How long to stop trying a replica that failed to hand out a connection
+        self.retry_after = retry_after
+
+        self._lock = threading.Lock()
+        self._recent_writes = {}     # user_id -> monotonic time until which reads stay on primary
+        self._lag = None
+        self._lag_checked = 0.0
+        self._down_until = 0.0
+        self._routed = {'replica': 0, 'primary': 0}
+        self._fallbacks = {'recent_write': 0, 'lag': 0, 'unavailable': 0}
+
+    def note_write(self, user_id):
+        """Record that `user_id` just wrote, pinning their reads to the primary for a while"""
+        if self.replica is None or user_id is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._recent_writes[str(user_id)] = now + self.read_your_writes
+            if len(self._recent_writes) > 10000:
+                self._recent_writes = {u: t for u, t in self._recent_writes.items() if t > now}
+
+    def _wrote_recently(self, user_id):
+        with self._lock:
+            until = self._recent_writes.get(str(user_id))
+            return until is not None and until > time.monotonic()
+
+    def _replica_fresh(self, conn):
+        """Check replication lag on `conn`, at most once per lag_check_interval"""
+        now = time.monotonic()
+        with self._lock:
+            if self._lag is not None and now - self._lag_checked < self.lag_check_interval:
+                return self._lag <= self.max_lag
+        with conn.cursor() as cursor:
+            cursor.execute(self.LAG_QUERY)
+            row = cursor.fetchone()
+        lag = float(row['lag_seconds'] if isinstance(row, dict) else row[0])
+        with self._lock:
+            self._lag = lag
+            self._lag_checked = now
+        return lag <= self.max_lag
+
+    def _fallback(self, reason):
+        with self._lock:
+            self._fallbacks[reason] += 1
+
+    def _replica_conn(self, user_id):
+        """A replica connection that is safe to read from, or None to use the primary"""
+        if self.replica is None:
+            return None
+        if user_id is not None and self._wrote_recently(user_id):
+            self._fallback('recent_write')
+            return None
+        if time.monotonic() < self._down_until:
+            self._fallback('unavailable')
+            return None
+
+        try:
+            conn = self.replica.getconn()
+        except (PoolTimeoutError, psycopg2.OperationalError) as e:
+            print(f"⚠️  Read replica unavailable, using primary: {e}")
+            self._down_until = time.monotonic() + self.retry_after
+            self._fallback('unavailable')
+            return None
+
+        try:
+            fresh = self._replica_fresh(conn)
+        except psycopg2.Error:
+            self.replica.putconn(conn, discard=True)
+            self._down_until = time.monotonic() + self.retry_after
+            self._fallback('unavailable')
+            return None
+        if not fresh:
+            self.replica.putconn(conn)
+            self._fallback('lag')
+            return None
+        return conn
+
+    @contextmanager
+    def connection(self, user_id=None):
+        """Check out a connection for read-only work on behalf of `user_id`"""
+        conn = self._replica_conn(user_id)
+        if conn is not None:
+            with self._lock:
+                self._routed['replica'] += 1
+            with self.replica.lease(conn) as conn:
+                yield conn
+            return
+
+        with self._lock:
+            self._routed['primary'] += 1
+        with self.primary.connection() as conn:
+            yield conn
+
+    def stats(self):
+        with self._lock:
+            return {
+                'replica_configured': self.replica is not None,
+                'replica_lag_seconds': self._lag,
+                'routed': dict(self._routed),
+                'fallbacks': dict(self._fallbacks),
+            }
@@ -0,0 +1,101 @@
+"""
+Streaming export of a user's full metrics history (/api/metrics/export).
+
+Rows are read oldest first through a server-side (named) cursor, so only
+`itersize` rows are in memory at a time regardless of history size. The
+export is split into chunks of CHUNK_ROWS rows, each in its own short
+read-only transaction on a pooled connection, continuing from the last
+(captured_at, id) of the previous chunk; a slow download therefore never
+pins a snapshot or a pool slot for the whole export.
+"""
+
+import csv
+import io
+import json
+import uuid
+import zlib
+
+from history import HISTORY_COLUMNS
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+EXPORT_FIELDS = [column.strip() for column in HISTORY_COLUMNS.split(',')]
+
+# Rows per transaction, and rows per network round trip within it
+CHUNK_ROWS = 50000
+ITERSIZE = 2000
+
+
+def iter_history(connection, user_id, chunk_rows=CHUNK_ROWS, itersize=ITERSIZE):
+    """
+    Yield every llmprompts row of the user, oldest first.
+    `connection` is a context manager factory such as ConnectionPool.connection.
+    """
+    after = None
+    while True:
+        keyset = 'AND (captured_at, id) > (%s, %s)' if after else ''
+        params = [str(user_id)] + (list(after) if after else []) + [chunk_rows]
+        fetched = 0
+        with connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SET TRANSACTION READ ONLY")
+            with conn.cursor(name=f'export_{uuid.uuid4().hex}') as cursor:
+                cursor.itersize = itersize
+                cursor.execute(
+                    f"""
+                    SELECT {HISTORY_COLUMNS}
+                    FROM llmprompts
+                    WHERE user_id = %s {keyset}
+                    ORDER BY captured_at, id
+                    LIMIT %s
+                    """,
+                    params
+                )
+                for row in cursor:
+                    fetched += 1
+                    after = (row['captured_at'], row['id'])
+                    yield row
+            conn.rollback()
+        if fetched < chunk_rows:
+            return
+
+
+def _json_default(value):
+    # Decimal / datetime columns
+    return value.isoformat() if hasattr(value, 'isoformat') else float(value)
+
+
+def encode_rows(rows, fmt, rows_per_chunk=500):
+    """Serialize rows into text chunks of `rows_per_chunk` rows each"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS) if fmt == 'csv' else None
+    if writer:
+        writer.writeheader()
+
+    pending = 0
+    for row in rows:
+        if writer:
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(row, default=_json_default) + '\n')
+        pending += 1
+        if pending >= rows_per_chunk:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def gzip_stream(chunks, level=6):
+    """Gzip a stream of text chunks incrementally"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31 = gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,135 @@
+"""
+Paging through a user's raw metrics history.
+
+Pages are addressed with an opaque keyset cursor over (captured_at, id), which
+the (user_id, captured_at DESC, id DESC) index serves directly, so fetching a
+page costs O(page size) however deep into the history it is. The old
+limit/offset parameters are still supported for existing clients.
+
+Each page is first looked for in a bounded captured_at window below the
+cursor (or now), so a partitioned llmprompts only scans the newest monthly
+partitions. The window widens only when it holds less than a page.
+"""
+
+import base64
+import json
+from datetime import datetime, timedelta, timezone
+
+from compaction import compaction_info
+
+HISTORY_COLUMNS = """
+    id, input_raw, input_tokens, output_tokens, total_tokens,
+    is_cached, model, llm, energy_kwh, co2_grams, water_liters,
+    cloud_provider, cloud_region, captured_at
+"""
+
+# Above this many rows a missing rollup falls back to a capped (estimated) count
+COUNT_CAP = 10000
+
+# captured_at windows a page is looked for in, widest last (None: no lower bound)
+PAGE_WINDOWS = (timedelta(days=31), timedelta(days=366), None)
+
+
+class InvalidCursorError(ValueError):
+    """Raised for a malformed or tampered pagination cursor"""
+
+
+def encode_cursor(row):
+    """Opaque cursor pointing just after `row`"""
+    raw = json.dumps([row['captured_at'].isoformat(), row['id']]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """Return (captured_at, id) from a cursor produced by encode_cursor"""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        value = json.loads(raw)
+        if not isinstance(value, list) or len(value) != 2:
+            raise ValueError('expected [captured_at, id]')
+        captured_at, row_id = value
+        return datetime.fromisoformat(captured_at), int(row_id)
+    except (ValueError, TypeError) as e:
+        raise InvalidCursorError(f'Invalid cursor: {e}')
+
+
+def fetch_history_page(cursor, user_id, limit, offset=0, after=None, now=None):
+    """
+    Fetch one page, newest first.
+    Returns (rows, next_cursor); next_cursor is None on the last page.
+    """
+    newest = after[0] if after is not None else (now or datetime.now(timezone.utc))
+    for window in PAGE_WINDOWS:
+        params = [str(user_id)]
+        bounds = ''
+        if after is not None:
+            bounds += ' AND (captured_at, id) < (%s, %s)'
+            params.extend(after)
+        if window is not None:
+            # A plain parameter, so partitions below it are pruned at plan time
+            bounds += ' AND captured_at >= %s'
+            params.append(newest - window)
+
+        # One extra row tells us whether another page exists
+        params.append(limit + 1)
+        query = f"""
+            SELECT {HISTORY_COLUMNS}
+            FROM llmprompts
+            WHERE user_id = %s{bounds}
+            ORDER BY captured_at DESC, id DESC
+            LIMIT %s
+        """
+        if after is None and offset:
+            query += ' OFFSET %s'
+            params.append(offset)
+
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+        # Rows in a window are a prefix of the unbounded result, so a full
+        # page from it is the same page
+        if len(rows) > limit:
+            break
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1])
+    return rows, next_cursor
+
+
+def count_history(cursor, user_id):
+    """
+    Return (total, lifetime_total, is_estimate, compacted) without a full
+    COUNT(*) over the user's rows. `total` is what paging can reach (raw rows
+    only); `lifetime_total` also counts prompts that now only exist as hourly
+    aggregates, described by `compacted` ({'prompts', 'before'}, or None when
+    nothing was compacted). All of it comes from the user's rollup row when
+    present, otherwise from a count capped at COUNT_CAP.
+    """
+    cursor.execute(
+        """
+        SELECT total_prompts, compacted_prompts, compacted_before
+        FROM llmprompt_user_rollups
+        WHERE user_id = %s
+        """,
+        (str(user_id),)
+    )
+    row = cursor.fetchone()
+    if row is not None:
+        lifetime = row['total_prompts']
+        compacted = None
+        if row['compacted_prompts']:
+            compacted = {'prompts': row['compacted_prompts'], 'before': row['compacted_before']}
+        # Clamped, in case the counters were ever rebuilt out of step
+        return max(lifetime - row['compacted_prompts'], 0), lifetime, False, compacted
+
+    compacted = compaction_info(cursor, user_id)
+    prompts = compacted['prompts'] if compacted else 0
+    cursor.execute(
+        "SELECT COUNT(*) AS count FROM (SELECT 1 FROM llmprompts WHERE user_id = %s LIMIT %s) capped",
+        (str(user_id), COUNT_CAP + 1)
+    )
+    count = cursor.fetchone()['count']
+    if count > COUNT_CAP:
+        return COUNT_CAP, COUNT_CAP + prompts, True, compacted
+    return count, count + prompts, False, compacted
@@ -0,0 +1,397 @@
+"""
+Metrics ingestion helpers shared by the single-event and batch endpoints:
+payload validation, environmental impact calculation and bulk inserts.
+"""
+
+import hashlib
+import json
+import zlib
+
+from psycopg2.extras import execute_values
+
+from rollups import apply_rollups
+from timeseries import apply_buckets
+
+# Fields every extension event must carry
+REQUIRED_FIELDS = ('site', 'model', 'input_tokens_after', 'output_tokens')
+
+# Numeric fields that must be non-negative integers when present
+TOKEN_FIELDS = ('input_tokens_before', 'input_tokens_after', 'output_tokens')
+
+# Token counts are stored in INTEGER columns (and summed into total_tokens)
+MAX_TOKENS = 2 ** 31 - 1
+
+# Text fields and the length of the llmprompts column each is stored in
+STRING_FIELDS = (('site', 255), ('model', 255), ('cloud_provider', 20), ('cloud_region', 50))
+
+INSERT_COLUMNS = (
+    'user_id', 'input_raw', 'input_tokens', 'output_tokens',
+    'is_cached', 'model', 'llm', 'energy_kwh', 'co2_grams',
+    'water_liters', 'cloud_provider', 'cloud_region',
+    'grid_zone', 'carbon_intensity_g_per_kwh'
+)
+
+EVENT_ID_MAX_LENGTH = 128
+
+# Channel the CO2 worker (flask/co2_worker.py) listens on for new rows
+NOTIFY_CHANNEL = 'llmprompts_pending'
+
+
+class PayloadError(ValueError):
+    """Raised when a request body cannot be decoded into events"""
+
+
+# ==================== VALIDATION ====================
+
+def validate_event(data):
+    """
+    Validate one extension event and return it normalised.
+    Raises ValueError with a client-facing message.
+    """
+    if not isinstance(data, dict):
+        raise ValueError('Event must be a JSON object')
+
+    for field in REQUIRED_FIELDS:
+        if field not in data:
+            raise ValueError(f'Missing required field: {field}')
+
+    for field in TOKEN_FIELDS:
+        value = data.get(field, 0)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) \
+                or not 0 <= value <= MAX_TOKENS:
+            raise ValueError(f'{field} must be a non-negative number of at most {MAX_TOKENS}')
+    if int(data['input_tokens_after']) + int(data['output_tokens']) > MAX_TOKENS:
+        raise ValueError(f'input_tokens_after + output_tokens must be at most {MAX_TOKENS}')
+
+    for field, max_length in STRING_FIELDS:
+        value = data.get(field)
+        if value is None and field not in REQUIRED_FIELDS:
+            continue
+        if not isinstance(value, str) or len(value) > max_length:
+            raise ValueError(f'{field} must be a string of at most {max_length} characters')
+
+    return {
+        'llm': data['site'],
+        'model': data['model'],
+        'input_raw': int(data.get('input_tokens_before', 0)),
+        'input_tokens': int(data['input_tokens_after']),
+        'output_tokens': int(data['output_tokens']),
+        'is_cached': bool(data.get('is_cached', False)),
+        'cloud_provider': data.get('cloud_provider') or 'unknown',
+        'cloud_region': data.get('cloud_region') or 'unknown',
+        'event_key': derive_event_key(data),
+    }
+
+
+def derive_event_key(data):
+    """
+    Idempotency key for an event: the client's event_id if sent, otherwise a
+    hash of session_id + timestamp + token counts, or None when neither is
+    available (such events are never deduplicated).
+    """
+    event_id = data.get('event_id')
+    if event_id is not None:
+        if isinstance(event_id, bool) or not isinstance(event_id, (str, int)) \
+                or not str(event_id) or len(str(event_id)) > EVENT_ID_MAX_LENGTH:
+            raise ValueError(f'event_id must be a non-empty string of at most {EVENT_ID_MAX_LENGTH} characters')
+        return f'id:{event_id}'
+
+    if data.get('session_id') is None or data.get('timestamp') is None:
+        return None
+    raw = json.dumps([
+        str(data['session_id']), str(data['timestamp']),
+        data.get('input_tokens_before', 0), data.get('input_tokens_after', 0), data.get('output_tokens', 0)
+    ])
+    return 'h:' + hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def validate_events(items):
+    """
+    Validate a list of events.
+    Returns (valid, errors) where valid is [(index, event)] and errors is [(index, message)].
+    """
+    valid = []
+    errors = []
+    for index, item in enumerate(items):
+        try:
+            valid.append((index, validate_event(item)))
+        except ValueError as e:
+            errors.append((index, str(e)))
+    return valid, errors
+
+
+def decode_batch_payload(raw, content_encoding=None, max_bytes=10 * 1024 * 1024):
+    """
+    Decode a (optionally gzip-compressed) batch body into a list of events.
+    Accepts either a bare JSON array or {"events": [...]}.
+    """
+    if content_encoding and content_encoding.lower() == 'gzip':
+        # Bounded decompression so a tiny body cannot inflate without limit
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            raw = decompressor.decompress(raw, max_bytes)
+        except zlib.error as e:
+            raise PayloadError(f'Invalid gzip body: {e}')
+        if decompressor.unconsumed_tail:
+            raise PayloadError(f'Decompressed body exceeds {max_bytes} bytes')
+    elif len(raw) > max_bytes:
+        raise PayloadError(f'Body exceeds {max_bytes} bytes')
+
+    try:
+        payload = json.loads(raw)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise PayloadError(f'Invalid JSON: {e}')
+
+    if isinstance(payload, dict):
+        payload = payload.get('events')
+    if not isinstance(payload, list):
+        raise PayloadError("Body must be a JSON array of events or {\"events\": [...]}")
+    return payload
+
+
+# ==================== IMPACT CALCULATION ====================
+
+def compute_impacts(events):
+    """
+    Attach environmental impact fields to every event in place.
+    Model/region lookups are resolved once per distinct value for the batch.
+    """
+    intensity_by_region = {}
+    zone_by_region = {}
+
+    for event in events:
+        region = event['cloud_region']
+        if region not in intensity_by_region:
+            intensity_by_region[region] = get_carbon_intensity(region)
+            zone_by_region[region] = get_grid_zone(region)
+
+        energy_kwh = calculate_energy(event['input_tokens'], event['output_tokens'], event['model'])
+        event['carbon_intensity'] = intensity_by_region[region]
+        event['grid_zone'] = zone_by_region[region]
+        event['energy_kwh'] = energy_kwh
+        event['co2_grams'] = calculate_co2(energy_kwh, event['carbon_intensity'])
+        event['water_liters'] = calculate_water(event['input_tokens'], event['output_tokens'])
+
+    return events
+
+
+def impact_summary(event):
+    """Environmental impact block returned to the extension"""
+    return {
+        'energy_kwh': float(event['energy_kwh']),
+        'co2_grams': float(event['co2_grams']),
+        'water_liters': float(event['water_liters'])
+    }
+
+
+# ==================== PERSISTENCE ====================
+
+def claim_event_keys(cursor, user_id, keys, attempts=3):
+    """
+    Reserve a llmprompts id for every new idempotency key in one statement.
+    Keys already stored (retries) are left alone and report the id they got
+    the first time. Returns {key: (new_id, existing_id)}; exactly one is set.
+    """
+    rows = execute_values(
+        cursor,
+        """
+        WITH v(user_id, event_key) AS (VALUES %s),
+        claimed AS (
+            INSERT INTO llmprompt_event_keys (user_id, event_key, prompt_id)
+            SELECT user_id, event_key, nextval(pg_get_serial_sequence('llmprompts', 'id'))
+            FROM v
+            ORDER BY event_key
+            ON CONFLICT (user_id, event_key) DO NOTHING
+            RETURNING event_key, prompt_id
+        )
+        SELECT v.event_key, c.prompt_id AS new_id, k.prompt_id AS existing_id
+        FROM v
+        LEFT JOIN claimed c ON c.event_key = v.event_key
+        LEFT JOIN llmprompt_event_keys k
+            ON c.prompt_id IS NULL AND k.user_id = v.user_id AND k.event_key = v.event_key
+        """,
+        [(str(user_id), key) for key in keys],
+        template='(%s::uuid, %s)',
+        page_size=len(keys),
+        fetch=True
+    )
+    claims = {row['event_key']: (row['new_id'], row['existing_id']) for row in rows}
+
+    # A key committed by a concurrent request after this statement's snapshot
+    # conflicts but is not visible to the join. A new statement sees it (or
+    # claims the key if that request rolled back).
+    unresolved = [key for key, (new_id, existing_id) in claims.items() if new_id is None and existing_id is None]
+    if unresolved:
+        if attempts <= 1:
+            raise RuntimeError(f'Could not resolve {len(unresolved)} concurrently claimed event keys')
+        claims.update(claim_event_keys(cursor, user_id, unresolved, attempts - 1))
+    return claims
+
+
+def insert_metrics(cursor, user_id, events):
+    """
+    Insert scored events for one user with a single multi-row INSERT and add
+    the new ones to the user's rollups and hourly buckets. Events whose
+    `event_key` was already stored (client retries) are not inserted again.
+    Returns [{'id', 'total_tokens', 'duplicate'}] in the same order as `events`.
+    The caller owns the transaction (commit/rollback).
+    """
+    if not events:
+        return []
+
+    # Repeated keys inside the batch: the first occurrence wins
+    first_index = {}
+    for index, event in enumerate(events):
+        key = event.get('event_key')
+        if key is not None and key not in first_index:
+            first_index[key] = index
+    claims = claim_event_keys(cursor, user_id, list(first_index)) if first_index else {}
+
+    results = [None] * len(events)
+    fresh = []  # [(index, event, reserved_id or None)]
+    for index, event in enumerate(events):
+        key = event.get('event_key')
+        if key is None:
+            fresh.append((index, event, None))
+        elif first_index[key] == index and claims[key][0] is not None:
+            fresh.append((index, event, claims[key][0]))
+        elif first_index[key] == index:
+            results[index] = {
+                'id': claims[key][1],
+                'total_tokens': event['input_tokens'] + event['output_tokens'],
+                'duplicate': True
+            }
+
+    if fresh:
+        # Every row gets its id up front (keyed ones reserved it with their
+        # key), so returned rows are matched by id, not by position
+        unkeyed = sum(1 for _, _, reserved_id in fresh if reserved_id is None)
+        if unkeyed:
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence('llmprompts', 'id')) AS id FROM generate_series(1, %s)",
+                (unkeyed,)
+            )
+            new_ids = iter([row['id'] for row in cursor.fetchall()])
+            fresh = [
+                (index, event, reserved_id if reserved_id is not None else next(new_ids))
+                for index, event, reserved_id in fresh
+            ]
+
+        rows = [
+            (
+                reserved_id,
+                str(user_id),
+                event['input_raw'],
+                event['input_tokens'],
+                event['output_tokens'],
+                event['is_cached'],
+                event['model'],
+                event['llm'],
+                event['energy_kwh'],
+                event['co2_grams'],
+                event['water_liters'],
+                event['cloud_provider'],
+                event['cloud_region'],
+                event['grid_zone'],
+                event['carbon_intensity']
+            )
+            for _, event, reserved_id in fresh
+        ]
+
+        # total_tokens is a generated column
+        inserted = execute_values(
+            cursor,
+            f"INSERT INTO llmprompts (id, {', '.join(INSERT_COLUMNS)}) VALUES %s "
+            "RETURNING id, total_tokens",
+            rows,
+            page_size=len(rows),
+            fetch=True
+        )
+        total_tokens = {row['id']: row['total_tokens'] for row in inserted}
+        for index, _, prompt_id in fresh:
+            results[index] = {'id': prompt_id, 'total_tokens': total_tokens[prompt_id], 'duplicate': False}
+
+        new_events = [event for _, event, _ in fresh]
+        apply_rollups(cursor, user_id, new_events)
+        apply_buckets(cursor, user_id, new_events)
+        # Delivered on commit; identical notifications in one transaction collapse into one
+        cursor.execute("SELECT pg_notify(%s, '')", (NOTIFY_CHANNEL,))
+
+    # Later copies of a key within this batch point at the first one's row
+    for index, event in enumerate(events):
+        if results[index] is None:
+            first = results[first_index[event['event_key']]]
+            results[index] = {'id': first['id'], 'total_tokens': first['total_tokens'], 'duplicate': True}
+    return results
+
+
+def insert_queued_metrics(cursor, items):
+    """
+    Insert write-behind items [(ingest_id, user_id, event)] for many users.
+    One multi-row INSERT per user; the caller commits once for the whole batch.
+    """
+    by_user = {}
+    for _, user_id, event in items:
+        by_user.setdefault(user_id, []).append(event)
+    # Sorted so concurrent flushes lock users' rollup rows in the same order
+    for user_id in sorted(by_user):
+        insert_metrics(cursor, user_id, by_user[user_id])
+
+
+# ==================== IMPACT FORMULAS ====================
+
+def calculate_energy(input_tokens: int, output_tokens: int, model: str) -> float:
+    """
+    Calculate energy consumption in kWh
+    Based on research: https://arxiv.org/abs/2311.16863
+    """
+    energy_per_token = {
+        'GPT-4': 0.000001,
+        'GPT-3.5': 0.0000005,
+        'Claude': 0.0000008,
+        'ChatGPT': 0.0000007,
+        'Gemini': 0.0000006,
+        'Copilot': 0.0000007,
+        'default': 0.0000007
+    }
+    
+    rate = energy_per_token.get(model, energy_per_token['default'])
+    total_tokens = input_tokens + output_tokens
+    return round(total_tokens * rate, 8)
+
+def calculate_co2(energy_kwh: float, carbon_intensity: int = 475) -> float:
+    """
+    Calculate CO2 emissions in grams
+    """
+    return round(energy_kwh * carbon_intensity, 4)
+
+def calculate_water(input_tokens: int, output_tokens: int) -> float:
+    """
+    Calculate water consumption in liters
+    """
+    total_tokens = input_tokens + output_tokens
+    return round((total_tokens / 1000) * 0.5, 4)
+
+def get_carbon_intensity(region: str) -> int:
+    """
+    Get carbon intensity for a region (g CO2/kWh)
+    """
+    intensities = {
+        'us-east-1': 415,
+        'us-west-2': 250,
+        'eu-west-1': 300,
+        'ap-south-1': 700,
+        'unknown': 475
+    }
+    return intensities.get(region, intensities['unknown'])
+
+def get_grid_zone(region: str) -> str:
+    """Map cloud region to grid zone"""
+    zones = {
+        'us-east-1': 'US-EAST',
+        'us-west-2': 'US-WEST',
+        'eu-west-1': 'EU-WEST',
+        'ap-south-1': 'ASIA-PAC',
+        'unknown': 'GLOBAL'
+    }
+    return zones.get(region, zones['unknown'])
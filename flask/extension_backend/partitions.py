@@ -0,0 +1,358 @@
+"""
+Monthly range partitioning of llmprompts by captured_at.
+
+    python partitions.py migrate          # one-time: convert llmprompts to a partitioned table
+    python partitions.py ensure [months]  # create partitions for this month and the next N
+                                          # (the backend also does this itself while ingesting)
+    python partitions.py detach <months>  # detach partitions older than N months
+    python partitions.py drop <months>    # detach and drop them
+
+`migrate` renames the existing table to llmprompts_legacy and attaches it as
+the partition holding everything before the first monthly partition. The
+expensive parts (NOT NULL/CHECK validation, matching indexes) are prepared
+on the live table first, so the final swap only takes a brief lock. Month
+partitions are named llmprompts_yYYYYmMM.
+
+Rollups and time buckets are kept in their own tables, so detaching or
+dropping old partitions does not change summaries or charts.
+"""
+
+import re
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+
+PARENT_TABLE = 'llmprompts'
+LEGACY_TABLE = 'llmprompts_legacy'
+PARTITION_NAME = re.compile(r'^llmprompts_y(\d{4})m(\d{2})$')
+
+# Primary key of the partitioned table (must include the partition key)
+PARENT_PRIMARY_KEY = '(id, captured_at)'
+
+# Arbitrary constant so concurrent ensure_partitions() calls create each month once
+PARTITION_LOCK_ID = 727274002
+
+
+def month_start(value):
+    return date(value.year, value.month, 1)
+
+
+def add_months(value, months):
+    index = value.year * 12 + value.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f'{PARENT_TABLE}_y{month.year:04d}m{month.month:02d}'
+
+
+def is_partitioned(cursor, table=PARENT_TABLE):
+    cursor.execute(
+        "SELECT c.relkind = 'p' AS partitioned FROM pg_class c WHERE c.oid = to_regclass(%s)",
+        (table,)
+    )
+    row = cursor.fetchone()
+    if row is None:
+        return False
+    return row[0] if isinstance(row, tuple) else row['partitioned']
+
+
+def _fetch_values(cursor, query, params=()):
+    cursor.execute(query, params)
+    return [row[0] if isinstance(row, tuple) else next(iter(row.values())) for row in cursor.fetchall()]
+
+
+# ==================== CREATE AHEAD ====================
+
+def ensure_partitions(conn, months_ahead=3, today=None):
+    """
+    Create monthly partitions from the current month through `months_ahead`
+    months ahead. Months already covered (e.g. by the legacy partition) are
+    skipped. Returns the names of partitions created.
+    """
+    today = today or datetime.now(timezone.utc).date()
+    created = []
+    with conn.cursor() as cursor:
+        if not is_partitioned(cursor):
+            conn.commit()
+            return created
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", (PARTITION_LOCK_ID,))
+        for offset in range(months_ahead + 1):
+            start = add_months(month_start(today), offset)
+            end = add_months(start, 1)
+            name = partition_name(start)
+            cursor.execute("SELECT to_regclass(%s) IS NOT NULL AS present", (name,))
+            row = cursor.fetchone()
+            if row[0] if isinstance(row, tuple) else row['present']:
+                continue
+            cursor.execute("SAVEPOINT create_partition")
+            try:
+                cursor.execute(
+                    f"CREATE TABLE {name} PARTITION OF {PARENT_TABLE} "
+                    "FOR VALUES FROM (%s) TO (%s)",
+                    (start.isoformat(), end.isoformat())
+                )
+                cursor.execute("RELEASE SAVEPOINT create_partition")
+                created.append(name)
+            except Exception as e:
+                # Overlaps an existing partition (the legacy range): already covered
+                cursor.execute("ROLLBACK TO SAVEPOINT create_partition")
+                if 'overlap' not in str(e):
+                    raise
+    conn.commit()
+    return created
+
+
+class PartitionKeeper:
+    """
+    Creates upcoming monthly partitions from the ingest path, so inserts never
+    depend on `partitions.py ensure` being scheduled. `check()` is called
+    before each insert; it does nothing but compare a clock unless
+    `interval` seconds have passed since the last check in this process.
+    """
+
+    def __init__(self, connection, months_ahead=3, interval=3600.0):
+        self.connection = connection      # () -> context manager yielding a connection
+        self.months_ahead = months_ahead
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next_check = 0.0
+        self._checks = 0
+        self._failures = 0
+        self._created = 0
+
+    def check(self):
+        now = time.monotonic()
+        if now < self._next_check or not self._lock.acquire(blocking=False):
+            return
+        try:
+            if now < self._next_check:
+                return
+            self._next_check = now + self.interval
+            with self.connection() as conn:
+                created = ensure_partitions(conn, self.months_ahead)
+            self._checks += 1
+            self._created += len(created)
+            if created:
+                print(f"✅ Created partitions ahead of ingestion: {created}")
+        except Exception as e:
+            # Try again soon rather than after a full interval
+            self._failures += 1
+            self._next_check = now + min(self.interval, 60.0)
+            print(f"⚠️  Partition check failed: {e}")
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        return {
+            'checks': self._checks,
+            'failures': self._failures,
+            'created': self._created,
+        }
+
+
+# ==================== RETENTION ====================
+
+def list_partitions(cursor):
+    """Names of every partition attached to llmprompts (monthly and legacy)"""
+    return _fetch_values(
+        cursor,
+        """
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s)
+        ORDER BY c.relname
+        """,
+        (PARENT_TABLE,)
+    )
+
+
+def list_month_partitions(conn):
+    """Return [(name, month_start)] of attached monthly partitions, oldest first"""
+    with conn.cursor() as cursor:
+        names = list_partitions(cursor)
+    conn.commit()
+    partitions = []
+    for name in names:
+        match = PARTITION_NAME.match(name)
+        if match:
+            partitions.append((name, date(int(match.group(1)), int(match.group(2)), 1)))
+    return sorted(partitions, key=lambda p: p[1])
+
+
+def detach_old_partitions(conn, keep_months, drop=False, today=None):
+    """
+    Detach (and optionally drop) monthly partitions that end before the start
+    of the month `keep_months` months ago. Uses DETACH ... CONCURRENTLY so
+    inserts and reads are not blocked. Returns the affected partition names.
+    """
+    today = today or datetime.now(timezone.utc).date()
+    cutoff = add_months(month_start(today), -keep_months)
+    old = [name for name, month in list_month_partitions(conn) if add_months(month, 1) <= cutoff]
+
+    autocommit = conn.autocommit
+    conn.autocommit = True  # DETACH CONCURRENTLY cannot run inside a transaction
+    try:
+        with conn.cursor() as cursor:
+            for name in old:
+                cursor.execute(f"ALTER TABLE {PARENT_TABLE} DETACH PARTITION {name} CONCURRENTLY")
+                if drop:
+                    cursor.execute(f"DROP TABLE {name}")
+    finally:
+        conn.autocommit = autocommit
+    return old
+
+
+# ==================== ONE-TIME MIGRATION ====================
+
+def migrate_to_partitioned(conn, months_ahead=3, now=None):
+    """
+    Convert an unpartitioned llmprompts into a monthly partitioned table.
+    Returns False if it is already partitioned.
+    """
+    now = now or datetime.now(timezone.utc)
+    # First monthly partition; leave a margin so no insert can land past the
+    # legacy range between validation and the swap
+    first_month = add_months(month_start(now.date()), 1)
+    if datetime(first_month.year, first_month.month, 1, tzinfo=timezone.utc) - now < timedelta(days=2):
+        first_month = add_months(first_month, 1)
+
+    with conn.cursor() as cursor:
+        if is_partitioned(cursor):
+            conn.commit()
+            return False
+    conn.commit()
+
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            # 1. Partition key must be NOT NULL; validate CHECKs without blocking writes
+            cursor.execute(f"UPDATE {PARENT_TABLE} SET captured_at = CURRENT_TIMESTAMP WHERE captured_at IS NULL")
+            cursor.execute(
+                f"ALTER TABLE {PARENT_TABLE} ADD CONSTRAINT llmprompts_legacy_range "
+                "CHECK (captured_at IS NOT NULL AND captured_at < %s) NOT VALID",
+                (first_month.isoformat(),)
+            )
+            cursor.execute(f"ALTER TABLE {PARENT_TABLE} VALIDATE CONSTRAINT llmprompts_legacy_range")
+
+            # 2. Build the partition-level primary key index up front
+            cursor.execute(
+                f"CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS llmprompts_legacy_id_captured "
+                f"ON {PARENT_TABLE} {PARENT_PRIMARY_KEY}"
+            )
+
+            index_defs = _fetch_values(
+                cursor,
+                """
+                SELECT pg_get_indexdef(i.indexrelid)
+                FROM pg_index i
+                WHERE i.indrelid = to_regclass(%s)
+                  AND NOT i.indisunique
+                """,
+                (PARENT_TABLE,)
+            )
+            index_names = _fetch_values(
+                cursor,
+                """
+                SELECT c.relname
+                FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+                WHERE i.indrelid = to_regclass(%s)
+                  AND NOT i.indisunique
+                """,
+                (PARENT_TABLE,)
+            )
+    finally:
+        conn.autocommit = autocommit
+
+    # 3. Swap in a single short transaction
+    with conn.cursor() as cursor:
+        cursor.execute(f"LOCK TABLE {PARENT_TABLE} IN ACCESS EXCLUSIVE MODE")
+        cursor.execute(f"ALTER TABLE {PARENT_TABLE} RENAME TO {LEGACY_TABLE}")
+        cursor.execute(f"ALTER TABLE {LEGACY_TABLE} ALTER COLUMN captured_at SET NOT NULL")
+        for name in index_names:
+            cursor.execute(f"ALTER INDEX {name} RENAME TO {(name + '_legacy')[:63]}")
+
+        # Partitions need a primary key that includes the partition key
+        primary_keys = _fetch_values(
+            cursor,
+            "SELECT conname FROM pg_constraint WHERE conrelid = to_regclass(%s) AND contype = 'p'",
+            (LEGACY_TABLE,)
+        )
+        for name in primary_keys:
+            cursor.execute(f"ALTER TABLE {LEGACY_TABLE} DROP CONSTRAINT {name}")
+        cursor.execute(
+            f"ALTER TABLE {LEGACY_TABLE} ADD CONSTRAINT llmprompts_legacy_pkey "
+            "PRIMARY KEY USING INDEX llmprompts_legacy_id_captured"
+        )
+
+        cursor.execute(
+            f"""
+            CREATE TABLE {PARENT_TABLE} (
+                LIKE {LEGACY_TABLE} INCLUDING DEFAULTS INCLUDING GENERATED INCLUDING STORAGE
+            ) PARTITION BY RANGE (captured_at)
+            """
+        )
+        cursor.execute(f"ALTER TABLE {PARENT_TABLE} ADD PRIMARY KEY {PARENT_PRIMARY_KEY}")
+        cursor.execute(
+            f"ALTER TABLE {PARENT_TABLE} ADD CONSTRAINT fk_user "
+            "FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE"
+        )
+        cursor.execute(
+            f"""
+            SELECT pg_get_serial_sequence('{LEGACY_TABLE}', 'id') AS seq
+            """
+        )
+        row = cursor.fetchone()
+        sequence = row[0] if isinstance(row, tuple) else row['seq']
+        if sequence:
+            cursor.execute(f"ALTER SEQUENCE {sequence} OWNED BY {PARENT_TABLE}.id")
+
+        # Same secondary indexes on the parent (definitions were captured under the
+        # old table name, which is now the parent); legacy ones are attached, not rebuilt
+        for definition in index_defs:
+            cursor.execute(definition)
+
+        cursor.execute(
+            f"ALTER TABLE {PARENT_TABLE} ATTACH PARTITION {LEGACY_TABLE} "
+            "FOR VALUES FROM (MINVALUE) TO (%s)",
+            (first_month.isoformat(),)
+        )
+    conn.commit()
+
+    ensure_partitions(conn, months_ahead, today=first_month)
+    return True
+
+
+if __name__ == '__main__':
+    import os
+    import sys
+    import psycopg2
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    commands = ('migrate', 'ensure', 'detach', 'drop')
+    if len(sys.argv) < 2 or sys.argv[1] not in commands:
+        print(__doc__)
+        sys.exit(1)
+
+    connection = psycopg2.connect(os.getenv('DATABASE_URL'))
+    try:
+        command = sys.argv[1]
+        if command == 'migrate':
+            if migrate_to_partitioned(connection):
+                print("✅ llmprompts is now partitioned by month")
+            else:
+                print("ℹ️  llmprompts is already partitioned")
+        elif command == 'ensure':
+            months = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+            print(f"✅ Created partitions: {ensure_partitions(connection, months) or 'none needed'}")
+        else:
+            if len(sys.argv) < 3:
+                print(f"Usage: python partitions.py {command} <keep_months>")
+                sys.exit(1)
+            affected = detach_old_partitions(connection, int(sys.argv[2]), drop=command == 'drop')
+            print(f"✅ {'Dropped' if command == 'drop' else 'Detached'}: {affected or 'nothing to do'}")
+    finally:
+        connection.close()
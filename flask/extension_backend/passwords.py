@@ -0,0 +1,137 @@
+"""
+Password hashing off the request threads.
+
+bcrypt is deliberately slow (hundreds of ms per call at cost 12) and holds a
+CPU for the whole time, so hashes and checks run in a small dedicated
+process pool. A semaphore caps how many calls may be queued or running at
+once; a request that cannot get a slot within `queue_timeout` seconds gets
+HasherBusyError (-> 503) instead of tying up a web worker, so a login burst
+can only ever consume a fixed share of capacity.
+"""
+
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt
+
+
+class HasherBusyError(Exception):
+    """No hashing slot became free within the queue timeout"""
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _check(password, password_hash):
+    return bcrypt.checkpw(password, password_hash)
+
+
+def hash_cost(password_hash):
+    """Cost factor of a '$2b$12$...' hash, or None if it can't be read"""
+    try:
+        return int(password_hash.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+class PasswordHasher:
+    """Bounded bcrypt worker pool with queue-depth counters"""
+
+    def __init__(self, workers=2, max_pending=8, queue_timeout=2.0, rounds=12):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.queue_timeout = queue_timeout
+        self.rounds = rounds
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        # Created on first use, so it is started in the serving (post-fork) process
+        self._executor = None
+
+        self._waiting = 0
+        self._in_flight = 0
+        self._completed = 0
+        self._rejected = 0
+        self._rehashed = 0
+        self._busy_seconds = 0.0
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def _reset_executor(self, broken):
+        with self._lock:
+            if self._executor is broken:
+                self._executor = None
+        broken.shutdown(wait=False)
+
+    def _run(self, fn, *args):
+        with self._lock:
+            self._waiting += 1
+        acquired = self._slots.acquire(timeout=self.queue_timeout)
+        with self._lock:
+            self._waiting -= 1
+            if not acquired:
+                self._rejected += 1
+            else:
+                self._in_flight += 1
+        if not acquired:
+            raise HasherBusyError("Password hashing queue is full")
+
+        started = time.monotonic()
+        try:
+            executor = self._get_executor()
+            try:
+                return executor.submit(fn, *args).result()
+            except BrokenProcessPool:
+                # A worker died (e.g. OOM-killed); start a fresh pool and retry once
+                print("⚠️  Password hashing pool broke, restarting it")
+                self._reset_executor(executor)
+                return self._get_executor().submit(fn, *args).result()
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                self._completed += 1
+                self._busy_seconds += time.monotonic() - started
+            self._slots.release()
+
+    def hash(self, password):
+        """bcrypt hash of `password` (str) at the configured cost"""
+        return self._run(_hash, password.encode('utf-8'), self.rounds)
+
+    def check(self, password, password_hash):
+        """True if `password` matches the stored bcrypt hash"""
+        return self._run(_check, password.encode('utf-8'), password_hash.encode('utf-8'))
+
+    def needs_rehash(self, password_hash):
+        """True if the stored hash was made with a different cost than configured"""
+        return hash_cost(password_hash) != self.rounds
+
+    def note_rehash(self):
+        with self._lock:
+            self._rehashed += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'max_pending': self.max_pending,
+                'rounds': self.rounds,
+                'started': self._executor is not None,
+                'waiting': self._waiting,
+                'in_flight': self._in_flight,
+                'completed': self._completed,
+                'rejected': self._rejected,
+                'rehashed': self._rehashed,
+                'busy_seconds': round(self._busy_seconds, 3),
+            }
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,287 @@
+"""
+Slow-query log for the extension backend's SQL.
+
+TracedCursor (db.py) reports every statement it runs to a QueryLog, which
+keeps:
+
+- latency per normalized query shape: literals and placeholders become `?`
+  and repeated VALUES rows / IN lists collapse, so every execute_values page
+  of an insert is one shape;
+- the `top` slowest individual statements, with their request ID;
+- for read-only statements slower than `slow_ms`, the output of
+  EXPLAIN (ANALYZE, BUFFERS). The plan is captured right after the statement,
+  on the same connection, so it sees the same data and settings.
+
+ANALYZE runs the statement a second time, so plans are rate-limited: at most
+one per shape every `explain_interval` seconds, at least `explain_gap`
+seconds apart and one at a time per process. Only SELECTs (and WITH queries
+without data-modifying parts) are explained. They run inside a savepoint that
+is rolled back, so the caller's transaction is left as it was. Statements on
+autocommit connections are never explained. Bound parameters are never
+stored, only shapes.
+
+Everything is per process.
+"""
+
+import functools
+import heapq
+import itertools
+import re
+import threading
+import time
+from collections import deque
+
+import psycopg2
+import psycopg2.extensions
+
+from gaia_common.tracing import current_request_id, span
+
+# Longest shape kept (longer ones are cut, which may merge them)
+MAX_SHAPE_CHARS = 2000
+# Plan text kept per capture
+MAX_PLAN_CHARS = 20000
+# Distinct shapes tracked; later ones are counted under OTHER_SHAPE
+MAX_SHAPES = 500
+OTHER_SHAPE = '<other>'
+# Plans kept per shape, newest last
+PLANS_PER_SHAPE = 3
+
+_COMMENTS = re.compile(r'--[^\n]*|/\*.*?\*/', re.S)
+_STRINGS = re.compile(r"[Ee]'(?:[^'\\]|\\.|'')*'|'(?:[^']|'')*'", re.S)
+_NUMBERS = re.compile(r'(?<![\w$.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b')
+_PLACEHOLDERS = re.compile(r'%(?:\([^)]*\))?s')
+_REPEATED_VALUES = re.compile(r'\?(?:\s*,\s*\?)+')
+_REPEATED_ROWS = re.compile(r'(\([^()]*\))(?:\s*,\s*\1)+')
+_WHITESPACE = re.compile(r'\s+')
+
+_READ_ONLY_START = re.compile(r'^\s*(SELECT|WITH)\b', re.I)
+# Things an EXPLAIN ANALYZE must not run again even inside a rolled-back
+# savepoint (sequences and advisory locks are not transactional; row locks are
+# not worth taking twice)
+_SIDE_EFFECTS = re.compile(
+    r'\b(INSERT|UPDATE|DELETE|MERGE|TRUNCATE|NEXTVAL|SETVAL|PG_(TRY_)?ADVISORY_\w+|SHARE)\b',
+    re.I
+)
+
+
+def _sql_text(query):
+    if isinstance(query, bytes):
+        return query.decode('utf-8', 'replace')
+    return query if isinstance(query, str) else str(query)
+
+
+def _normalize(text):
+    text = _COMMENTS.sub(' ', text)
+    text = _STRINGS.sub('?', text)
+    text = _PLACEHOLDERS.sub('?', text)
+    text = _NUMBERS.sub('?', text)
+    text = _WHITESPACE.sub(' ', text).strip()
+    text = _REPEATED_VALUES.sub('?, ...', text)
+    text = _REPEATED_ROWS.sub(r'\1, ...', text)
+    return text[:MAX_SHAPE_CHARS]
+
+
+# Parameterized statements reuse a handful of templates; mogrified batches
+# (bytes from execute_values) are all different, so only strings are cached
+_normalize_template = functools.lru_cache(maxsize=1024)(_normalize)
+
+
+def normalize_query(query):
+    """The shape of a statement: literals replaced, whitespace and lists collapsed"""
+    if isinstance(query, str):
+        return _normalize_template(query)
+    return _normalize(_sql_text(query))
+
+
+def is_explainable(shape):
+    """Whether re-running the statement under EXPLAIN ANALYZE is harmless"""
+    return bool(_READ_ONLY_START.match(shape)) and not _SIDE_EFFECTS.search(shape)
+
+
+class _ShapeStats:
+    __slots__ = ('calls', 'errors', 'slow', 'total', 'max', 'last_at', 'plans', 'next_plan_at')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.slow = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last_at = None
+        self.plans = deque(maxlen=PLANS_PER_SHAPE)
+        self.next_plan_at = 0.0
+
+
+class QueryLog:
+    """Per-shape statement latency, slowest statements and captured plans"""
+
+    def __init__(self, slow_ms=250.0, top=50, explain=True, explain_interval=300.0, explain_gap=10.0):
+        self.slow_ms = slow_ms
+        self.top = top
+        self.explain = explain
+        self.explain_interval = explain_interval
+        self.explain_gap = explain_gap
+
+        self._lock = threading.Lock()
+        self._shapes = {}
+        self._slowest = []                  # min-heap of (seconds, seq, entry)
+        self._seq = itertools.count()
+        self._next_plan_at = 0.0
+        self._explaining = threading.Lock()
+
+        self._statements = 0
+        self._errors = 0
+        self._slow = 0
+        self._plans_captured = 0
+        self._plans_failed = 0
+
+    # ---------------- recording ----------------
+
+    def record(self, query, seconds, error=False, conn=None, vars=None):
+        """
+        Account one statement. `conn` (with the statement's `vars`) is given
+        for statements that may be explained on it.
+        """
+        shape = normalize_query(query)
+        slow = seconds * 1000 >= self.slow_ms
+        now = time.time()
+
+        with self._lock:
+            stats = self._shapes.get(shape)
+            if stats is None:
+                if len(self._shapes) >= MAX_SHAPES:
+                    shape = OTHER_SHAPE
+                    stats = self._shapes.get(shape)
+                if stats is None:
+                    stats = self._shapes[shape] = _ShapeStats()
+            stats.calls += 1
+            stats.total += seconds
+            stats.max = max(stats.max, seconds)
+            stats.last_at = now
+            self._statements += 1
+            if error:
+                stats.errors += 1
+                self._errors += 1
+            if not slow:
+                return
+            stats.slow += 1
+            self._slow += 1
+
+            entry = {
+                'shape': shape,
+                'ms': round(seconds * 1000, 3),
+                'at': now,
+                'request_id': current_request_id(),
+                'error': error,
+            }
+            item = (seconds, next(self._seq), entry)
+            if len(self._slowest) < self.top:
+                heapq.heappush(self._slowest, item)
+            elif seconds > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, item)
+
+            want_plan = (
+                self.explain and conn is not None and not error
+                and shape != OTHER_SHAPE
+                and now >= stats.next_plan_at and now >= self._next_plan_at
+                and is_explainable(shape)
+            )
+            if want_plan:
+                # Reserve the slot now so concurrent slow statements don't all explain
+                stats.next_plan_at = now + self.explain_interval
+                self._next_plan_at = now + self.explain_gap
+
+        print(f"🐢 Slow query ({entry['ms']:.0f} ms{', failed' if error else ''}) "
+              f"[{entry['request_id'] or '-'}]: {shape[:300]}")
+        if want_plan:
+            self._capture_plan(conn, query, vars, stats, entry)
+
+    def _capture_plan(self, conn, query, vars, stats, entry):
+        if conn.autocommit or conn.closed:
+            return
+        if conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+            return
+        if not self._explaining.acquire(blocking=False):
+            return
+        try:
+            prefix = 'EXPLAIN (ANALYZE, BUFFERS) '
+            if isinstance(query, bytes):
+                explain = prefix.encode() + query
+            else:
+                explain = prefix + _sql_text(query)
+            plan = None
+            error = None
+            # A plain cursor: the plan's rows are single-column tuples, and the
+            # EXPLAIN itself is not logged as a statement
+            with span('explain'), conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cursor:
+                cursor.execute('SAVEPOINT gaia_explain')
+                try:
+                    cursor.execute(explain, vars)
+                    plan = '\n'.join(row[0] for row in cursor.fetchall())
+                except psycopg2.Error as e:
+                    error = str(e).strip()
+                finally:
+                    cursor.execute('ROLLBACK TO SAVEPOINT gaia_explain')
+                    cursor.execute('RELEASE SAVEPOINT gaia_explain')
+        except psycopg2.Error as e:
+            plan, error = None, str(e).strip()
+        finally:
+            self._explaining.release()
+
+        with self._lock:
+            if error is None:
+                stats.plans.append({
+                    'captured_at': time.time(),
+                    'statement_ms': entry['ms'],
+                    'request_id': entry['request_id'],
+                    'plan': plan[:MAX_PLAN_CHARS],
+                })
+                self._plans_captured += 1
+            else:
+                self._plans_failed += 1
+        if error is not None:
+            print(f"⚠️  Could not capture plan for slow query: {error}")
+
+    # ---------------- introspection ----------------
+
+    def stats(self):
+        with self._lock:
+            return {
+                'statements': self._statements,
+                'errors': self._errors,
+                'slow': self._slow,
+                'shapes': len(self._shapes),
+                'plans_captured': self._plans_captured,
+                'plans_failed': self._plans_failed,
+            }
+
+    def report(self, limit=20):
+        """Slowest statements, the shapes with the most total time, and their plans"""
+        with self._lock:
+            slowest = [entry for _, _, entry in sorted(self._slowest, reverse=True)]
+            shapes = sorted(self._shapes.items(), key=lambda item: item[1].total, reverse=True)[:limit]
+            by_shape = [{
+                'shape': shape,
+                'calls': stats.calls,
+                'errors': stats.errors,
+                'slow': stats.slow,
+                'total_ms': round(stats.total * 1000, 3),
+                'mean_ms': round(stats.total / stats.calls * 1000, 3),
+                'max_ms': round(stats.max * 1000, 3),
+                'last_at': stats.last_at,
+                'plans': list(stats.plans),
+            } for shape, stats in shapes]
+            # Plans of shapes that are in the slowest table but not listed above
+            plans = {}
+            listed = {entry['shape'] for entry in by_shape}
+            for entry in slowest:
+                stats = self._shapes.get(entry['shape'])
+                if entry['shape'] not in listed and stats is not None and stats.plans:
+                    plans[entry['shape']] = list(stats.plans)
+        return {
+            'slow_ms': self.slow_ms,
+            'stats': self.stats(),
+            'slowest': slowest,
+            'shapes': by_shape,
+            'other_plans': plans,
+        }
@@ -0,0 +1,158 @@
+"""
+Token-bucket rate limiting for the extension backend.
+
+Each scope (e.g. 'ingest', 'read') has a per-user bucket and a global bucket.
+Checks are O(1) and run before any database work. Buckets live in process
+memory by default; with a Redis URL they are shared by every worker and host
+through one atomic Lua script per check. If Redis is unreachable the check
+fails open (and is counted) rather than taking the API down.
+"""
+
+import math
+import threading
+import time
+
+# KEYS[1] = bucket key; ARGV = rate, burst, now, cost -> {allowed, retry_after}
+REDIS_TOKEN_BUCKET = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return {allowed, tostring(wait)}
+"""
+
+
+class Limit:
+    """`rate` tokens per second, up to `burst` tokens saved up"""
+
+    def __init__(self, rate, burst):
+        if rate <= 0 or burst <= 0:
+            raise ValueError("Rate limit rate and burst must be positive")
+        self.rate = float(rate)
+        self.burst = float(burst)
+
+
+class MemoryBuckets:
+    """Per-process buckets: {key: [tokens, last_refill_monotonic]}"""
+
+    # Idle buckets are dropped once there are more than this many
+    MAX_KEYS = 100000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def take(self, key, limit, cost):
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.MAX_KEYS:
+                    self._prune(now)
+                bucket = self._buckets[key] = [limit.burst, now]
+            tokens = min(limit.burst, bucket[0] + (now - bucket[1]) * limit.rate)
+            bucket[1] = now
+            if tokens >= cost:
+                bucket[0] = tokens - cost
+                return True, 0.0
+            bucket[0] = tokens
+            return False, (cost - tokens) / limit.rate
+
+    def _prune(self, now):
+        # A bucket idle long enough to be full again carries no state
+        self._buckets = {
+            key: bucket for key, bucket in self._buckets.items()
+            if now - bucket[1] < 60
+        }
+
+
+class RedisBuckets:
+    """Buckets shared through Redis (one round trip per check)"""
+
+    def __init__(self, url, prefix='gaia:rl:'):
+        import redis  # optional dependency, only needed for the shared backend
+        self._client = redis.Redis.from_url(url, socket_timeout=0.25, socket_connect_timeout=0.25)
+        self._script = self._client.register_script(REDIS_TOKEN_BUCKET)
+        self.prefix = prefix
+
+    def take(self, key, limit, cost):
+        allowed, wait = self._script(
+            keys=[self.prefix + key],
+            args=[limit.rate, limit.burst, time.time(), cost]
+        )
+        return bool(allowed), float(wait)
+
+
+class RateLimiter:
+    """Per-user and global token buckets per scope, with counters"""
+
+    def __init__(self, limits, backend=None):
+        """
+        Args:
+            limits: {scope: (per_user Limit or None, global Limit or None)}
+            backend: MemoryBuckets (default) or RedisBuckets
+        """
+        self.limits = limits
+        self.backend = backend or MemoryBuckets()
+        self._lock = threading.Lock()
+        self._counters = {
+            scope: {'allowed': 0, 'limited_user': 0, 'limited_global': 0, 'backend_errors': 0}
+            for scope in limits
+        }
+
+    def _count(self, scope, counter):
+        with self._lock:
+            self._counters[scope][counter] += 1
+
+    def check(self, scope, user_id, cost=1):
+        """
+        Take `cost` tokens from the user's and the global bucket for `scope`.
+        Returns (allowed, retry_after_seconds).
+        """
+        user_limit, global_limit = self.limits[scope]
+        checks = []
+        if user_limit is not None:
+            checks.append(('limited_user', f'{scope}:user:{user_id}', user_limit))
+        if global_limit is not None:
+            checks.append(('limited_global', f'{scope}:global', global_limit))
+
+        for counter, key, limit in checks:
+            try:
+                # A request larger than the burst is admitted when the bucket is full
+                allowed, retry_after = self.backend.take(key, limit, min(cost, limit.burst))
+            except Exception as e:
+                print(f"⚠️  Rate limit backend error ({scope}), allowing request: {e}")
+                self._count(scope, 'backend_errors')
+                return True, 0.0
+            if not allowed:
+                self._count(scope, counter)
+                return False, retry_after
+
+        self._count(scope, 'allowed')
+        return True, 0.0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': 'redis' if isinstance(self.backend, RedisBuckets) else 'memory',
+                'scopes': {scope: dict(counters) for scope, counters in self._counters.items()},
+            }
+
+
+def retry_after_header(seconds):
+    """Retry-After takes whole seconds; never advertise 0"""
+    return str(max(1, math.ceil(seconds)))
@@ -0,0 +1,237 @@
+"""
+Incrementally maintained per-user rollups of llmprompts.
+
+Every insert path adds its deltas to `llmprompt_user_rollups` and
+`llmprompt_user_llm_rollups` in the same transaction as the raw rows, so the
+summary endpoint reads one row instead of aggregating the user's history.
+
+Writers always lock the user's rollup row first (the per-LLM rows are only
+touched while holding it), which is also what makes the rebuild below safe to
+run against live traffic. Run `python rollups.py rebuild [user_id]` to
+reconcile rollups with the raw rows, e.g. after rows were written by a path
+that does not maintain them.
+"""
+
+# Additive columns kept per user (averages are derived on read)
+SUMMARY_COLUMNS = (
+    'total_prompts', 'total_input_tokens', 'total_output_tokens', 'total_tokens',
+    'total_energy_kwh', 'total_co2_grams', 'total_water_liters'
+)
+
+
+def _event_total_tokens(event):
+    return event['input_tokens'] + event['output_tokens']
+
+
+def apply_rollups(cursor, user_id, events):
+    """Add a batch of newly inserted events for one user to the rollups"""
+    if not events:
+        return
+
+    totals = {
+        'total_prompts': len(events),
+        'total_input_tokens': sum(e['input_tokens'] for e in events),
+        'total_output_tokens': sum(e['output_tokens'] for e in events),
+        'total_tokens': sum(_event_total_tokens(e) for e in events),
+        'total_energy_kwh': sum(e['energy_kwh'] for e in events),
+        'total_co2_grams': sum(e['co2_grams'] for e in events),
+        'total_water_liters': sum(e['water_liters'] for e in events),
+    }
+
+    by_llm = {}
+    for event in events:
+        llm = event['llm'] or 'Unknown'
+        count, tokens = by_llm.get(llm, (0, 0))
+        by_llm[llm] = (count + 1, tokens + _event_total_tokens(event))
+
+    cursor.execute(
+        f"""
+        INSERT INTO llmprompt_user_rollups AS r (user_id, {', '.join(SUMMARY_COLUMNS)})
+        VALUES (%s, {', '.join(['%s'] * len(SUMMARY_COLUMNS))})
+        ON CONFLICT (user_id) DO UPDATE SET
+            {', '.join(f'{c} = r.{c} + EXCLUDED.{c}' for c in SUMMARY_COLUMNS)},
+            updated_at = CURRENT_TIMESTAMP
+        RETURNING (xmax = 0) AS created
+        """,
+        [str(user_id)] + [totals[c] for c in SUMMARY_COLUMNS]
+    )
+    if cursor.fetchone()['created']:
+        # First rollup row for this user: older raw rows may predate rollups,
+        # so seed from the raw table (which already includes this batch)
+        rebuild_user_rollups(cursor, user_id)
+        return
+
+    # Sorted so concurrent batches lock per-LLM rows in the same order
+    for llm in sorted(by_llm):
+        count, tokens = by_llm[llm]
+        cursor.execute(
+            """
+            INSERT INTO llmprompt_user_llm_rollups AS r (user_id, llm, prompt_count, total_tokens)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (user_id, llm) DO UPDATE SET
+                prompt_count = r.prompt_count + EXCLUDED.prompt_count,
+                total_tokens = r.total_tokens + EXCLUDED.total_tokens
+            """,
+            (str(user_id), llm, count, tokens)
+        )
+
+
+def read_summary(cursor, user_id):
+    """
+    Return (summary, llm_breakdown) from the rollups, or None if the user has
+    no rollup row yet (never ingested through this backend, or not migrated).
+    """
+    cursor.execute(
+        f"""
+        SELECT {', '.join(SUMMARY_COLUMNS)}
+        FROM llmprompt_user_rollups
+        WHERE user_id = %s
+        """,
+        (str(user_id),)
+    )
+    row = cursor.fetchone()
+    if row is None:
+        return None
+
+    summary = dict(row)
+    prompts = summary['total_prompts']
+    summary['avg_input_tokens'] = summary['total_input_tokens'] / prompts if prompts else 0
+    summary['avg_output_tokens'] = summary['total_output_tokens'] / prompts if prompts else 0
+
+    cursor.execute(
+        """
+        SELECT llm, prompt_count AS count, total_tokens AS tokens
+        FROM llmprompt_user_llm_rollups
+        WHERE user_id = %s
+        ORDER BY prompt_count DESC
+        """,
+        (str(user_id),)
+    )
+    return summary, cursor.fetchall()
+
+
+def rebuild_user_rollups(cursor, user_id):
+    """
+    Recompute one user's rollups from the raw and compacted rows.
+    Must run in its own transaction; the caller commits.
+    """
+    user_id = str(user_id)
+
+    # Take the user's rollup row lock before reading raw rows: writers that
+    # already added deltas have committed, later ones wait and apply on top.
+    cursor.execute(
+        "INSERT INTO llmprompt_user_rollups (user_id) VALUES (%s) ON CONFLICT (user_id) DO NOTHING",
+        (user_id,)
+    )
+    cursor.execute(
+        "SELECT 1 FROM llmprompt_user_rollups WHERE user_id = %s FOR UPDATE",
+        (user_id,)
+    )
+
+    cursor.execute(
+        """
+        UPDATE llmprompt_user_rollups r SET
+            total_prompts = s.total_prompts,
+            total_input_tokens = s.total_input_tokens,
+            total_output_tokens = s.total_output_tokens,
+            total_tokens = s.total_tokens,
+            total_energy_kwh = s.total_energy_kwh,
+            total_co2_grams = s.total_co2_grams,
+            total_water_liters = s.total_water_liters,
+            compacted_prompts = c.prompts,
+            compacted_before = c.compacted_before,
+            updated_at = CURRENT_TIMESTAMP
+        FROM (
+            SELECT
+                COALESCE(SUM(prompts), 0) AS total_prompts,
+                COALESCE(SUM(input_tokens), 0) AS total_input_tokens,
+                COALESCE(SUM(output_tokens), 0) AS total_output_tokens,
+                COALESCE(SUM(total_tokens), 0) AS total_tokens,
+                COALESCE(SUM(energy_kwh), 0) AS total_energy_kwh,
+                COALESCE(SUM(co2_grams), 0) AS total_co2_grams,
+                COALESCE(SUM(water_liters), 0) AS total_water_liters
+            FROM (
+                SELECT COUNT(*) AS prompts, SUM(input_tokens) AS input_tokens,
+                       SUM(output_tokens) AS output_tokens, SUM(total_tokens) AS total_tokens,
+                       SUM(energy_kwh) AS energy_kwh, SUM(co2_grams) AS co2_grams,
+                       SUM(water_liters) AS water_liters
+                FROM llmprompts
+                WHERE user_id = %(user_id)s
+                UNION ALL
+                -- History already folded by compaction.py
+                SELECT SUM(prompt_count), SUM(input_tokens), SUM(output_tokens), SUM(total_tokens),
+                       SUM(energy_kwh), SUM(co2_grams), SUM(water_liters)
+                FROM llmprompt_compacted_hourly
+                WHERE user_id = %(user_id)s
+            ) parts
+        ) s, (
+            SELECT COALESCE(SUM(prompt_count), 0) AS prompts,
+                   MAX(hour_start) + INTERVAL '1 hour' AS compacted_before
+            FROM llmprompt_compacted_hourly
+            WHERE user_id = %(user_id)s
+        ) c
+        WHERE r.user_id = %(user_id)s
+        """,
+        {'user_id': user_id}
+    )
+
+    cursor.execute("DELETE FROM llmprompt_user_llm_rollups WHERE user_id = %s", (user_id,))
+    cursor.execute(
+        """
+        INSERT INTO llmprompt_user_llm_rollups (user_id, llm, prompt_count, total_tokens)
+        SELECT %(user_id)s, llm, SUM(prompts), SUM(tokens)
+        FROM (
+            SELECT COALESCE(llm, 'Unknown') AS llm, COUNT(*) AS prompts,
+                   COALESCE(SUM(total_tokens), 0) AS tokens
+            FROM llmprompts
+            WHERE user_id = %(user_id)s
+            GROUP BY 1
+            UNION ALL
+            SELECT llm, prompt_count, total_tokens
+            FROM llmprompt_compacted_hourly
+            WHERE user_id = %(user_id)s
+        ) parts
+        GROUP BY llm
+        """,
+        {'user_id': user_id}
+    )
+
+
+def rebuild_all_rollups(conn, user_ids=None):
+    """Reconcile rollups for the given users (default: every user), one transaction each"""
+    if user_ids is None:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT id FROM users ORDER BY id")
+            user_ids = [row[0] if isinstance(row, tuple) else row['id'] for row in cursor.fetchall()]
+        conn.commit()
+
+    rebuilt = 0
+    for user_id in user_ids:
+        try:
+            with conn.cursor() as cursor:
+                rebuild_user_rollups(cursor, user_id)
+            conn.commit()
+            rebuilt += 1
+        except Exception as e:
+            conn.rollback()
+            print(f"❌ Rollup rebuild failed for user {user_id}: {e}")
+    return rebuilt
+
+
+if __name__ == '__main__':
+    import os
+    import sys
+    import psycopg2
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    if len(sys.argv) < 2 or sys.argv[1] != 'rebuild':
+        print("Usage: python rollups.py rebuild [user_id ...]")
+        sys.exit(1)
+
+    connection = psycopg2.connect(os.getenv('DATABASE_URL'))
+    try:
+        count = rebuild_all_rollups(connection, sys.argv[2:] or None)
+        print(f"✅ Rebuilt rollups for {count} user(s)")
+    finally:
+        connection.close()
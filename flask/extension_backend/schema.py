@@ -0,0 +1,269 @@
+"""
+Idempotent schema setup for tables owned by the extension backend.
+
+The base `users` / `llmprompts` tables are created by hand (see QUICKSTART.md);
+everything the backend derives from them is created here. Run directly with
+`python schema.py`, or automatically at startup unless DB_AUTO_MIGRATE=false.
+
+Startup only applies the quick statements. The llmprompts indexes are built
+CONCURRENTLY, which can take minutes on a large table, so only `python
+schema.py` builds them; startup logs a warning while any are missing.
+"""
+
+from partitions import PARENT_TABLE, is_partitioned, ensure_partitions, list_partitions
+
+# Arbitrary constant so concurrently starting workers migrate one at a time
+SCHEMA_LOCK_ID = 727274001
+
+SCHEMA_STATEMENTS = [
+    # ---- per-user rollups (summary endpoint) ----
+    """
+    CREATE TABLE IF NOT EXISTS llmprompt_user_rollups (
+        user_id UUID PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+        total_prompts BIGINT NOT NULL DEFAULT 0,
+        total_input_tokens BIGINT NOT NULL DEFAULT 0,
+        total_output_tokens BIGINT NOT NULL DEFAULT 0,
+        total_tokens BIGINT NOT NULL DEFAULT 0,
+        total_energy_kwh NUMERIC(24, 8) NOT NULL DEFAULT 0,
+        total_co2_grams NUMERIC(24, 4) NOT NULL DEFAULT 0,
+        total_water_liters NUMERIC(24, 4) NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    # Set once the user's time buckets are seeded from their history (timeseries.py)
+    """
+    ALTER TABLE llmprompt_user_rollups ADD COLUMN IF NOT EXISTS buckets_seeded BOOLEAN NOT NULL DEFAULT FALSE
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS llmprompt_user_llm_rollups (
+        user_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+        llm VARCHAR(255) NOT NULL,
+        prompt_count BIGINT NOT NULL DEFAULT 0,
+        total_tokens BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, llm)
+    )
+    """,
+
+    # ---- time buckets (timeseries endpoint) ----
+    """
+    CREATE TABLE IF NOT EXISTS llmprompt_hourly_buckets (
+        user_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+        bucket_start TIMESTAMP WITH TIME ZONE NOT NULL,
+        model VARCHAR(255) NOT NULL,
+        llm VARCHAR(255) NOT NULL,
+        cloud_region VARCHAR(50) NOT NULL,
+        prompt_count BIGINT NOT NULL DEFAULT 0,
+        input_tokens BIGINT NOT NULL DEFAULT 0,
+        output_tokens BIGINT NOT NULL DEFAULT 0,
+        total_tokens BIGINT NOT NULL DEFAULT 0,
+        energy_kwh NUMERIC(24, 8) NOT NULL DEFAULT 0,
+        co2_grams NUMERIC(24, 4) NOT NULL DEFAULT 0,
+        water_liters NUMERIC(24, 4) NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, bucket_start, model, llm, cloud_region)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS llmprompt_daily_buckets (
+        LIKE llmprompt_hourly_buckets INCLUDING DEFAULTS INCLUDING CONSTRAINTS,
+        PRIMARY KEY (user_id, bucket_start, model, llm, cloud_region),
+        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS llmprompt_bucket_watermarks (
+        name VARCHAR(64) PRIMARY KEY,
+        rolled_up_to TIMESTAMP WITH TIME ZONE NOT NULL
+    )
+    """,
+
+    # ---- idempotency keys (client retries are not inserted twice) ----
+    # Kept outside llmprompts because a unique index on a partitioned table
+    # must include the partition key
+    """
+    CREATE TABLE IF NOT EXISTS llmprompt_event_keys (
+        user_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+        event_key VARCHAR(160) NOT NULL,
+        prompt_id BIGINT NOT NULL,
+        created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (user_id, event_key)
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_llmprompt_event_keys_created
+        ON llmprompt_event_keys USING brin (created_at)
+    """,
+
+    # ---- compacted history (raw rows older than COMPACT_AFTER_DAYS) ----
+    """
+    CREATE TABLE IF NOT EXISTS llmprompt_compacted_hourly (
+        user_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+        hour_start TIMESTAMP WITH TIME ZONE NOT NULL,
+        model VARCHAR(255) NOT NULL,
+        llm VARCHAR(255) NOT NULL,
+        prompt_count BIGINT NOT NULL DEFAULT 0,
+        input_tokens BIGINT NOT NULL DEFAULT 0,
+        output_tokens BIGINT NOT NULL DEFAULT 0,
+        total_tokens BIGINT NOT NULL DEFAULT 0,
+        energy_kwh NUMERIC(24, 8) NOT NULL DEFAULT 0,
+        co2_grams NUMERIC(24, 4) NOT NULL DEFAULT 0,
+        water_liters NUMERIC(24, 4) NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, hour_start, model, llm)
+    )
+    """,
+    # Per-user compaction totals kept next to the rollup counter, so the history
+    # endpoint does not sum llmprompt_compacted_hourly on every page. Seeded from
+    # that table once, when the columns are added.
+    """
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = current_schema()
+              AND table_name = 'llmprompt_user_rollups'
+              AND column_name = 'compacted_prompts'
+        ) THEN
+            ALTER TABLE llmprompt_user_rollups
+                ADD COLUMN compacted_prompts BIGINT NOT NULL DEFAULT 0,
+                ADD COLUMN compacted_before TIMESTAMP WITH TIME ZONE;
+            UPDATE llmprompt_user_rollups r SET
+                compacted_prompts = c.prompts,
+                compacted_before = c.compacted_before
+            FROM (
+                SELECT user_id, SUM(prompt_count) AS prompts,
+                       MAX(hour_start) + INTERVAL '1 hour' AS compacted_before
+                FROM llmprompt_compacted_hourly
+                GROUP BY user_id
+            ) c
+            WHERE r.user_id = c.user_id;
+        END IF;
+    END
+    $$
+    """,
+]
+
+
+# Indexes on llmprompts, built without blocking ingestion: CONCURRENTLY on a
+# plain table, per partition on a partitioned one (_ensure_partitioned_index)
+LLMPROMPTS_INDEXES = [
+    # Keyset pagination of a user's history: /api/metrics/user?cursor=...
+    ('idx_llmprompts_user_captured_id', '(user_id, captured_at DESC, id DESC)'),
+    # Compaction scans for the oldest rows; BRIN stays tiny on append-only time data
+    ('idx_llmprompts_captured_brin', 'USING brin (captured_at)'),
+]
+
+
+def _index_is_valid(cursor, name):
+    """True/False for an existing index, None if there is none"""
+    cursor.execute("SELECT indisvalid AS valid FROM pg_index WHERE indexrelid = to_regclass(%s)", (name,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return row[0] if isinstance(row, tuple) else row['valid']
+
+
+def _ensure_partitioned_index(cursor, name, definition):
+    """
+    A partitioned parent cannot be indexed CONCURRENTLY, and a plain CREATE
+    INDEX would lock every partition while it builds. Instead: create the
+    index ON ONLY the parent (invalid, instant), build the same index
+    CONCURRENTLY on each partition and attach it. The parent index becomes
+    valid once every partition has one, and new partitions get theirs
+    automatically. Needs an autocommit connection.
+    """
+    if _index_is_valid(cursor, name):
+        return
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON ONLY {PARENT_TABLE} {definition}")
+    # Partitions created since (or attached earlier) already have one
+    cursor.execute(
+        """
+        SELECT t.relname AS partition
+        FROM pg_inherits i
+        JOIN pg_index x ON x.indexrelid = i.inhrelid
+        JOIN pg_class t ON t.oid = x.indrelid
+        WHERE i.inhparent = to_regclass(%s)
+        """,
+        (name,)
+    )
+    indexed = {row[0] if isinstance(row, tuple) else row['partition'] for row in cursor.fetchall()}
+    suffix = name.removeprefix(f'idx_{PARENT_TABLE}_')
+    for partition in list_partitions(cursor):
+        if partition in indexed:
+            continue
+        child = f'{partition}_{suffix}'[:63]
+        if _index_is_valid(cursor, child) is False:
+            # Left over from an interrupted CONCURRENTLY build
+            cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {child}")
+        cursor.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {child} ON {partition} {definition}")
+        cursor.execute(f"ALTER INDEX {name} ATTACH PARTITION {child}")
+
+
+def missing_indexes(cursor):
+    """Names of LLMPROMPTS_INDEXES that do not exist or are not valid yet"""
+    return [name for name, _ in LLMPROMPTS_INDEXES if not _index_is_valid(cursor, name)]
+
+
+def ensure_indexes(conn):
+    """
+    Build LLMPROMPTS_INDEXES without blocking ingestion. Indexes left INVALID
+    by an interrupted CONCURRENTLY build are dropped and rebuilt.
+    """
+    with conn.cursor() as cursor:
+        partitioned = is_partitioned(cursor)
+    conn.commit()
+
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_lock(%s)", (SCHEMA_LOCK_ID,))
+            try:
+                for name, definition in LLMPROMPTS_INDEXES:
+                    if partitioned:
+                        _ensure_partitioned_index(cursor, name, definition)
+                        continue
+                    valid = _index_is_valid(cursor, name)
+                    if valid:
+                        continue
+                    if valid is False:
+                        # IF NOT EXISTS would keep the broken one forever
+                        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+                    cursor.execute(f"CREATE INDEX CONCURRENTLY {name} ON {PARENT_TABLE} {definition}")
+            finally:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", (SCHEMA_LOCK_ID,))
+    finally:
+        conn.autocommit = autocommit
+
+
+def ensure_schema(conn, partition_months_ahead=3):
+    """
+    Apply all schema statements in one transaction and, if llmprompts is
+    partitioned, create upcoming monthly partitions. Indexes are left to
+    ensure_indexes().
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK_ID,))
+        for statement in SCHEMA_STATEMENTS:
+            cursor.execute(statement)
+        partitioned = is_partitioned(cursor)
+        missing = missing_indexes(cursor)
+    conn.commit()
+
+    if missing:
+        print(f"⚠️  llmprompts indexes missing or invalid: {', '.join(missing)} (run python schema.py)")
+    if partitioned:
+        ensure_partitions(conn, partition_months_ahead)
+
+
+if __name__ == '__main__':
+    import os
+    import psycopg2
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    connection = psycopg2.connect(os.getenv('DATABASE_URL'))
+    try:
+        ensure_schema(connection)
+        ensure_indexes(connection)
+        print("✅ Schema and indexes ready")
+    finally:
+        connection.close()
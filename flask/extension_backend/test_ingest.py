@@ -0,0 +1,168 @@
+# test_ingest.py
+"""
+Tests for the ingestion helpers (validation, idempotency keys, batch decoding).
+No database needed. Run with: pytest test_ingest.py -v
+"""
+
+import gzip
+import json
+
+import pytest
+
+from ingest import (
+    EVENT_ID_MAX_LENGTH, MAX_TOKENS, PayloadError,
+    decode_batch_payload, derive_event_key, validate_event
+)
+
+
+def make_event(**overrides):
+    event = {
+        'site': 'chatgpt',
+        'model': 'gpt-4o',
+        'input_tokens_before': 120,
+        'input_tokens_after': 100,
+        'output_tokens': 50,
+    }
+    event.update(overrides)
+    return event
+
+
+class TestValidateEvent:
+    """Test single event validation and normalisation."""
+
+    def test_valid_event_is_normalised(self):
+        """Test fields are mapped to llmprompts columns with defaults."""
+        event = validate_event(make_event())
+        assert event['llm'] == 'chatgpt'
+        assert event['model'] == 'gpt-4o'
+        assert event['input_raw'] == 120
+        assert event['input_tokens'] == 100
+        assert event['output_tokens'] == 50
+        assert event['is_cached'] is False
+        assert event['cloud_provider'] == 'unknown'
+        assert event['cloud_region'] == 'unknown'
+        assert event['event_key'] is None
+
+    def test_not_an_object(self):
+        """Test non-object events are rejected."""
+        with pytest.raises(ValueError, match='JSON object'):
+            validate_event(['site', 'model'])
+
+    @pytest.mark.parametrize('field', ['site', 'model', 'input_tokens_after', 'output_tokens'])
+    def test_missing_required_field(self, field):
+        """Test every required field is enforced."""
+        data = make_event()
+        del data[field]
+        with pytest.raises(ValueError, match=f'Missing required field: {field}'):
+            validate_event(data)
+
+    @pytest.mark.parametrize('value', [-1, True, '10', None, MAX_TOKENS + 1])
+    def test_invalid_token_count(self, value):
+        """Test token counts must be non-negative numbers within INTEGER range."""
+        with pytest.raises(ValueError, match='output_tokens'):
+            validate_event(make_event(output_tokens=value))
+
+    def test_token_sum_overflow(self):
+        """Test the summed total_tokens must also fit an INTEGER column."""
+        with pytest.raises(ValueError, match='input_tokens_after \\+ output_tokens'):
+            validate_event(make_event(input_tokens_after=MAX_TOKENS, output_tokens=1))
+
+    def test_string_too_long(self):
+        """Test text fields are bounded by their column length."""
+        with pytest.raises(ValueError, match='cloud_region'):
+            validate_event(make_event(cloud_region='x' * 51))
+
+    def test_optional_string_wrong_type(self):
+        """Test optional text fields must be strings when present."""
+        with pytest.raises(ValueError, match='cloud_provider'):
+            validate_event(make_event(cloud_provider=42))
+
+
+class TestDeriveEventKey:
+    """Test idempotency keys."""
+
+    def test_event_id_wins(self):
+        """Test a client event_id is used as is."""
+        assert derive_event_key(make_event(event_id='abc', session_id='s', timestamp=1)) == 'id:abc'
+        assert derive_event_key(make_event(event_id=7)) == 'id:7'
+
+    @pytest.mark.parametrize('event_id', ['', True, 1.5, 'x' * (EVENT_ID_MAX_LENGTH + 1)])
+    def test_invalid_event_id(self, event_id):
+        """Test empty, non-scalar and oversized event ids are rejected."""
+        with pytest.raises(ValueError, match='event_id'):
+            derive_event_key(make_event(event_id=event_id))
+
+    def test_hash_is_stable(self):
+        """Test the same session, timestamp and counts give the same key."""
+        first = derive_event_key(make_event(session_id='s1', timestamp='2024-01-01T00:00:00Z'))
+        again = derive_event_key(make_event(session_id='s1', timestamp='2024-01-01T00:00:00Z'))
+        assert first == again
+        assert first.startswith('h:')
+
+    def test_hash_depends_on_counts(self):
+        """Test a retry is only matched when the token counts are the same."""
+        base = derive_event_key(make_event(session_id='s1', timestamp=1))
+        assert derive_event_key(make_event(session_id='s1', timestamp=1, output_tokens=51)) != base
+        assert derive_event_key(make_event(session_id='s2', timestamp=1)) != base
+
+    def test_no_key_without_session_and_timestamp(self):
+        """Test events without an id or session/timestamp are never deduplicated."""
+        assert derive_event_key(make_event(session_id='s1')) is None
+        assert derive_event_key(make_event(timestamp=1)) is None
+
+
+class TestDecodeBatchPayload:
+    """Test batch body decoding."""
+
+    def test_bare_array(self):
+        """Test a JSON array of events."""
+        events = [make_event(), make_event(model='claude')]
+        assert decode_batch_payload(json.dumps(events).encode()) == events
+
+    def test_events_object(self):
+        """Test the {"events": [...]} shape."""
+        events = [make_event()]
+        assert decode_batch_payload(json.dumps({'events': events}).encode()) == events
+
+    @pytest.mark.parametrize('body', [b'{"items": []}', b'{"events": {}}', b'42', b'"events"'])
+    def test_wrong_shape(self, body):
+        """Test bodies that are neither shape are rejected."""
+        with pytest.raises(PayloadError, match='JSON array'):
+            decode_batch_payload(body)
+
+    def test_invalid_json(self):
+        """Test malformed and non-UTF-8 bodies are rejected."""
+        with pytest.raises(PayloadError, match='Invalid JSON'):
+            decode_batch_payload(b'[{"site": ')
+        with pytest.raises(PayloadError, match='Invalid JSON'):
+            decode_batch_payload(b'\xff\xfe[]')
+
+    def test_gzip(self):
+        """Test a gzip body is decompressed (Content-Encoding is case-insensitive)."""
+        events = [make_event()]
+        body = gzip.compress(json.dumps(events).encode())
+        assert decode_batch_payload(body, 'GZIP') == events
+
+    def test_invalid_gzip(self):
+        """Test a body claiming gzip that isn't is rejected."""
+        with pytest.raises(PayloadError, match='Invalid gzip body'):
+            decode_batch_payload(b'[{"site": "x"}]', 'gzip')
+
+    def test_byte_cap(self):
+        """Test an uncompressed body over max_bytes is rejected before parsing."""
+        body = json.dumps([make_event()] * 10).encode()
+        assert decode_batch_payload(body, max_bytes=len(body)) == [make_event()] * 10
+        with pytest.raises(PayloadError, match=f'Body exceeds {len(body) - 1} bytes'):
+            decode_batch_payload(body, max_bytes=len(body) - 1)
+
+    def test_gzip_bomb_is_bounded(self):
+        """Test a small gzip body that inflates past max_bytes is rejected."""
+        body = gzip.compress(b'[' + b' ' * (50 * 1024 * 1024) + b']')
+        assert len(body) < 100 * 1024
+        with pytest.raises(PayloadError, match='Decompressed body exceeds 1048576 bytes'):
+            decode_batch_payload(body, 'gzip', max_bytes=1024 * 1024)
+
+    def test_gzip_at_the_cap(self):
+        """Test a gzip body that inflates to exactly max_bytes is accepted."""
+        raw = json.dumps([make_event()]).encode()
+        assert decode_batch_payload(gzip.compress(raw), 'gzip', max_bytes=len(raw)) == [make_event()]
@@ -0,0 +1,148 @@
+# test_ratelimit.py
+"""
+Tests for the token-bucket rate limiter, on a fake clock.
+Run with: pytest test_ratelimit.py -v
+"""
+
+import pytest
+
+import ratelimit
+from ratelimit import Limit, MemoryBuckets, RateLimiter, retry_after_header
+
+
+class FakeTime:
+    """Stands in for the time module inside ratelimit"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class BrokenBackend:
+    def take(self, key, limit, cost):
+        raise ConnectionError('redis unreachable')
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeTime()
+    monkeypatch.setattr(ratelimit, 'time', fake)
+    return fake
+
+
+class TestMemoryBuckets:
+    """Test the in-process token bucket."""
+
+    def test_burst_then_limited(self, clock):
+        """Test a new bucket starts full and is empty after `burst` requests."""
+        buckets = MemoryBuckets()
+        limit = Limit(rate=2, burst=5)
+        assert all(buckets.take('k', limit, 1) == (True, 0.0) for _ in range(5))
+        allowed, retry_after = buckets.take('k', limit, 1)
+        assert not allowed
+        assert retry_after == pytest.approx(0.5)
+
+    def test_refill_over_time(self, clock):
+        """Test tokens come back at `rate` per second."""
+        buckets = MemoryBuckets()
+        limit = Limit(rate=2, burst=5)
+        assert buckets.take('k', limit, 5)[0]
+        clock.advance(1.0)
+        assert buckets.take('k', limit, 2)[0]
+        assert not buckets.take('k', limit, 1)[0]
+
+    def test_refill_capped_at_burst(self, clock):
+        """Test an idle bucket never holds more than `burst` tokens."""
+        buckets = MemoryBuckets()
+        limit = Limit(rate=2, burst=5)
+        assert buckets.take('k', limit, 5)[0]
+        clock.advance(3600)
+        assert buckets.take('k', limit, 5)[0]
+        assert not buckets.take('k', limit, 1)[0]
+
+    def test_retry_after(self, clock):
+        """Test retry_after is the time until `cost` tokens are available."""
+        buckets = MemoryBuckets()
+        limit = Limit(rate=4, burst=10)
+        assert buckets.take('k', limit, 9)[0]
+        allowed, retry_after = buckets.take('k', limit, 3)
+        assert not allowed
+        assert retry_after == pytest.approx(0.5)  # 1 token left, 2 more at 4/s
+        clock.advance(retry_after)
+        assert buckets.take('k', limit, 3)[0]
+
+    def test_denied_request_takes_nothing(self, clock):
+        """Test a rejected request leaves the tokens for a smaller one."""
+        buckets = MemoryBuckets()
+        limit = Limit(rate=1, burst=3)
+        assert not buckets.take('k', limit, 4)[0]
+        assert buckets.take('k', limit, 3)[0]
+
+    def test_keys_are_independent(self, clock):
+        """Test one user's bucket does not drain another's."""
+        buckets = MemoryBuckets()
+        limit = Limit(rate=1, burst=1)
+        assert buckets.take('a', limit, 1)[0]
+        assert buckets.take('b', limit, 1)[0]
+        assert not buckets.take('a', limit, 1)[0]
+
+
+class TestRateLimiter:
+    """Test per-user and global checks with their counters."""
+
+    def test_cost_above_burst_needs_full_bucket(self, clock):
+        """Test a request larger than the burst is admitted only when the bucket is full."""
+        limiter = RateLimiter({'ingest': (Limit(rate=10, burst=100), None)})
+        assert limiter.check('ingest', 'u1', cost=1) == (True, 0.0)
+
+        # 99 tokens left: a 500-event batch must wait for the bucket to fill up
+        allowed, retry_after = limiter.check('ingest', 'u1', cost=500)
+        assert not allowed
+        assert retry_after == pytest.approx(0.1)
+
+        clock.advance(retry_after)
+        assert limiter.check('ingest', 'u1', cost=500) == (True, 0.0)
+        allowed, retry_after = limiter.check('ingest', 'u1', cost=500)
+        assert not allowed
+        assert retry_after == pytest.approx(10.0)
+
+    def test_user_and_global_limits(self, clock):
+        """Test the global bucket limits all users together and is counted separately."""
+        limiter = RateLimiter({'read': (Limit(rate=1, burst=2), Limit(rate=1, burst=3))})
+        assert limiter.check('read', 'u1')[0]
+        assert limiter.check('read', 'u1')[0]
+        assert not limiter.check('read', 'u1')[0]
+        assert limiter.check('read', 'u2')[0]
+        assert not limiter.check('read', 'u3')[0]
+
+        counters = limiter.stats()['scopes']['read']
+        assert counters == {'allowed': 3, 'limited_user': 1, 'limited_global': 1, 'backend_errors': 0}
+        assert limiter.stats()['backend'] == 'memory'
+
+    def test_fail_open_on_backend_error(self, clock):
+        """Test a failing backend lets requests through and counts the error."""
+        limiter = RateLimiter({'ingest': (Limit(rate=1, burst=1), Limit(rate=1, burst=1))}, backend=BrokenBackend())
+        assert limiter.check('ingest', 'u1', cost=5) == (True, 0.0)
+        assert limiter.check('ingest', 'u1') == (True, 0.0)
+
+        counters = limiter.stats()['scopes']['ingest']
+        assert counters['backend_errors'] == 2
+        assert counters['allowed'] == 0
+
+    def test_unlimited_scope(self, clock):
+        """Test a scope without limits always allows."""
+        limiter = RateLimiter({'read': (None, None)})
+        assert all(limiter.check('read', 'u1', cost=1000)[0] for _ in range(10))
+
+
+class TestRetryAfterHeader:
+    """Test the Retry-After header value."""
+
+    @pytest.mark.parametrize('seconds, header', [(0.0, '1'), (0.2, '1'), (1.0, '1'), (1.01, '2'), (59.5, '60')])
+    def test_whole_seconds_never_zero(self, seconds, header):
+        assert retry_after_header(seconds) == header
@@ -0,0 +1,202 @@
+# test_write_behind.py
+"""
+Tests for the write-behind queue: spill files, orphan recovery, isolating bad
+events and dead-lettering. Uses a fake write_batch, so no database is needed.
+Run with: pytest test_write_behind.py -v
+"""
+
+import json
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from write_behind import DEAD_LETTER_FILE, WriteBehindQueue
+
+TIMEOUT = 5
+
+
+class FakeWriter:
+    """write_batch stand-in that records calls and fails the batches `fail` picks"""
+
+    def __init__(self, fail=None, gate=None):
+        self.fail = fail
+        self.gate = gate
+        self.entered = threading.Event()
+        self.calls = []
+        self.written = []
+        self._cond = threading.Condition()
+
+    def __call__(self, batch):
+        self.entered.set()
+        if self.gate is not None:
+            assert self.gate.wait(TIMEOUT)
+        error = self.fail(batch) if self.fail else None
+        with self._cond:
+            self.calls.append([item[0] for item in batch])
+            if error is None:
+                self.written.extend(item[0] for item in batch)
+            self._cond.notify_all()
+        if error is not None:
+            raise error
+
+    def wait_for(self, predicate):
+        with self._cond:
+            assert self._cond.wait_for(predicate, TIMEOUT)
+
+
+def dead_pid():
+    """A pid that is certainly not running any more"""
+    child = subprocess.Popen([sys.executable, '-c', 'pass'])
+    child.wait()
+    return child.pid
+
+
+def read_ids(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line)['id'] for line in f]
+
+
+def spill_files(directory):
+    return sorted(name for name in os.listdir(directory) if name.startswith('metrics-'))
+
+
+@pytest.fixture
+def make_queue(tmp_path):
+    queues = []
+
+    def make(writer, **options):
+        options.setdefault('flush_interval', 60)
+        options.setdefault('retry_delay', 0.01)
+        queue = WriteBehindQueue(writer, spill_dir=str(tmp_path), **options)
+        queues.append(queue)
+        return queue
+
+    yield make
+    for queue in queues:
+        queue.stop(timeout=TIMEOUT)
+
+
+class TestSpillRotation:
+    """Test events are on disk until their batch commits."""
+
+    def test_flushing_file_kept_until_commit(self, tmp_path, make_queue):
+        """Test a flush moves queued events aside and new ones start a fresh file."""
+        gate = threading.Event()
+        writer = FakeWriter(gate=gate)
+        queue = make_queue(writer, batch_size=2)
+        pid = os.getpid()
+        active = tmp_path / f'metrics-{pid}.jsonl'
+        flushing = tmp_path / f'metrics-{pid}.flushing.jsonl'
+
+        queue.submit('e1', 'u1', {'n': 1})
+        assert read_ids(active) == ['e1']
+        queue.submit('e2', 'u1', {'n': 2})
+
+        # The batch is being written: its events now live in the .flushing file
+        assert writer.entered.wait(TIMEOUT)
+        assert read_ids(flushing) == ['e1', 'e2']
+        queue.submit('e3', 'u1', {'n': 3})
+        assert read_ids(active) == ['e3']
+
+        gate.set()
+        writer.wait_for(lambda: writer.written == ['e1', 'e2'])
+        queue.stop(timeout=TIMEOUT)
+
+        assert writer.written == ['e1', 'e2', 'e3']
+        assert spill_files(tmp_path) == []
+
+    def test_failed_flush_keeps_events_on_disk(self, tmp_path, make_queue):
+        """Test a batch that failed transiently stays in the .flushing file and is retried."""
+        failures = [ConnectionError('database unreachable')]
+        writer = FakeWriter(fail=lambda batch: failures.pop() if failures else None)
+        queue = make_queue(writer, batch_size=2, transient_errors=(ConnectionError,))
+
+        queue.submit('e1', 'u1', {})
+        queue.submit('e2', 'u1', {})
+        writer.wait_for(lambda: writer.written == ['e1', 'e2'])
+
+        # Retried as one batch, never split into single writes
+        assert writer.calls == [['e1', 'e2'], ['e1', 'e2']]
+        assert queue.stats()['failures'] == 1
+        assert queue.stats()['dead_lettered'] == 0
+
+
+class TestOrphanRecovery:
+    """Test spill files of dead processes are replayed."""
+
+    def test_dead_process_files_are_replayed(self, tmp_path, make_queue):
+        """Test both spill files of a dead pid are written; a torn last line is skipped."""
+        pid = dead_pid()
+        (tmp_path / f'metrics-{pid}.flushing.jsonl').write_text(
+            json.dumps({'id': 'e1', 'user_id': 'u1', 'event': {'n': 1}}) + '\n'
+        )
+        (tmp_path / f'metrics-{pid}.jsonl').write_text(
+            json.dumps({'id': 'e2', 'user_id': 'u2', 'event': {'n': 2}}) + '\n'
+            + '{"id": "e3", "user_'
+        )
+        # Belongs to a running process, which is still flushing it
+        live = tmp_path / f'metrics-{os.getppid()}.jsonl'
+        live.write_text(json.dumps({'id': 'other', 'user_id': 'u3', 'event': {}}) + '\n')
+
+        writer = FakeWriter()
+        queue = make_queue(writer, batch_size=2)
+        queue.start()
+        writer.wait_for(lambda: writer.written == ['e1', 'e2'])
+        queue.stop(timeout=TIMEOUT)
+
+        assert live.exists()
+        assert spill_files(tmp_path) == [live.name]
+
+    def test_recovered_attempts_count(self, tmp_path, make_queue):
+        """Test failed attempts saved in a spill file count toward max_attempts."""
+        (tmp_path / f'metrics-{dead_pid()}.jsonl').write_text(
+            json.dumps({'id': 'bad', 'user_id': 'u1', 'event': {}, 'attempts': 2}) + '\n'
+        )
+        writer = FakeWriter(fail=lambda batch: ValueError('rejected'))
+        queue = make_queue(writer, batch_size=1, max_attempts=3)
+        queue.start()
+        writer.wait_for(lambda: len(writer.calls) == 1)
+        queue.stop(timeout=TIMEOUT)
+
+        assert read_ids(tmp_path / DEAD_LETTER_FILE) == ['bad']
+
+
+class TestBadEvents:
+    """Test one bad event does not block the rest."""
+
+    def test_write_each_isolates_bad_event(self, tmp_path, make_queue):
+        """Test a rejected batch is retried per event, so the good ones are written."""
+        writer = FakeWriter(fail=lambda batch: ValueError('bad value') if 'bad' in [i[0] for i in batch] else None)
+        queue = make_queue(writer, batch_size=3, flush_interval=0.05, max_attempts=3)
+
+        for ingest_id in ('g1', 'bad', 'g2'):
+            queue.submit(ingest_id, 'u1', {'id': ingest_id})
+        writer.wait_for(lambda: writer.calls.count(['bad']) == 3)
+        queue.stop(timeout=TIMEOUT)
+
+        assert writer.written == ['g1', 'g2']
+        assert writer.calls[:4] == [['g1', 'bad', 'g2'], ['g1'], ['bad'], ['g2']]
+
+    def test_dead_letter_after_max_attempts(self, tmp_path, make_queue):
+        """Test an event failing max_attempts times moves to dead-letter.jsonl."""
+        writer = FakeWriter(fail=lambda batch: ValueError('invalid input syntax'))
+        queue = make_queue(writer, batch_size=1, flush_interval=0.05, max_attempts=3)
+
+        queue.submit('bad', 'u1', {'model': 'x'})
+        writer.wait_for(lambda: len(writer.calls) == 3)
+        queue.stop(timeout=TIMEOUT)
+
+        with open(tmp_path / DEAD_LETTER_FILE, encoding='utf-8') as f:
+            records = [json.loads(line) for line in f]
+        assert len(records) == 1
+        assert records[0]['id'] == 'bad'
+        assert records[0]['user_id'] == 'u1'
+        assert records[0]['event'] == {'model': 'x'}
+        assert records[0]['error'] == 'invalid input syntax'
+        stats = queue.stats()
+        assert stats['dead_lettered'] == 1
+        assert stats['queued'] == 0
+        assert spill_files(tmp_path) == []
@@ -0,0 +1,392 @@
+"""
+Pre-aggregated time buckets for /api/metrics/timeseries.
+
+Ingestion adds every event to `llmprompt_hourly_buckets` (per user, UTC hour,
+model, llm and region) in the same transaction as the raw row. A periodic
+job (`python timeseries.py rollup`) folds complete UTC days into
+`llmprompt_daily_buckets` and advances a watermark; weeks are derived from
+days. Reads take closed days from the daily table and merge in hourly rows
+at or after the watermark, so the current, partially filled buckets are
+always up to date and a year-long daily chart reads a few hundred rows.
+
+A user's first ingested batch seeds their buckets from the raw and compacted
+history (`rebuild_user_buckets`), so rows written before the bucket tables
+existed are charted too. `python timeseries.py rebuild [user_id ...]`
+reconciles everyone (or the given users) the same way.
+"""
+
+from datetime import datetime, timedelta, timezone
+
+from psycopg2.extras import execute_values
+
+from rollups import rebuild_user_rollups
+
+BUCKET_SIZES = ('hour', 'day', 'week')
+
+# group_by value -> bucket column
+GROUP_COLUMNS = {
+    'model': 'model',
+    'llm': 'llm',
+    'region': 'cloud_region',
+}
+
+# Default window per bucket size when no ?from= is given
+DEFAULT_WINDOWS = {
+    'hour': timedelta(hours=48),
+    'day': timedelta(days=90),
+    'week': timedelta(weeks=52),
+}
+
+MEASURE_COLUMNS = (
+    'prompt_count', 'input_tokens', 'output_tokens', 'total_tokens',
+    'energy_kwh', 'co2_grams', 'water_liters'
+)
+
+WATERMARK_NAME = 'daily_buckets'
+
+# UTC truncation independent of the session TimeZone
+HOUR_NOW_SQL = "date_trunc('hour', CURRENT_TIMESTAMP AT TIME ZONE 'UTC') AT TIME ZONE 'UTC'"
+
+# Hourly buckets per user, hour, model, llm and region from the raw rows plus
+# the compacted history (which no longer has regions)
+HISTORY_SQL = f"""
+    SELECT date_trunc('hour', captured_at AT TIME ZONE 'UTC') AT TIME ZONE 'UTC' AS hour_start,
+           COALESCE(model, 'Unknown') AS model, COALESCE(llm, 'Unknown') AS llm,
+           COALESCE(cloud_region, 'unknown') AS cloud_region,
+           COUNT(*) AS prompt_count,
+           COALESCE(SUM(input_tokens), 0) AS input_tokens,
+           COALESCE(SUM(output_tokens), 0) AS output_tokens,
+           COALESCE(SUM(total_tokens), 0) AS total_tokens,
+           COALESCE(SUM(energy_kwh), 0) AS energy_kwh,
+           COALESCE(SUM(co2_grams), 0) AS co2_grams,
+           COALESCE(SUM(water_liters), 0) AS water_liters
+    FROM llmprompts
+    WHERE user_id = %(user_id)s
+    GROUP BY 1, 2, 3, 4
+    UNION ALL
+    SELECT hour_start, model, llm, 'unknown', {', '.join(MEASURE_COLUMNS)}
+    FROM llmprompt_compacted_hourly
+    WHERE user_id = %(user_id)s
+"""
+
+
+def apply_buckets(cursor, user_id, events):
+    """Add newly inserted events for one user to the current hourly bucket"""
+    if not events:
+        return
+
+    # The caller has locked the user's rollup row (apply_rollups), so this
+    # flips at most once per user
+    cursor.execute(
+        """
+        UPDATE llmprompt_user_rollups SET buckets_seeded = TRUE
+        WHERE user_id = %s AND NOT buckets_seeded
+        RETURNING user_id
+        """,
+        (str(user_id),)
+    )
+    if cursor.fetchone() is not None:
+        # First buckets for this user: seed from the raw table (which already
+        # includes this batch) and the compacted history
+        rebuild_user_buckets(cursor, user_id)
+        return
+
+    groups = {}
+    for event in events:
+        key = (event['model'] or 'Unknown', event['llm'] or 'Unknown', event['cloud_region'] or 'unknown')
+        measures = groups.setdefault(key, [0, 0, 0, 0, 0.0, 0.0, 0.0])
+        measures[0] += 1
+        measures[1] += event['input_tokens']
+        measures[2] += event['output_tokens']
+        measures[3] += event['input_tokens'] + event['output_tokens']
+        measures[4] += event['energy_kwh']
+        measures[5] += event['co2_grams']
+        measures[6] += event['water_liters']
+
+    # Sorted so concurrent writers lock bucket rows in the same order
+    rows = [(str(user_id),) + key + tuple(groups[key]) for key in sorted(groups)]
+    execute_values(
+        cursor,
+        f"""
+        INSERT INTO llmprompt_hourly_buckets AS b (
+            user_id, bucket_start, model, llm, cloud_region, {', '.join(MEASURE_COLUMNS)}
+        )
+        SELECT v.user_id::uuid, {HOUR_NOW_SQL}, v.model, v.llm, v.cloud_region,
+               {', '.join(f'v.{c}' for c in MEASURE_COLUMNS)}
+        FROM (VALUES %s) AS v(user_id, model, llm, cloud_region, {', '.join(MEASURE_COLUMNS)})
+        ON CONFLICT (user_id, bucket_start, model, llm, cloud_region) DO UPDATE SET
+            {', '.join(f'{c} = b.{c} + EXCLUDED.{c}' for c in MEASURE_COLUMNS)}
+        """,
+        rows,
+        page_size=len(rows)
+    )
+
+
+def rebuild_user_buckets(cursor, user_id, hourly_days=35):
+    """
+    Recompute one user's hourly and daily buckets from the raw and compacted rows.
+    Days before the watermark go to the daily table; hourly rows are kept for
+    the last `hourly_days` and everything after the watermark (what
+    prune_hourly leaves). Must run in its own transaction; the caller commits.
+    """
+    user_id = str(user_id)
+
+    # Bucket writers (ingest, the CO2 worker) hold the user's rollup row lock
+    # while adding deltas, as in rollups.rebuild_user_rollups
+    cursor.execute("SELECT 1 FROM llmprompt_user_rollups WHERE user_id = %s FOR UPDATE", (user_id,))
+    if cursor.fetchone() is None:
+        rebuild_user_rollups(cursor, user_id)
+
+    # Keep the daily fold from moving the watermark under us
+    cursor.execute(
+        """
+        INSERT INTO llmprompt_bucket_watermarks (name, rolled_up_to)
+        VALUES (%s, '-infinity') ON CONFLICT (name) DO NOTHING
+        """,
+        (WATERMARK_NAME,)
+    )
+    cursor.execute(
+        "SELECT rolled_up_to FROM llmprompt_bucket_watermarks WHERE name = %s FOR SHARE",
+        (WATERMARK_NAME,)
+    )
+
+    params = {'user_id': user_id, 'watermark': WATERMARK_NAME, 'hourly_days': hourly_days}
+    watermark_sql = "(SELECT rolled_up_to FROM llmprompt_bucket_watermarks WHERE name = %(watermark)s)"
+    sums = ', '.join(f'SUM({c})' for c in MEASURE_COLUMNS)
+
+    cursor.execute("DELETE FROM llmprompt_hourly_buckets WHERE user_id = %s", (user_id,))
+    cursor.execute("DELETE FROM llmprompt_daily_buckets WHERE user_id = %s", (user_id,))
+    cursor.execute(
+        f"""
+        INSERT INTO llmprompt_hourly_buckets (
+            user_id, bucket_start, model, llm, cloud_region, {', '.join(MEASURE_COLUMNS)}
+        )
+        SELECT %(user_id)s::uuid, hour_start, model, llm, cloud_region, {sums}
+        FROM ({HISTORY_SQL}) h
+        WHERE hour_start >= LEAST({watermark_sql}, CURRENT_TIMESTAMP - make_interval(days => %(hourly_days)s))
+        GROUP BY 2, 3, 4, 5
+        """,
+        params
+    )
+    cursor.execute(
+        f"""
+        INSERT INTO llmprompt_daily_buckets (
+            user_id, bucket_start, model, llm, cloud_region, {', '.join(MEASURE_COLUMNS)}
+        )
+        SELECT %(user_id)s::uuid,
+               date_trunc('day', hour_start AT TIME ZONE 'UTC') AT TIME ZONE 'UTC',
+               model, llm, cloud_region, {sums}
+        FROM ({HISTORY_SQL}) h
+        WHERE hour_start < {watermark_sql}
+        GROUP BY 2, 3, 4, 5
+        """,
+        params
+    )
+    cursor.execute("UPDATE llmprompt_user_rollups SET buckets_seeded = TRUE WHERE user_id = %s", (user_id,))
+
+
+def rebuild_all_buckets(conn, user_ids=None, hourly_days=35):
+    """Reconcile buckets for the given users (default: every user), one transaction each"""
+    if user_ids is None:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT id FROM users ORDER BY id")
+            user_ids = [row[0] if isinstance(row, tuple) else row['id'] for row in cursor.fetchall()]
+        conn.commit()
+
+    rebuilt = 0
+    for user_id in user_ids:
+        try:
+            with conn.cursor() as cursor:
+                rebuild_user_buckets(cursor, user_id, hourly_days)
+            conn.commit()
+            rebuilt += 1
+        except Exception as e:
+            conn.rollback()
+            print(f"❌ Bucket rebuild failed for user {user_id}: {e}")
+    return rebuilt
+
+
+def parse_range(bucket, start=None, end=None, now=None):
+    """Resolve ?from=/?to= (ISO 8601) into an aware UTC [start, end) range aligned to `bucket`"""
+    now = now or datetime.now(timezone.utc)
+
+    def parse(value):
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+    end = parse(end) if end else now
+    start = parse(start) if start else end - DEFAULT_WINDOWS[bucket]
+    if start >= end:
+        raise ValueError('from must be earlier than to')
+
+    # Align the start to a bucket boundary so the first bucket is complete
+    start = start.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    if bucket in ('day', 'week'):
+        start = start.replace(hour=0)
+    if bucket == 'week':
+        start -= timedelta(days=start.weekday())  # ISO weeks start on Monday
+    return start, end
+
+
+def fetch_timeseries(cursor, user_id, bucket, group_by=None, start=None, end=None):
+    """
+    Return [{bucket_start, group?, prompt_count, ...}] ordered by time.
+    `start`/`end` come from parse_range(); buckets are aligned to UTC boundaries.
+    """
+    if bucket not in BUCKET_SIZES:
+        raise ValueError(f"bucket must be one of: {', '.join(BUCKET_SIZES)}")
+    if group_by is not None and group_by not in GROUP_COLUMNS:
+        raise ValueError(f"group_by must be one of: {', '.join(GROUP_COLUMNS)}")
+
+    group_column = GROUP_COLUMNS.get(group_by)
+    select_group = f', {group_column} AS "group"' if group_column else ''
+    group_clause = f', {group_column}' if group_column else ''
+    sums = ', '.join(f'SUM({c}) AS {c}' for c in MEASURE_COLUMNS)
+    inner_columns = f"bucket_start, model, llm, cloud_region, {', '.join(MEASURE_COLUMNS)}"
+
+    if bucket == 'hour':
+        source = f"""
+            SELECT {inner_columns}
+            FROM llmprompt_hourly_buckets
+            WHERE user_id = %(user_id)s AND bucket_start >= %(start)s AND bucket_start < %(end)s
+        """
+    else:
+        # Closed days from the daily table, everything after the watermark from hourly
+        source = f"""
+            SELECT {inner_columns}
+            FROM llmprompt_daily_buckets
+            WHERE user_id = %(user_id)s
+              AND bucket_start >= %(start)s
+              AND bucket_start < %(end)s
+              AND bucket_start < (SELECT watermark FROM wm)
+            UNION ALL
+            SELECT {inner_columns}
+            FROM llmprompt_hourly_buckets
+            WHERE user_id = %(user_id)s
+              AND bucket_start >= GREATEST(%(start)s, (SELECT watermark FROM wm))
+              AND bucket_start < %(end)s
+        """
+
+    query = f"""
+        WITH wm AS (
+            SELECT COALESCE(
+                (SELECT rolled_up_to FROM llmprompt_bucket_watermarks WHERE name = %(watermark)s),
+                '-infinity'::timestamptz
+            ) AS watermark
+        )
+        SELECT
+            date_trunc(%(bucket)s, bucket_start AT TIME ZONE 'UTC') AT TIME ZONE 'UTC' AS bucket_start
+            {select_group},
+            {sums}
+        FROM ({source}) b
+        GROUP BY 1{group_clause}
+        ORDER BY 1{group_clause}
+    """
+    cursor.execute(query, {
+        'user_id': str(user_id),
+        'start': start,
+        'end': end,
+        'bucket': bucket,
+        'watermark': WATERMARK_NAME,
+    })
+    return cursor.fetchall()
+
+
+def roll_up_daily(conn):
+    """
+    Fold complete UTC days from hourly into daily buckets and advance the watermark.
+    Returns the new watermark. Safe to run repeatedly; one transaction per run.
+    """
+    with conn.cursor() as cursor:
+        # Serialises concurrent runs
+        cursor.execute(
+            """
+            INSERT INTO llmprompt_bucket_watermarks (name, rolled_up_to)
+            VALUES (%s, '-infinity') ON CONFLICT (name) DO NOTHING
+            """,
+            (WATERMARK_NAME,)
+        )
+        cursor.execute(
+            "SELECT rolled_up_to FROM llmprompt_bucket_watermarks WHERE name = %s FOR UPDATE",
+            (WATERMARK_NAME,)
+        )
+        cursor.execute(
+            f"""
+            WITH bounds AS (
+                SELECT
+                    (SELECT rolled_up_to FROM llmprompt_bucket_watermarks WHERE name = %(name)s) AS lo,
+                    date_trunc('day', CURRENT_TIMESTAMP AT TIME ZONE 'UTC') AT TIME ZONE 'UTC' AS hi
+            )
+            INSERT INTO llmprompt_daily_buckets AS d (
+                user_id, bucket_start, model, llm, cloud_region, {', '.join(MEASURE_COLUMNS)}
+            )
+            SELECT user_id,
+                   date_trunc('day', bucket_start AT TIME ZONE 'UTC') AT TIME ZONE 'UTC',
+                   model, llm, cloud_region,
+                   {', '.join(f'SUM({c})' for c in MEASURE_COLUMNS)}
+            FROM llmprompt_hourly_buckets, bounds
+            WHERE bucket_start >= bounds.lo AND bucket_start < bounds.hi
+            GROUP BY 1, 2, 3, 4, 5
+            ON CONFLICT (user_id, bucket_start, model, llm, cloud_region) DO UPDATE SET
+                {', '.join(f'{c} = EXCLUDED.{c}' for c in MEASURE_COLUMNS)}
+            """,
+            {'name': WATERMARK_NAME}
+        )
+        cursor.execute(
+            """
+            UPDATE llmprompt_bucket_watermarks
+            SET rolled_up_to = date_trunc('day', CURRENT_TIMESTAMP AT TIME ZONE 'UTC') AT TIME ZONE 'UTC'
+            WHERE name = %s
+            RETURNING rolled_up_to
+            """,
+            (WATERMARK_NAME,)
+        )
+        watermark = cursor.fetchone()
+    conn.commit()
+    return watermark[0] if isinstance(watermark, tuple) else watermark['rolled_up_to']
+
+
+def prune_hourly(conn, keep_days=35):
+    """Delete hourly buckets older than `keep_days` that are already folded into days"""
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """
+            DELETE FROM llmprompt_hourly_buckets
+            WHERE bucket_start < LEAST(
+                CURRENT_TIMESTAMP - make_interval(days => %s),
+                COALESCE(
+                    (SELECT rolled_up_to FROM llmprompt_bucket_watermarks WHERE name = %s),
+                    '-infinity'::timestamptz
+                )
+            )
+            """,
+            (keep_days, WATERMARK_NAME)
+        )
+        deleted = cursor.rowcount
+    conn.commit()
+    return deleted
+
+
+if __name__ == '__main__':
+    import os
+    import sys
+    import psycopg2
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    if len(sys.argv) < 2 or sys.argv[1] not in ('rollup', 'prune', 'rebuild'):
+        print("Usage: python timeseries.py rollup | prune [keep_days] | rebuild [user_id ...]")
+        sys.exit(1)
+
+    connection = psycopg2.connect(os.getenv('DATABASE_URL'))
+    try:
+        if sys.argv[1] == 'rollup':
+            print(f"✅ Daily buckets rolled up to {roll_up_daily(connection)}")
+        elif sys.argv[1] == 'rebuild':
+            count = rebuild_all_buckets(connection, sys.argv[2:] or None)
+            print(f"✅ Rebuilt time buckets for {count} user(s)")
+        else:
+            keep = int(sys.argv[2]) if len(sys.argv) > 2 else 35
+            print(f"✅ Pruned {prune_hourly(connection, keep)} hourly buckets")
+    finally:
+        connection.close()
@@ -0,0 +1,344 @@
+"""
+Write-behind ingestion queue for extension metrics.
+
+Validated, scored events are appended to a bounded in-process queue and a
+local spill file, and a background thread bulk-writes them to Postgres when
+either `batch_size` events are waiting or `flush_interval` seconds have
+passed. The request thread never waits for a commit.
+
+Spill files are per process (`metrics-<pid>.jsonl`). Each flush rotates the
+active file to `metrics-<pid>.flushing.jsonl` and deletes it only after the
+commit succeeds, so events that were queued when a process died are replayed
+by the next process that starts with the same spill directory.
+
+When a batch fails with an error other than `transient_errors` (e.g. a value
+the database rejects), its events are retried one at a time so the good ones
+are written. An event that has failed `max_attempts` times is moved to
+`dead-letter.jsonl` in the spill directory instead of blocking the queue.
+Transient errors (database unreachable) put the whole batch back to retry.
+"""
+
+import json
+import os
+import re
+import threading
+import time
+from collections import deque
+
+SPILL_FILE_PATTERN = re.compile(r'^metrics-(\d+)(?:\.flushing)?(?:-recovered-\d+)?\.jsonl$')
+DEAD_LETTER_FILE = 'dead-letter.jsonl'
+
+
+class QueueFullError(Exception):
+    """Raised when the write-behind queue is at capacity (caller should return 429)"""
+
+
+class WriteBehindQueue:
+    """Bounded queue of events drained to the database by a background flusher"""
+
+    def __init__(self, write_batch, max_size=10000, batch_size=500,
+                 flush_interval=1.0, spill_dir=None, retry_delay=2.0,
+                 max_attempts=3, transient_errors=()):
+        """
+        Args:
+            write_batch: callable taking [(ingest_id, user_id, event)] that
+                writes all items in one transaction and raises on failure
+            max_size: maximum number of queued events before submit() rejects
+            batch_size: flush as soon as this many events are waiting
+            flush_interval: flush at least this often (seconds) when non-empty
+            spill_dir: directory for crash-recovery spill files (None disables)
+            retry_delay: seconds to wait before retrying a failed flush
+            max_attempts: failed writes of one event before it is dead-lettered
+            transient_errors: exception types that mean "retry the whole batch
+                later" rather than "some event in it is bad"
+        """
+        self.write_batch = write_batch
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spill_dir = spill_dir
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+        self.transient_errors = tuple(transient_errors)
+
+        self._cond = threading.Condition()
+        self._items = deque()
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+        self._spill = None
+        self._attempts = {}      # ingest_id -> failed writes so far
+
+        self._accepted = 0
+        self._rejected = 0
+        self._flushed = 0
+        self._flushes = 0
+        self._failures = 0
+        self._dead_lettered = 0
+        self._last_error = None
+
+    # ---------------- lifecycle ----------------
+
+    def start(self):
+        """Start the flusher (idempotent, and safe to call again after a fork)"""
+        with self._cond:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stopping = False
+            if self.spill_dir:
+                os.makedirs(self.spill_dir, exist_ok=True)
+                self._spill = open(self._spill_path(), 'a', encoding='utf-8')
+            self._thread = threading.Thread(target=self._run, name='metrics-write-behind', daemon=True)
+            self._thread.start()
+
+        if self.spill_dir:
+            self._recover_orphans()
+
+    def stop(self, timeout=10.0):
+        """Flush everything still queued and stop the flusher (shutdown hook)"""
+        with self._cond:
+            if self._thread is None or self._pid != os.getpid():
+                return
+            self._stopping = True
+            self._cond.notify_all()
+            thread = self._thread
+        thread.join(timeout)
+        with self._cond:
+            self._thread = None
+            if self._spill is not None:
+                self._spill.close()
+                self._spill = None
+                # Nothing left in memory means nothing left to recover
+                if not self._items and os.path.exists(self._spill_path()):
+                    os.remove(self._spill_path())
+
+    # ---------------- producer side ----------------
+
+    def submit(self, ingest_id, user_id, event):
+        """Queue one event; raises QueueFullError when the queue is at capacity"""
+        if self._thread is None or self._pid != os.getpid():
+            self.start()
+
+        item = (ingest_id, str(user_id), event)
+        with self._cond:
+            if len(self._items) >= self.max_size:
+                self._rejected += 1
+                raise QueueFullError(f'Ingestion queue is full ({self.max_size} events)')
+            self._append_spill([item])
+            self._items.append(item)
+            self._accepted += 1
+            if len(self._items) >= self.batch_size:
+                self._cond.notify()
+        return ingest_id
+
+    # ---------------- flusher ----------------
+
+    def _run(self):
+        while True:
+            with self._cond:
+                deadline = time.monotonic() + self.flush_interval
+                while not self._stopping and len(self._items) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                stopping = self._stopping
+                if not self._items:
+                    if stopping:
+                        return
+                    continue
+                # Drain everything queued so far; new submits go to a fresh spill file
+                batch = list(self._items)
+                self._items.clear()
+                flushing_path = self._rotate_spill()
+
+            try:
+                self.write_batch(batch)
+            except Exception as e:
+                with self._cond:
+                    self._failures += 1
+                    self._last_error = str(e)
+                print(f"❌ Write-behind flush of {len(batch)} events failed: {e}")
+                retry = batch if isinstance(e, self.transient_errors) else self._write_each(batch, e)
+                if retry:
+                    with self._cond:
+                        # Put the rest back in front; its .flushing file stays on disk
+                        # and the next rotation appends newer events to it
+                        self._items.extendleft(reversed(retry))
+                    if flushing_path and retry is not batch:
+                        self._rewrite_spill(flushing_path, retry)
+                    if stopping:
+                        return
+                    time.sleep(self.retry_delay)
+                    continue
+            else:
+                with self._cond:
+                    self._flushed += len(batch)
+                    self._flushes += 1
+                    if self._attempts:
+                        for ingest_id, _, _ in batch:
+                            self._attempts.pop(ingest_id, None)
+            if flushing_path and os.path.exists(flushing_path):
+                os.remove(flushing_path)
+
+    def _write_each(self, batch, error):
+        """
+        Write a batch that failed with `error` one event per transaction.
+        Returns the events to retry later.
+        """
+        if len(batch) == 1:
+            return self._failed(batch[0], error)
+        retry = []
+        for index, item in enumerate(batch):
+            try:
+                self.write_batch([item])
+            except Exception as e:
+                if isinstance(e, self.transient_errors):
+                    # The database went away; try the rest later as a batch
+                    retry.extend(batch[index:])
+                    break
+                retry.extend(self._failed(item, e))
+                continue
+            with self._cond:
+                self._attempts.pop(item[0], None)
+                self._flushed += 1
+        return retry
+
+    def _failed(self, item, error):
+        """Count a failed write of `item`: [item] to retry it, [] once dead-lettered"""
+        with self._cond:
+            attempts = self._attempts[item[0]] = self._attempts.get(item[0], 0) + 1
+        if attempts < self.max_attempts:
+            return [item]
+        self._dead_letter(item, error)
+        return []
+
+    def _dead_letter(self, item, error):
+        ingest_id, user_id, event = item
+        with self._cond:
+            self._attempts.pop(ingest_id, None)
+            self._dead_lettered += 1
+        record = json.dumps({'id': ingest_id, 'user_id': user_id, 'event': event,
+                             'error': str(error).strip(), 'at': time.time()})
+        print(f"☠️  Dead-lettered metrics event {ingest_id} after {self.max_attempts} attempts: {error}")
+        if not self.spill_dir:
+            print(record)
+            return
+        with open(os.path.join(self.spill_dir, DEAD_LETTER_FILE), 'a', encoding='utf-8') as f:
+            f.write(record + '\n')
+
+    def flush_now(self):
+        """Wake the flusher immediately"""
+        with self._cond:
+            self._cond.notify()
+
+    # ---------------- spill file ----------------
+
+    def _spill_path(self, suffix=''):
+        return os.path.join(self.spill_dir, f'metrics-{os.getpid()}{suffix}.jsonl')
+
+    def _spill_record(self, item):
+        ingest_id, user_id, event = item
+        record = {'id': ingest_id, 'user_id': user_id, 'event': event}
+        attempts = self._attempts.get(ingest_id)
+        if attempts:
+            record['attempts'] = attempts
+        return json.dumps(record) + '\n'
+
+    def _append_spill(self, items):
+        if self._spill is None:
+            return
+        for item in items:
+            self._spill.write(self._spill_record(item))
+        # Flush to the OS so queued events survive a process crash
+        self._spill.flush()
+
+    def _rewrite_spill(self, flushing_path, items):
+        """Replace the .flushing file with the events still to be written"""
+        with self._cond:
+            lines = [self._spill_record(item) for item in items]
+        tmp = f'{flushing_path}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+        os.replace(tmp, flushing_path)
+
+    def _rotate_spill(self):
+        """Move the active spill file aside for the batch being flushed (lock held)"""
+        if self._spill is None:
+            return None
+        self._spill.close()
+        flushing_path = self._spill_path('.flushing')
+        if os.path.exists(flushing_path):
+            # A previous failed flush is still pending; keep both on disk
+            with open(flushing_path, 'a', encoding='utf-8') as out, \
+                    open(self._spill_path(), encoding='utf-8') as src:
+                out.write(src.read())
+            os.remove(self._spill_path())
+        else:
+            os.replace(self._spill_path(), flushing_path)
+        self._spill = open(self._spill_path(), 'a', encoding='utf-8')
+        return flushing_path
+
+    def _recover_orphans(self):
+        """Replay spill files left behind by processes that are no longer running"""
+        recovered = 0
+        for name in sorted(os.listdir(self.spill_dir)):
+            match = SPILL_FILE_PATTERN.match(name)
+            if not match:
+                continue
+            pid = int(match.group(1))
+            if pid == os.getpid() or _pid_alive(pid):
+                continue
+            claimed = os.path.join(self.spill_dir, f'metrics-{os.getpid()}-recovered-{pid}.jsonl')
+            try:
+                # Atomic claim: only one starting worker wins each orphan file
+                os.rename(os.path.join(self.spill_dir, name), claimed)
+            except OSError:
+                continue
+            items = []
+            attempts = {}
+            with open(claimed, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        items.append((record['id'], record['user_id'], record['event']))
+                    except (ValueError, KeyError):
+                        continue  # torn final line from the crash
+                    if record.get('attempts'):
+                        attempts[record['id']] = record['attempts']
+            with self._cond:
+                self._attempts.update(attempts)
+                self._append_spill(items)
+                self._items.extend(items)
+                self._cond.notify()
+            os.remove(claimed)
+            recovered += len(items)
+        if recovered:
+            print(f"♻️  Recovered {recovered} queued metrics events from spill files")
+
+    # ---------------- introspection ----------------
+
+    def stats(self):
+        with self._cond:
+            return {
+                'queued': len(self._items),
+                'capacity': self.max_size,
+                'accepted': self._accepted,
+                'rejected': self._rejected,
+                'flushed': self._flushed,
+                'flushes': self._flushes,
+                'failures': self._failures,
+                'dead_lettered': self._dead_lettered,
+                'last_error': self._last_error,
+            }
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
@@ -0,0 +1,6 @@
+"""
+Code shared by the Flask services (calculator, suggestion, extension backend).
+
+Services outside flask/ put flask/ on sys.path to import it; Docker images
+copy this package next to the service code.
+"""
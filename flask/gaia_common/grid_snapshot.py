@@ -0,0 +1,299 @@
+"""
+Per-zone grid carbon intensity shared by every worker process on a host.
+
+One refresher process (started from the gunicorn master, see the services'
+gunicorn.conf.py) fetches each zone upstream and publishes the readings into
+a fixed-layout multiprocessing.shared_memory segment. Workers read it without
+locks or network I/O, so upstream call volume no longer grows with the
+number of workers.
+
+Writes are guarded by a sequence counter (seqlock): it is odd while the
+refresher is writing and even once a write is complete. A reader copies the
+segment and keeps the copy only if the counter was even and unchanged, so it
+never sees a half-written snapshot. Parsed snapshots are cached per sequence
+number; a lookup costs one 8-byte read when nothing changed.
+
+Workers and the refresher are forked from the process that created the
+segment, so they share its multiprocessing resource tracker and attaching
+never causes the segment to be unlinked when one of them exits.
+
+Layout (little-endian):
+    header  magic '4s', layout version I, capacity I, count I, sequence Q, published_at d
+    slot    zone 32s, measured_at 32s, carbon_intensity d, fossil_free_percentage d,
+            renewable_percentage d, fetched_at d, flags I, 4 pad bytes
+"""
+
+import logging
+import math
+import os
+import signal
+import struct
+import threading
+import time
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'GRID'
+LAYOUT_VERSION = 1
+DEFAULT_CAPACITY = 256
+
+HEADER = struct.Struct('<4sIIIQd')
+SLOT = struct.Struct('<32s32s4dI4x')
+SEQUENCE = struct.Struct('<Q')
+SEQUENCE_OFFSET = 16
+COUNT_OFFSET = 12
+PUBLISHED_OFFSET = 24
+
+FLAG_ESTIMATE = 1
+
+REFRESHER_DEFAULT_SIGNALS = [
+    signal.SIGHUP, signal.SIGQUIT, signal.SIGINT, signal.SIGTERM, signal.SIGTTIN,
+    signal.SIGTTOU, signal.SIGUSR1, signal.SIGUSR2, signal.SIGWINCH, signal.SIGCHLD,
+]
+
+ZoneReading = namedtuple('ZoneReading', [
+    'zone',
+    'carbon_intensity',
+    'fossil_free_percentage',
+    'renewable_percentage',
+    'measured_at',
+    'fetched_at',
+    'is_estimate',
+])
+
+
+def segment_size(capacity):
+    return HEADER.size + capacity * SLOT.size
+
+
+def _encode(text):
+    return (text or '').encode('utf-8')[:32]
+
+
+def _decode(raw):
+    return raw.rstrip(b'\0').decode('utf-8', 'replace') or None
+
+
+def _number(value):
+    return math.nan if value is None else float(value)
+
+
+def _optional(value):
+    return None if math.isnan(value) else value
+
+
+class GridSnapshotWriter:
+    """Publishes readings into a segment (the only process that writes to it)"""
+
+    def __init__(self, shm):
+        self.name = shm.name
+        self.capacity = HEADER.unpack_from(shm.buf, 0)[2]
+        self._shm = shm
+
+    @classmethod
+    def create(cls, name, capacity=DEFAULT_CAPACITY):
+        size = segment_size(capacity)
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # Left behind by a master that was killed; nobody else can own it
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        HEADER.pack_into(shm.buf, 0, MAGIC, LAYOUT_VERSION, capacity, 0, 0, 0.0)
+        return cls(shm)
+
+    @classmethod
+    def attach(cls, name):
+        return cls(shared_memory.SharedMemory(name=name))
+
+    def publish(self, readings):
+        """Replace the snapshot with `readings` (ZoneReading iterable)"""
+        readings = list(readings)[:self.capacity]
+        buf = self._shm.buf
+        sequence = SEQUENCE.unpack_from(buf, SEQUENCE_OFFSET)[0]
+        SEQUENCE.pack_into(buf, SEQUENCE_OFFSET, sequence + 1)  # odd: write in progress
+        for index, reading in enumerate(readings):
+            SLOT.pack_into(
+                buf, HEADER.size + index * SLOT.size,
+                _encode(reading.zone),
+                _encode(reading.measured_at),
+                _number(reading.carbon_intensity),
+                _number(reading.fossil_free_percentage),
+                _number(reading.renewable_percentage),
+                reading.fetched_at,
+                FLAG_ESTIMATE if reading.is_estimate else 0
+            )
+        struct.pack_into('<I', buf, COUNT_OFFSET, len(readings))
+        struct.pack_into('<d', buf, PUBLISHED_OFFSET, time.time())
+        SEQUENCE.pack_into(buf, SEQUENCE_OFFSET, sequence + 2)
+
+    def close(self, unlink=True):
+        self._shm.close()
+        if unlink:
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+class GridSnapshotReader:
+    """
+    Lock-free view of a published snapshot. Safe to share between threads.
+    get() returns None when there is no segment (e.g. not running under the
+    gunicorn config), the zone is missing, or its reading is older than max_age.
+    """
+
+    # How often to look for the segment again while it doesn't exist
+    ATTACH_RETRY_SECONDS = 5.0
+    READ_ATTEMPTS = 8
+
+    def __init__(self, name, max_age=900.0):
+        self.name = name
+        self.max_age = max_age
+        self._shm = None
+        self._capacity = 0
+        self._next_attach = 0.0
+        self._attach_lock = threading.Lock()
+        # (sequence, {zone: ZoneReading}) replaced atomically
+        self._view = (None, {})
+
+    def _attach(self):
+        now = time.monotonic()
+        if now < self._next_attach:
+            return None
+        with self._attach_lock:
+            if self._shm is not None:
+                return self._shm
+            try:
+                shm = shared_memory.SharedMemory(name=self.name)
+            except (FileNotFoundError, ValueError):
+                self._next_attach = now + self.ATTACH_RETRY_SECONDS
+                return None
+            magic, version, capacity = HEADER.unpack_from(shm.buf, 0)[:3]
+            if magic != MAGIC or version != LAYOUT_VERSION:
+                logger.warning(f"Grid snapshot {self.name} has an unknown layout, ignoring it")
+                shm.close()
+                self._next_attach = now + self.ATTACH_RETRY_SECONDS
+                return None
+            self._capacity = capacity
+            self._shm = shm
+            return shm
+
+    def _parse(self, data):
+        count = min(struct.unpack_from('<I', data, COUNT_OFFSET)[0], (len(data) - HEADER.size) // SLOT.size)
+        zones = {}
+        for index in range(count):
+            zone, measured_at, intensity, fossil_free, renewable, fetched_at, flags = \
+                SLOT.unpack_from(data, HEADER.size + index * SLOT.size)
+            zone = _decode(zone)
+            zones[zone] = ZoneReading(
+                zone,
+                _optional(intensity),
+                _optional(fossil_free),
+                _optional(renewable),
+                _decode(measured_at),
+                fetched_at,
+                bool(flags & FLAG_ESTIMATE)
+            )
+        return zones
+
+    def snapshot(self):
+        """{zone: ZoneReading} of the latest complete snapshot (may be empty)"""
+        shm = self._shm or self._attach()
+        if shm is None:
+            return {}
+        buf = shm.buf
+        view = self._view
+        for _ in range(self.READ_ATTEMPTS):
+            before = SEQUENCE.unpack_from(buf, SEQUENCE_OFFSET)[0]
+            if before == view[0]:
+                return view[1]
+            if before & 1:
+                time.sleep(0)
+                continue
+            count = struct.unpack_from('<I', buf, COUNT_OFFSET)[0]
+            data = bytes(buf[:HEADER.size + min(count, self._capacity) * SLOT.size])
+            if SEQUENCE.unpack_from(buf, SEQUENCE_OFFSET)[0] == before:
+                view = (before, self._parse(data))
+                self._view = view
+                return view[1]
+        # Writer kept racing us; the previous complete snapshot is still valid
+        return view[1]
+
+    def get(self, zone):
+        reading = self.snapshot().get(zone)
+        if reading is None or time.time() - reading.fetched_at > self.max_age:
+            return None
+        return reading
+
+    def stats(self):
+        sequence, zones = self._view
+        return {
+            'name': self.name,
+            'attached': self._shm is not None,
+            'version': sequence // 2 if sequence else 0,
+            'zones': len(zones),
+        }
+
+
+def run_refresher(name, zones, fetch, interval, parent_pid):
+    """
+    Refresher loop: fetch every zone, publish the readings, sleep `interval`.
+    `fetch(zone)` returns a ZoneReading or None; a failed zone keeps its last
+    good reading until it is older than the readers' max_age.
+    """
+    writer = GridSnapshotWriter.attach(name)
+    latest = {}
+    while os.getppid() == parent_pid:
+        started = time.monotonic()
+        for zone in zones:
+            try:
+                reading = fetch(zone)
+            except Exception as e:
+                logger.warning(f"Grid snapshot fetch failed for {zone}: {e}")
+                continue
+            if reading is not None:
+                latest[zone] = reading
+        writer.publish(latest.values())
+        logger.info(f"Grid snapshot {name}: published {len(latest)}/{len(zones)} zones")
+        # Sleep in short steps so an orphaned refresher exits promptly
+        next_round = started + max(1.0, interval)
+        while time.monotonic() < next_round and os.getppid() == parent_pid:
+            time.sleep(min(1.0, next_round - time.monotonic()))
+    writer.close(unlink=False)
+
+
+class GridRefresher:
+    """Snapshot segment plus its refresher process, owned by the gunicorn master"""
+
+    def __init__(self, name, zones, fetch, interval=300.0, capacity=DEFAULT_CAPACITY):
+        zones = sorted(set(zones))
+        if len(zones) > capacity:
+            raise ValueError(f"{len(zones)} zones do not fit a snapshot of capacity {capacity}")
+        self.writer = GridSnapshotWriter.create(name, capacity)
+        parent_pid = os.getpid()
+        # A bare fork rather than multiprocessing.Process: workers forked later
+        # would inherit it as a "child" and terminate it when they exit
+        self.pid = os.fork()
+        if self.pid == 0:
+            # Don't run the gunicorn master's signal handlers in this process
+            for signum in REFRESHER_DEFAULT_SIGNALS:
+                signal.signal(signum, signal.SIG_DFL)
+            try:
+                run_refresher(name, zones, fetch, interval, parent_pid)
+            except Exception as e:
+                logger.error(f"Grid snapshot refresher for {name} crashed: {e}")
+            finally:
+                os._exit(0)
+
+    def stop(self):
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+            os.waitpid(self.pid, 0)
+        except (ProcessLookupError, ChildProcessError):
+            pass  # already exited (and possibly reaped by the gunicorn master)
+        self.writer.close(unlink=True)
@@ -0,0 +1,560 @@
+"""
+Prometheus-style runtime metrics for the Flask services.
+
+instrument_app(app) adds per-route request counts, latency histograms and an
+in-flight gauge, and serves everything in the text exposition format at
+/metrics. Services record upstream calls with `upstream_call`, cache lookups
+with CACHE_EVENTS and batch sizes with BATCH_SIZE. They expose the stats()
+of pools, queues and caches they already have with StatsCollector.
+
+Recording never takes a lock. Each thread updates its own cells, and a
+scrape adds up all threads' cells. Label children are created once, so a hot
+path that binds them up front (`HIT = CACHE_EVENTS.labels('x', 'hit')`)
+only does a list increment per event. Cells of threads that have exited are
+folded into one retired cell, so the dev server's thread-per-request model
+does not grow memory.
+
+Values are per process. With several gunicorn workers, set GAIA_METRICS_DIR
+(the services' gunicorn.conf.py do this) and a MultiProcessStore combines
+them: every worker writes a snapshot of its values to that directory every
+GAIA_METRICS_FLUSH_SECONDS, and a scrape adds its own live values to the
+other workers' snapshots. Counters and histograms of workers that have
+exited are kept, so totals never go backwards and rate() stays right;
+gauges only count live workers. StatsCollector values describe one
+process's pool or queue, so they get a `pid` label instead of being added.
+"""
+
+import atexit
+import bisect
+import glob
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+
+from .tracing import span
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class _ThreadCells:
+    """A row of numeric cells per thread; each thread writes only its own row"""
+
+    __slots__ = ('size', '_local', '_lock', '_rows', '_retired')
+
+    def __init__(self, size):
+        self.size = size
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._rows = []
+        self._retired = [0] * size
+
+    def mine(self):
+        try:
+            return self._local.row
+        except AttributeError:
+            row = [0] * self.size
+            with self._lock:
+                # Rows of exited threads can't change any more; fold them in
+                alive = []
+                for thread, other in self._rows:
+                    if thread.is_alive():
+                        alive.append((thread, other))
+                    else:
+                        self._retired = [a + b for a, b in zip(self._retired, other)]
+                alive.append((threading.current_thread(), row))
+                self._rows = alive
+            self._local.row = row
+            return row
+
+    def totals(self):
+        with self._lock:
+            totals = list(self._retired)
+            rows = [row for _, row in self._rows]
+        for row in rows:
+            for index, value in enumerate(row):
+                totals[index] += value
+        return totals
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+class Registry:
+    """The collectors rendered by one /metrics endpoint"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._collectors = []
+        self.store = None  # MultiProcessStore combining gunicorn workers
+
+    def register(self, collector):
+        with self._lock:
+            self._collectors.append(collector)
+        return collector
+
+    def collect(self):
+        """This process's current values: [family], see _Metric.collect"""
+        with self._lock:
+            collectors = list(self._collectors)
+        families = []
+        for collector in collectors:
+            family = collector.collect()
+            if family is not None:
+                families.append(family)
+        return families
+
+    def render(self):
+        families = self.collect()
+        if self.store is not None:
+            families = self.store.merge(families)
+        lines = []
+        for family in families:
+            lines.extend(_render_family(family))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+        registry.register(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _value(self, child):
+        raise NotImplementedError
+
+    def collect(self):
+        """
+        {name, kind, help, labelnames, samples: [(label values, value)]}; a
+        histogram's value is (bucket counts, sum) and it also has `bounds`
+        """
+        return {
+            'name': self.name,
+            'kind': self.kind,
+            'help': self.documentation,
+            'labelnames': self.labelnames,
+            'samples': [(values, self._value(child)) for values, child in list(self._children.items())],
+        }
+
+
+class _Value:
+    __slots__ = ('_cells',)
+
+    def __init__(self):
+        self._cells = _ThreadCells(1)
+
+    def inc(self, amount=1):
+        self._cells.mine()[0] += amount
+
+    def dec(self, amount=1):
+        self._cells.mine()[0] -= amount
+
+    def value(self):
+        return self._cells.totals()[0]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._children[()].inc(amount)
+
+    def _value(self, child):
+        return child.value()
+
+
+class Gauge(Counter):
+    """Up/down value (inc/dec from any thread; the scrape sees the sum)"""
+
+    kind = 'gauge'
+
+    def dec(self, amount=1):
+        self._children[()].dec(amount)
+
+
+class _HistogramValue:
+    __slots__ = ('bounds', '_cells')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # one cell per bucket (the last is +Inf), then the sum
+        self._cells = _ThreadCells(len(bounds) + 2)
+
+    def observe(self, value):
+        row = self._cells.mine()
+        row[bisect.bisect_left(self.bounds, value)] += 1
+        row[-1] += value
+
+    def snapshot(self):
+        totals = self._cells.totals()
+        return totals[:-1], totals[-1]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.bounds)
+
+    def observe(self, value):
+        self._children[()].observe(value)
+
+    def _value(self, child):
+        return child.snapshot()
+
+    def collect(self):
+        family = super().collect()
+        family['bounds'] = self.bounds
+        return family
+
+
+def _render_family(family):
+    name = family['name']
+    labelnames = family['labelnames']
+    lines = [f'# HELP {name} {family["help"]}', f'# TYPE {name} {family["kind"]}']
+    if family['kind'] != 'histogram':
+        for values, value in family['samples']:
+            lines.append(f'{name}{_labels(labelnames, values)} {_number(value)}')
+        return lines
+
+    for values, (counts, total) in family['samples']:
+        cumulative = 0
+        for bound, count in zip(tuple(family['bounds']) + (math.inf,), counts):
+            cumulative += count
+            le = f'le="{_number(float(bound))}"'
+            lines.append(f'{name}_bucket{_labels(labelnames, values, le)} {cumulative}')
+        labels = _labels(labelnames, values)
+        lines.append(f'{name}_sum{labels} {_number(float(total))}')
+        lines.append(f'{name}_count{labels} {cumulative}')
+    return lines
+
+
+class StatsCollector:
+    """
+    Gauges read at scrape time from an existing stats() dict, one sample per
+    numeric entry: name{stat="in_use"} 3. Nested dicts become stat="a_b";
+    strings and None are skipped, booleans are 0/1.
+    """
+
+    def __init__(self, name, documentation, stats, registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.stats = stats
+        registry.register(self)
+
+    @staticmethod
+    def _flatten(stats, prefix=''):
+        for key, value in stats.items():
+            key = f'{prefix}{key}'
+            if isinstance(value, dict):
+                yield from StatsCollector._flatten(value, f'{key}_')
+            elif isinstance(value, bool):
+                yield key, int(value)
+            elif isinstance(value, (int, float)):
+                yield key, value
+
+    def collect(self):
+        try:
+            stats = self.stats()
+        except Exception:
+            return None
+        if not stats:
+            return None
+        return {
+            'name': self.name,
+            'kind': 'gauge',
+            'help': self.documentation,
+            'labelnames': ('stat',),
+            'samples': [((key,), value) for key, value in self._flatten(stats)],
+            'per_process': True,
+        }
+
+
+class MultiProcessStore:
+    """
+    Combines the metrics of the worker processes of one server through
+    snapshot files in `path` (one JSON file per process, replaced atomically).
+    Each process writes its snapshot every `interval` seconds and at exit, so
+    a scrape sees the other workers' values at most `interval` seconds old.
+    Clear the directory when the server starts (clear_directory) and call
+    mark_process_dead() when a worker exits.
+    """
+
+    def __init__(self, path, registry=REGISTRY, interval=5.0):
+        self.path = path
+        self.registry = registry
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        os.makedirs(self.path, exist_ok=True)
+        self.registry.store = self
+        self._start_thread()
+        # A gunicorn master that imported the app forks workers with the store
+        # already set up, but without its thread
+        os.register_at_fork(after_in_child=self._start_thread)
+        atexit.register(self.stop)
+        return self
+
+    def _start_thread(self):
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='metrics-store', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        try:
+            self.write()
+        except OSError:
+            pass
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                print(f"⚠️  Could not write metrics snapshot: {e}")
+
+    def _file(self, pid):
+        return os.path.join(self.path, f'metrics-{pid}.json')
+
+    def write(self):
+        """Snapshot this process's values for the other workers' scrapes"""
+        payload = json.dumps({'pid': os.getpid(), 'families': self.registry.collect()})
+        fd, temp = tempfile.mkstemp(dir=self.path, prefix='.metrics-', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(payload)
+            os.replace(temp, self._file(os.getpid()))
+        except BaseException:
+            try:
+                os.unlink(temp)
+            except OSError:
+                pass
+            raise
+
+    def _snapshots(self):
+        """[(pid, alive, families)] of the other processes"""
+        snapshots = []
+        own = self._file(os.getpid())
+        for path in glob.glob(os.path.join(self.path, 'metrics-*.json')):
+            if path == own:
+                continue
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue  # removed or replaced while listing
+            alive = '-dead-' not in os.path.basename(path) and _pid_alive(data['pid'])
+            snapshots.append((data['pid'], alive, data['families']))
+        return snapshots
+
+    def merge(self, families):
+        """This process's live `families` combined with every other process's snapshot"""
+        merged = {}
+        for pid, alive, process_families in [(os.getpid(), True, families)] + self._snapshots():
+            for family in process_families:
+                per_process = family.get('per_process', False)
+                if not alive and (per_process or family['kind'] == 'gauge'):
+                    continue  # a gauge of an exited process is no longer true
+                target = merged.get(family['name'])
+                if target is None:
+                    target = merged[family['name']] = dict(
+                        family,
+                        labelnames=tuple(family['labelnames']) + (('pid',) if per_process else ()),
+                        samples={}
+                    )
+                samples = target['samples']
+                for values, value in family['samples']:
+                    values = tuple(values) + ((str(pid),) if per_process else ())
+                    if per_process or values not in samples:
+                        samples[values] = value
+                    elif family['kind'] == 'histogram':
+                        counts, total = samples[values]
+                        samples[values] = ([a + b for a, b in zip(counts, value[0])], total + value[1])
+                    else:
+                        samples[values] = samples[values] + value
+        for family in merged.values():
+            family['samples'] = list(family['samples'].items())
+        return list(merged.values())
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def clear_directory(path):
+    """Remove the snapshots of a previous server run (call from the master at start)"""
+    os.makedirs(path, exist_ok=True)
+    for stale in glob.glob(os.path.join(path, '*metrics-*')):
+        try:
+            os.unlink(stale)
+        except OSError:
+            pass
+
+
+def mark_process_dead(path, pid):
+    """
+    Keep an exited worker's counters and histograms, drop its gauges. The
+    file is renamed so a later process reusing the pid doesn't replace it.
+    """
+    live = os.path.join(path, f'metrics-{pid}.json')
+    try:
+        os.replace(live, os.path.join(path, f'metrics-{pid}-dead-{time.time_ns()}.json'))
+    except OSError:
+        pass
+
+
+# ---- metrics shared by every service ----
+
+HTTP_REQUESTS = Counter('gaia_http_requests_total', 'HTTP requests by route, method and status',
+                        ('route', 'method', 'status'))
+HTTP_LATENCY = Histogram('gaia_http_request_duration_seconds', 'HTTP request latency by route',
+                         ('route', 'method'))
+HTTP_IN_FLIGHT = Gauge('gaia_http_requests_in_flight', 'HTTP requests being served')
+UPSTREAM_CALLS = Counter('gaia_upstream_requests_total', 'Calls to upstream APIs by endpoint and outcome',
+                         ('endpoint', 'outcome'))
+UPSTREAM_LATENCY = Histogram('gaia_upstream_request_duration_seconds', 'Upstream API call latency by endpoint',
+                             ('endpoint',))
+CACHE_EVENTS = Counter('gaia_cache_events_total', 'Cache lookups by cache and result (hit, miss, stale)',
+                       ('cache', 'result'))
+BATCH_SIZE = Histogram('gaia_batch_size', 'Items per batch by batch kind', ('batch',), buckets=SIZE_BUCKETS)
+
+
+class upstream_call:
+    """
+    Times one upstream call and counts its outcome:
+
+        with upstream_call('electricity_maps.latest'):
+            response = requests.get(...)
+            response.raise_for_status()
+
+    Outcome is ok, http_<status> (errors carrying a response), timeout, or error.
+    In a traced request the call is also an 'upstream' span.
+    """
+
+    __slots__ = ('endpoint', 'started', 'span')
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+
+    def __enter__(self):
+        self.span = span('upstream', endpoint=self.endpoint)
+        self.span.__enter__()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.span.__exit__(exc_type, exc, tb)
+        UPSTREAM_LATENCY.labels(self.endpoint).observe(time.perf_counter() - self.started)
+        if exc_type is None:
+            outcome = 'ok'
+        elif getattr(getattr(exc, 'response', None), 'status_code', None) is not None:
+            outcome = f'http_{exc.response.status_code}'
+        elif issubclass(exc_type, TimeoutError) or exc_type.__name__.endswith('Timeout'):
+            outcome = 'timeout'
+        else:
+            outcome = 'error'
+        UPSTREAM_CALLS.labels(self.endpoint, outcome).inc()
+        return False
+
+
+def instrument_app(app, registry=REGISTRY, path='/metrics', token=None):
+    """
+    Record every request of a Flask app and serve `registry` at `path`.
+    With `token`, /metrics requires `Authorization: Bearer <token>`.
+    Call right after creating the app so the timer starts before other hooks.
+    """
+    from flask import Response, g, request
+
+    def start_timer():
+        g._metrics_started = time.perf_counter()
+        HTTP_IN_FLIGHT.inc()
+
+    def record_status(response):
+        g._metrics_status = response.status_code
+        return response
+
+    def finish_timer(exc):
+        started = g.pop('_metrics_started', None)
+        if started is None:
+            return
+        HTTP_IN_FLIGHT.dec()
+        route = request.url_rule.rule if request.url_rule is not None else '<unmatched>'
+        HTTP_LATENCY.labels(route, request.method).observe(time.perf_counter() - started)
+        status = 500 if exc is not None else g.pop('_metrics_status', 500)
+        HTTP_REQUESTS.labels(route, request.method, str(status)).inc()
+
+    def metrics():
+        if token and request.headers.get('Authorization') != f'Bearer {token}':
+            return Response('Unauthorized\n', status=401, mimetype='text/plain')
+        return Response(registry.render(), content_type=CONTENT_TYPE)
+
+    # Several gunicorn workers: combine their values (see MultiProcessStore)
+    store_path = os.getenv('GAIA_METRICS_DIR')
+    if store_path and registry.store is None:
+        MultiProcessStore(
+            store_path, registry, interval=float(os.getenv('GAIA_METRICS_FLUSH_SECONDS', 5))
+        ).start()
+
+    app.before_request_funcs.setdefault(None, []).insert(0, start_timer)
+    app.after_request(record_status)
+    app.teardown_request(finish_timer)
+    app.add_url_rule(path, 'metrics', metrics, methods=['GET'])
@@ -0,0 +1,82 @@
+"""
+Per-key in-flight deduplication of expensive calls ("singleflight").
+
+When a cache entry expires, every request thread that misses at the same time
+would call upstream for the same key. With SingleFlight.do() the first caller
+runs the fetch and concurrent callers for the same key wait for its result
+(or its exception) instead, up to a deadline. Counters show how many calls
+were coalesced.
+"""
+
+import threading
+
+
+class SingleFlightTimeout(TimeoutError):
+    """A coalesced caller gave up waiting for the in-flight call"""
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesce concurrent calls per key within this process"""
+
+    def __init__(self, timeout=10.0):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._executions = 0
+        self._coalesced = 0
+        self._timeouts = 0
+
+    def do(self, key, fn, timeout=None):
+        """
+        Return fn() for `key`, sharing one execution between concurrent callers.
+        Waiters raise SingleFlightTimeout after `timeout` seconds (default: the
+        instance timeout); the in-flight call itself is never interrupted.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self._executions += 1
+            else:
+                self._coalesced += 1
+
+        if not leader:
+            if not call.done.wait(self.timeout if timeout is None else timeout):
+                with self._lock:
+                    self._timeouts += 1
+                raise SingleFlightTimeout(f"Timed out waiting for in-flight call {key!r}")
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            calls = self._executions + self._coalesced
+            return {
+                'in_flight': len(self._calls),
+                'executions': self._executions,
+                'coalesced': self._coalesced,
+                'timeouts': self._timeouts,
+                'coalescing_rate': round(self._coalesced / calls, 4) if calls else 0.0,
+            }
@@ -0,0 +1,94 @@
+"""
+TTL cache that is safe to share between request threads.
+
+cachetools caches are not thread-safe: even a lookup can expire and remove
+entries, so concurrent use from gthread workers corrupts them. Rather than
+one lock around the whole cache, keys are spread over independent stripes,
+each a cachetools cache with its own lock. Threads that look up different zones
+rarely wait on each other, and a lock is only held for one dict operation.
+
+Entries remember when they were stored (wall clock), so a cache restored
+from a warm-cache snapshot expires them at their original time.
+"""
+
+import threading
+import time
+
+from cachetools import TLRUCache
+
+DEFAULT_STRIPES = 8
+
+
+class StripedTTLCache:
+    """TTL cache split into `stripes` independently locked shards"""
+
+    def __init__(self, maxsize, ttl, stripes=DEFAULT_STRIPES):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # Each stripe gets an equal share of maxsize (rounded up). Values are
+        # stored as (value, stored_at) and expire ttl seconds after stored_at.
+        per_stripe = max(1, -(-maxsize // stripes))
+        self._stripes = [
+            (threading.Lock(), TLRUCache(maxsize=per_stripe, ttu=self._expires, timer=time.time))
+            for _ in range(stripes)
+        ]
+
+    def _expires(self, key, entry, now):
+        return entry[1] + self.ttl
+
+    def _stripe(self, key):
+        return self._stripes[hash(key) % len(self._stripes)]
+
+    def get(self, key, default=None):
+        lock, cache = self._stripe(key)
+        with lock:
+            entry = cache.get(key)
+        return default if entry is None else entry[0]
+
+    def __getitem__(self, key):
+        lock, cache = self._stripe(key)
+        with lock:
+            return cache[key][0]
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def set(self, key, value, stored_at=None):
+        """Store `value`; an already expired `stored_at` stores nothing"""
+        lock, cache = self._stripe(key)
+        with lock:
+            cache[key] = (value, time.time() if stored_at is None else stored_at)
+
+    def __delitem__(self, key):
+        lock, cache = self._stripe(key)
+        with lock:
+            del cache[key]
+
+    def __contains__(self, key):
+        lock, cache = self._stripe(key)
+        with lock:
+            return key in cache
+
+    def __len__(self):
+        total = 0
+        for lock, cache in self._stripes:
+            with lock:
+                total += len(cache)
+        return total
+
+    def items(self):
+        """Snapshot of the live (key, value) pairs, one stripe at a time"""
+        return [(key, value) for key, _, value in self.stamped_items()]
+
+    def stamped_items(self):
+        """Snapshot of the live entries as (key, stored_at, value)"""
+        entries = []
+        for lock, cache in self._stripes:
+            with lock:
+                entries.extend((key, stored_at, value) for key, (value, stored_at) in cache.items())
+        return entries
+
+    def clear(self):
+        for lock, cache in self._stripes:
+            with lock:
+                cache.clear()
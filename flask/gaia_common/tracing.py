@@ -0,0 +1,347 @@
+"""
+Per-request span timing, on-demand profiling and request IDs.
+
+trace_app(app) gives every request an ID: the caller's X-Request-ID if it
+sent a valid one, otherwise a new one. The ID is echoed in the response and
+available to logging through RequestIdFilter, so a Node worker call can be
+matched with the Flask log lines and trace it produced.
+
+A request is traced when it is sampled (`sample_rate`) or sends
+`X-Gaia-Trace: 1` together with the debug token. Code marks its stages with
+
+    with span('cache_lookup', zone=zone):
+        ...
+
+which costs one context-variable read when the request is not traced. Every
+trace is kept for GET /debug/traces/<request_id>. Only a trace the caller
+asked for with the token comes back in the X-Gaia-Trace response header:
+spans can carry SQL previews with bound values, so a sampled trace is
+stored, never echoed to whoever happened to send the request.
+
+With a debug token configured, `X-Gaia-Profile: cpu` or `memory` plus
+`X-Gaia-Debug-Token` also captures a cProfile (top functions by cumulative
+time) or tracemalloc (top allocation sites) report for that one request.
+tracemalloc is process-wide, so a memory capture also counts allocations
+by requests served at the same time. Only one capture of each kind runs at a
+time per process. Traces and profiles are kept per process, so with several
+workers a /debug lookup must reach the worker named in X-Gaia-Trace-Pid.
+"""
+
+import contextvars
+import cProfile
+import functools
+import hmac
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import re
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import OrderedDict
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+TRACE_HEADER = 'X-Gaia-Trace'
+PROFILE_HEADER = 'X-Gaia-Profile'
+DEBUG_TOKEN_HEADER = 'X-Gaia-Debug-Token'
+
+VALID_REQUEST_ID = re.compile(r'^[A-Za-z0-9._:-]{1,128}$')
+
+PROFILE_LINES = 40
+
+_request_id = contextvars.ContextVar('gaia_request_id', default=None)
+_trace = contextvars.ContextVar('gaia_trace', default=None)
+
+
+def current_request_id():
+    """The ID of the request being served by this thread, or None"""
+    return _request_id.get()
+
+
+class RequestIdFilter(logging.Filter):
+    """Adds %(request_id)s to log records ('-' outside a request)"""
+
+    def filter(self, record):
+        record.request_id = _request_id.get() or '-'
+        return True
+
+
+def debug_authorized(debug_token):
+    """Whether the current request sent `debug_token` (never true without one)"""
+    from flask import request
+
+    supplied = request.headers.get(DEBUG_TOKEN_HEADER, '')
+    return bool(debug_token) and hmac.compare_digest(supplied.encode(), debug_token.encode())
+
+
+class Span:
+    __slots__ = ('name', 'attrs', 'started', 'duration', 'children')
+
+    def __init__(self, name, attrs=None):
+        self.name = name
+        self.attrs = attrs
+        self.started = time.perf_counter()
+        self.duration = None
+        self.children = []
+
+    def to_dict(self, origin):
+        node = {
+            'name': self.name,
+            'start_ms': round((self.started - origin) * 1000, 3),
+            'ms': round(self.duration * 1000, 3) if self.duration is not None else None,
+        }
+        if self.attrs:
+            node['attrs'] = {key: str(value) for key, value in self.attrs.items()}
+        if self.children:
+            node['children'] = [child.to_dict(origin) for child in self.children]
+        return node
+
+
+class Trace:
+    """Span tree of one request"""
+
+    def __init__(self, request_id, name):
+        self.request_id = request_id
+        self.created_at = time.time()
+        self.root = Span(name)
+        self.stack = [self.root]
+        self.profile = None
+
+    def finish(self):
+        self.root.duration = time.perf_counter() - self.root.started
+
+    def to_dict(self):
+        return {
+            'request_id': self.request_id,
+            'created_at': self.created_at,
+            'pid': os.getpid(),
+            'spans': self.root.to_dict(self.root.started),
+        }
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _ActiveSpan:
+    __slots__ = ('trace', 'span')
+
+    def __init__(self, trace, span):
+        self.trace = trace
+        self.span = span
+
+    def __enter__(self):
+        self.trace.stack[-1].children.append(self.span)
+        self.trace.stack.append(self.span)
+        self.span.started = time.perf_counter()
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        self.span.duration = time.perf_counter() - self.span.started
+        if exc_type is not None:
+            self.span.attrs = dict(self.span.attrs or {}, error=exc_type.__name__)
+        self.trace.stack.pop()
+        return False
+
+
+def span(name, **attrs):
+    """Time a stage of the current request (no-op when it isn't traced)"""
+    trace = _trace.get()
+    if trace is None:
+        return _NULL_SPAN
+    return _ActiveSpan(trace, Span(name, attrs))
+
+
+def traced(name):
+    """Decorator form of span() covering a whole function"""
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TraceStore:
+    """The most recent `keep` finished traces of this process"""
+
+    def __init__(self, keep=200):
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._traces = OrderedDict()
+
+    def add(self, record):
+        with self._lock:
+            self._traces[record['request_id']] = record
+            self._traces.move_to_end(record['request_id'])
+            while len(self._traces) > self.keep:
+                self._traces.popitem(last=False)
+
+    def get(self, request_id):
+        with self._lock:
+            return self._traces.get(request_id)
+
+    def recent(self):
+        with self._lock:
+            records = list(self._traces.values())
+        return [{
+            'request_id': record['request_id'],
+            'created_at': record['created_at'],
+            'name': record['spans']['name'],
+            'ms': record['spans']['ms'],
+            'profile': record.get('profile', {}).get('kind'),
+        } for record in reversed(records)]
+
+
+class Profiler:
+    """One request's cProfile ('cpu') or tracemalloc ('memory') capture"""
+
+    _locks = {'cpu': threading.Lock(), 'memory': threading.Lock()}
+
+    def __init__(self, kind):
+        self.kind = kind
+        self._profile = None
+        self._before = None
+        self.started = self._locks[kind].acquire(blocking=False)
+        if not self.started:
+            return
+        if kind == 'cpu':
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            tracemalloc.start(16)
+            self._before = tracemalloc.take_snapshot()
+
+    def stop(self):
+        if not self.started:
+            return {'kind': self.kind, 'error': 'Another capture of this kind is running'}
+        try:
+            if self.kind == 'cpu':
+                self._profile.disable()
+                out = io.StringIO()
+                pstats.Stats(self._profile, stream=out).sort_stats('cumulative').print_stats(PROFILE_LINES)
+                return {'kind': 'cpu', 'report': out.getvalue()}
+            after = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            top = after.compare_to(self._before, 'lineno')[:PROFILE_LINES]
+            return {
+                'kind': 'memory',
+                'peak_bytes': peak,
+                'report': '\n'.join(str(stat) for stat in top),
+            }
+        finally:
+            self.started = False
+            self._locks[self.kind].release()
+
+
+def trace_app(app, sample_rate=0.0, debug_token=None, keep=200, header_limit=6000):
+    """
+    Install request IDs, tracing and profiling on a Flask app.
+    `debug_token` enables profiling and the /debug/traces endpoints; without
+    it they are off (the endpoints return 404).
+    """
+    from flask import abort, g, jsonify, request
+
+    store = TraceStore(keep)
+
+    # Time response serialization as its own span
+    base_provider = type(app.json)
+
+    class TracedJSONProvider(base_provider):
+        def response(self, *args, **kwargs):
+            with span('serialization'):
+                return super().response(*args, **kwargs)
+
+    app.json = TracedJSONProvider(app)
+
+    def authorized():
+        return debug_authorized(debug_token)
+
+    def start():
+        incoming = request.headers.get(REQUEST_ID_HEADER, '')
+        request_id = incoming if VALID_REQUEST_ID.match(incoming) else uuid.uuid4().hex
+        g.request_id = request_id
+        g._trace_tokens = [(_request_id, _request_id.set(request_id))]
+
+        profile_kind = request.headers.get(PROFILE_HEADER, '').lower()
+        profile_kind = profile_kind if profile_kind in Profiler._locks else None
+        requested = profile_kind is not None or request.headers.get(TRACE_HEADER) == '1'
+        # Spans and profiles only go back to the debug token; anyone else's
+        # request can still be sampled, but is only stored
+        g._trace_echo = requested and authorized()
+        if not g._trace_echo:
+            profile_kind = None
+        traced = g._trace_echo or (sample_rate > 0 and random.random() < sample_rate)
+        if traced:
+            route = request.url_rule.rule if request.url_rule is not None else request.path
+            trace = Trace(request_id, f'{request.method} {route}')
+            g._trace_tokens.append((_trace, _trace.set(trace)))
+            if profile_kind is not None:
+                trace.profile = Profiler(profile_kind)
+
+    def finish(response):
+        request_id = g.get('request_id')
+        if request_id is None:
+            return response
+        response.headers[REQUEST_ID_HEADER] = request_id
+        trace = _trace.get()
+        if trace is None:
+            return response
+
+        trace.finish()
+        record = trace.to_dict()
+        if trace.profile is not None:
+            record['profile'] = trace.profile.stop()
+            trace.profile = None
+        store.add(record)
+        if not g.get('_trace_echo'):
+            return response
+
+        tree = json.dumps(record['spans'], separators=(',', ':'))
+        if len(tree) > header_limit or 'profile' in record:
+            tree = json.dumps({'truncated': len(tree) > header_limit, 'url': f'/debug/traces/{request_id}'})
+        response.headers[TRACE_HEADER] = tree
+        response.headers[f'{TRACE_HEADER}-Pid'] = str(record['pid'])
+        return response
+
+    def cleanup(exc):
+        trace = _trace.get()
+        if trace is not None and trace.profile is not None:
+            trace.profile.stop()
+        for var, token in reversed(g.pop('_trace_tokens', [])):
+            var.reset(token)
+
+    def list_traces():
+        if not authorized():
+            abort(404)
+        return jsonify({'pid': os.getpid(), 'traces': store.recent()})
+
+    def get_trace(request_id):
+        if not authorized():
+            abort(404)
+        record = store.get(request_id)
+        if record is None:
+            abort(404)
+        return jsonify(record)
+
+    app.before_request_funcs.setdefault(None, []).insert(0, start)
+    app.after_request(finish)
+    app.teardown_request(cleanup)
+    app.add_url_rule('/debug/traces', 'debug_traces', list_traces, methods=['GET'])
+    app.add_url_rule('/debug/traces/<request_id>', 'debug_trace', get_trace, methods=['GET'])
+    return store
@@ -0,0 +1,168 @@
+"""
+Warm-cache snapshots: a service's cached upstream data, persisted to local
+disk so a restarted process serves from it instead of starting cold.
+
+A service exports its caches as sections of {key: (stored_at, value)}, with
+JSON-serializable values. WarmCachePersister writes them every `interval`
+seconds and at exit. Gunicorn workers share one file: each save merges with
+what is on disk and keeps the newest entry per key. At startup, the service
+reads the file before serving and restores entries that are still within
+their TTL. It refreshes the rest in the background.
+
+File layout (little-endian):
+    header  magic '4s', format version H, reserved H, written_at d,
+            payload length I, payload crc32 I
+    payload zlib-compressed JSON {section: [[key, stored_at, value], ...]}
+
+Files are written to a temporary name next to the target and renamed over
+it, so readers never see a partial file. A file with another magic, version
+or a bad checksum is ignored.
+"""
+
+import atexit
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'GWCS'
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct('<4sHHdII')
+
+# Entries older than this are dropped when merging, so the file stays small
+DEFAULT_MAX_KEEP_SECONDS = 24 * 3600
+
+WarmSnapshot = namedtuple('WarmSnapshot', ['written_at', 'sections'])
+
+
+def write_snapshot(path, sections):
+    """Atomically replace `path` with `sections` ({name: {key: (stored_at, value)}})"""
+    payload = zlib.compress(json.dumps({
+        name: [[key, stored_at, value] for key, (stored_at, value) in entries.items()]
+        for name, entries in sections.items()
+    }, separators=(',', ':')).encode('utf-8'))
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, 0, time.time(), len(payload), zlib.crc32(payload))
+
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(header)
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def read_snapshot(path):
+    """The WarmSnapshot in `path`, or None if it is missing or unreadable"""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    if len(data) < HEADER.size:
+        return None
+    magic, version, _, written_at, length, crc = HEADER.unpack_from(data, 0)
+    payload = data[HEADER.size:HEADER.size + length]
+    if magic != MAGIC or version != FORMAT_VERSION or len(payload) != length or zlib.crc32(payload) != crc:
+        logger.warning(f"Ignoring warm-cache snapshot {path}: unknown format or corrupt")
+        return None
+    try:
+        raw = json.loads(zlib.decompress(payload))
+    except (zlib.error, ValueError):
+        logger.warning(f"Ignoring warm-cache snapshot {path}: undecodable payload")
+        return None
+    sections = {
+        name: {key: (stored_at, value) for key, stored_at, value in entries}
+        for name, entries in raw.items()
+    }
+    return WarmSnapshot(written_at, sections)
+
+
+def merge_sections(*sources, max_keep=DEFAULT_MAX_KEEP_SECONDS):
+    """Newest entry per (section, key) across `sources`, dropping very old ones"""
+    cutoff = time.time() - max_keep
+    merged = {}
+    for sections in sources:
+        for name, entries in sections.items():
+            target = merged.setdefault(name, {})
+            for key, (stored_at, value) in entries.items():
+                if stored_at >= cutoff and (key not in target or target[key][0] < stored_at):
+                    target[key] = (stored_at, value)
+    return merged
+
+
+class WarmCachePersister:
+    """Saves `export()` to `path` every `interval` seconds and at interpreter exit"""
+
+    def __init__(self, path, export, interval=60.0, max_keep=DEFAULT_MAX_KEEP_SECONDS):
+        self.path = path
+        self.export = export
+        self.interval = interval
+        self.max_keep = max_keep
+        self.saves = 0
+        self.last_saved_at = None
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def load(self):
+        """Read the snapshot (None if there is none); call before serving"""
+        snapshot = read_snapshot(self.path)
+        if snapshot is not None:
+            logger.info(f"Warm-cache snapshot {self.path} is {time.time() - snapshot.written_at:.0f}s old")
+        return snapshot
+
+    def save(self):
+        with self._lock:
+            try:
+                on_disk = read_snapshot(self.path)
+                sections = merge_sections(
+                    on_disk.sections if on_disk is not None else {},
+                    self.export(),
+                    max_keep=self.max_keep
+                )
+                write_snapshot(self.path, sections)
+                self.saves += 1
+                self.last_saved_at = time.time()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)
+                logger.warning(f"Could not save warm-cache snapshot {self.path}: {e}")
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='warm-cache-persister', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.save()
+
+    def stop(self):
+        self._stop.set()
+        self.save()
+
+    def stats(self):
+        return {
+            'path': self.path,
+            'saves': self.saves,
+            'last_saved_at': self.last_saved_at,
+            'last_error': self.last_error,
+        }
@@ -0,0 +1,72 @@
+# gunicorn.conf.py
+"""
+Gunicorn settings for the CO2 calculator:  gunicorn -c gunicorn.conf.py app:app
+
+The master owns the shared grid snapshot (gaia_common/grid_snapshot.py). It
+creates the segment and forks one refresher before any worker starts, so the
+workers read zone intensities from shared memory instead of each calling
+Electricity Maps. Upstream calls per host are then one per zone per refresh,
+whatever the worker count.
+"""
+
+import os
+import tempfile
+
+bind = f"0.0.0.0:{os.getenv('PORT', 5001)}"
+workers = int(os.getenv("GUNICORN_WORKERS", 4))
+accesslog = "-"
+errorlog = "-"
+
+GRID_SNAPSHOT_REFRESH = float(os.getenv("GRID_SNAPSHOT_REFRESH_SECONDS", 300))
+
+# Workers combine their /metrics values through snapshot files here
+# (gaia_common/metrics.py); the workers inherit the variable from the master
+METRICS_DIR = os.environ.setdefault(
+    "GAIA_METRICS_DIR", os.path.join(tempfile.gettempdir(), f"gaia_metrics_calculator_{os.getpid()}")
+)
+
+
+def on_starting(server):
+    from gaia_common.metrics import clear_directory
+
+    clear_directory(METRICS_DIR)
+
+
+def when_ready(server):
+    from functools import partial
+    # Not app: importing it in the master would start the worker-side caches
+    from impact_tracker import GRID_SNAPSHOT_ENABLED, GRID_SNAPSHOT_NAME, fetch_zone_reading, grid_zones
+    from gaia_common.grid_snapshot import GridRefresher
+
+    api_key = os.getenv("ELECTRICITY_MAPS_API_KEY")
+    if not GRID_SNAPSHOT_ENABLED or not api_key:
+        server.log.info("Grid snapshot disabled (GRID_SNAPSHOT_ENABLED=false or no ELECTRICITY_MAPS_API_KEY)")
+        return
+    server.grid_refresher = GridRefresher(
+        GRID_SNAPSHOT_NAME,
+        grid_zones(),
+        partial(fetch_zone_reading, api_key=api_key),
+        interval=GRID_SNAPSHOT_REFRESH
+    )
+    server.log.info(f"Grid snapshot {GRID_SNAPSHOT_NAME} refreshed every {GRID_SNAPSHOT_REFRESH:.0f}s")
+
+
+def post_worker_init(worker):
+    # Each worker restores and saves the warm cache; importing the app
+    # elsewhere (scripts, the master) leaves the snapshot alone
+    from app import start_warm_cache
+
+    start_warm_cache()
+
+
+def child_exit(server, worker):
+    # Keep the exited worker's counters in the totals, drop its gauges
+    from gaia_common.metrics import mark_process_dead
+
+    mark_process_dead(METRICS_DIR, worker.pid)
+
+
+def on_exit(server):
+    refresher = getattr(server, "grid_refresher", None)
+    if refresher is not None:
+        refresher.stop()
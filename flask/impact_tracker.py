@@ -0,0 +1,382 @@
+"""
+EnvironmentalImpactTracker: the calculator's model table, cloud region to
+grid zone map and impact formulas.
+
+Importing this module has no side effects, so the CO2 worker and the bulk
+scorer use it directly instead of importing the calculator service (app.py),
+which starts its caches and background threads on import. app.py subclasses
+the tracker to read the shared grid snapshot and its per-process zone cache.
+"""
+
+import datetime
+import os
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import requests
+
+from gaia_common.grid_snapshot import ZoneReading
+from gaia_common.metrics import upstream_call
+from gaia_common.tracing import traced
+
+# Grid intensity shared by all workers on a host: the gunicorn master refreshes
+# the snapshot (gunicorn.conf.py), app.py reads it
+GRID_SNAPSHOT_ENABLED = os.getenv("GRID_SNAPSHOT_ENABLED", "true").lower() == "true"
+GRID_SNAPSHOT_NAME = os.getenv("GRID_SNAPSHOT_NAME", "gaia_grid_calculator")
+GRID_SNAPSHOT_MAX_AGE = float(os.getenv("GRID_SNAPSHOT_MAX_AGE_SECONDS", 900))
+
+# =========================
+# DATA MODELS
+# =========================
+
+@dataclass
+class ModelSpec:
+    parameters_billion: float
+    energy_per_1k_tokens_kwh: float
+    provider: str
+    architecture: str
+
+
+@dataclass
+class GridSpec:
+    carbon_intensity_g_per_kwh: float
+    grid_zone: str
+    timestamp: str
+    source: str
+
+
+# =========================
+# CORE TRACKER
+# =========================
+
+class EnvironmentalImpactTracker:
+
+    def __init__(
+        self,
+        cloud_provider: str = "gcp",
+        cloud_region: str = "asia-south1",
+        electricity_maps_api_key: Optional[str] = None,
+        pue: float = 1.1,
+        gpu_utilization: float = 0.65,
+        batching_efficiency: float = 0.9,
+        confidence_margin: float = 0.30
+    ):
+        self.cloud_provider = cloud_provider.lower()
+        self.cloud_region = cloud_region.lower()
+        self.api_key = electricity_maps_api_key
+
+        self.pue = pue
+        self.gpu_utilization = gpu_utilization
+        self.batching_efficiency = batching_efficiency
+        self.confidence_margin = confidence_margin
+
+        self.models = self._load_models()
+        self.zone_map = self._load_cloud_zone_map()
+        self.grid = self._fetch_hourly_grid_data()
+
+    # =========================
+    # MODEL DATABASE (EXTENDED 2026)
+    # =========================
+
+    def _load_models(self) -> Dict[str, ModelSpec]:
+        return {
+            # OpenAI
+            "gpt-4o": ModelSpec(180, 0.0029, "openai", "transformer"),
+            "gpt-4-turbo": ModelSpec(110, 0.0022, "openai", "transformer"),
+            "gpt-4o-mini": ModelSpec(8, 0.00045, "openai", "transformer"),
+            "gpt-3.5-turbo": ModelSpec(20, 0.00035, "openai", "transformer"),
+            "o1-preview": ModelSpec(120, 0.0150, "openai", "o1-reasoning"),
+            "o1-mini": ModelSpec(60, 0.0055, "openai", "o1-reasoning"),
+
+            # Google
+            "gemini-1.5-pro": ModelSpec(120, 0.0026, "google", "transformer-moe"),
+            "gemini-1.5-flash": ModelSpec(15, 0.00012, "google", "transformer"),
+            "gemini-2.0-flash": ModelSpec(25, 0.00018, "google", "transformer"),
+
+            # Anthropic
+            "claude-3-opus": ModelSpec(130, 0.0024, "anthropic", "transformer"),
+            "claude-3.5-sonnet": ModelSpec(70, 0.0016, "anthropic", "transformer"),
+            "claude-3-sonnet": ModelSpec(70, 0.0014, "anthropic", "transformer"),
+            "claude-3-haiku": ModelSpec(20, 0.0003, "anthropic", "transformer"),
+
+            # Meta
+            "llama-3-8b": ModelSpec(8, 0.00006, "meta", "transformer"),
+            "llama-3-70b": ModelSpec(70, 0.0013, "meta", "transformer"),
+            "llama-3.1-8b": ModelSpec(8, 0.00008, "meta", "transformer"),
+            "llama-3.1-70b": ModelSpec(70, 0.0015, "meta", "transformer"),
+            "llama-3.1-405b": ModelSpec(405, 0.0070, "meta", "transformer"),
+
+            # Mistral
+            "mistral-large-2": ModelSpec(123, 0.0022, "mistral", "transformer"),
+            "mixtral-8x7b": ModelSpec(46, 0.0008, "mistral", "moe"),
+            "mixtral-8x22b": ModelSpec(141, 0.0020, "mistral", "moe"),
+
+            # xAI
+            "grok-2": ModelSpec(314, 0.0025, "xai", "moe"),
+
+            # DeepSeek
+            "deepseek-v3": ModelSpec(671, 0.0010, "deepseek", "moe"),
+
+            # Alibaba
+            "qwen2.5-72b": ModelSpec(72, 0.0013, "qwen", "transformer"),
+        }
+
+    # =========================
+    # CLOUD → GRID ZONE MAP
+    # =========================
+
+    @staticmethod
+    def _load_cloud_zone_map() -> Dict[str, Dict[str, str]]:
+        return {
+            "gcp": {
+                "asia-south1": "IN",
+                "us-central1": "US-MIDW-MISO",
+                "europe-west1": "BE",
+                "us-east1": "US-EAST-PJM",
+                "us-west1": "US-CAL-CISO",
+                "europe-north1": "FI",
+                "asia-southeast1": "SG",
+                "asia-northeast1": "JP-TK"
+            },
+            "aws": {
+                "ap-south-1": "IN",
+                "us-east-1": "US-EAST-PJM",
+                "us-west-2": "US-NW-PACW",
+                "eu-west-1": "IE",
+                "eu-central-1": "DE",
+                "ap-southeast-1": "SG",
+                "ap-northeast-1": "JP-TK"
+            },
+            "azure": {
+                "centralindia": "IN",
+                "eastus": "US-EAST-PJM",
+                "westus": "US-CAL-CISO",
+                "westeurope": "NL",
+                "northeurope": "IE",
+                "southeastasia": "SG"
+            }
+        }
+
+    # =========================
+    # REAL-TIME + HOURLY GRID DATA
+    # =========================
+
+    @traced("grid_lookup")
+    def _fetch_hourly_grid_data(self) -> GridSpec:
+        zone = self.zone_map.get(self.cloud_provider, {}).get(
+            self.cloud_region, "IN"
+        )
+
+        # ---- shared snapshot (no network I/O) ----
+        reading = self._shared_reading(zone)
+        if reading is not None:
+            return GridSpec(
+                carbon_intensity_g_per_kwh=reading.carbon_intensity,
+                grid_zone=zone,
+                timestamp=reading.measured_at,
+                source="electricity-maps (shared snapshot)"
+            )
+
+        # ---- fallback (no API key) ----
+        if not self.api_key:
+            # Regional fallback values (2025-26 averages)
+            fallback_intensities = {
+                "IN": 708,
+                "US-MIDW-MISO": 420,
+                "US-EAST-PJM": 385,
+                "US-CAL-CISO": 250,
+                "BE": 150,
+                "FR": 90,
+                "DE": 380,
+                "IE": 320,
+                "NL": 400,
+                "FI": 85,
+                "SG": 410,
+                "JP-TK": 475
+            }
+            
+            return GridSpec(
+                carbon_intensity_g_per_kwh=fallback_intensities.get(zone, 450),
+                grid_zone=zone,
+                timestamp=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                source=f"static fallback ({zone})"
+            )
+
+        # ---- Electricity Maps API ----
+        try:
+            reading = self._live_reading(zone)
+
+            return GridSpec(
+                carbon_intensity_g_per_kwh=reading.carbon_intensity,
+                grid_zone=zone,
+                timestamp=reading.measured_at,
+                source="electricity-maps (real-time)"
+            )
+
+        except Exception as e:
+            print(f"Electricity Maps API error: {e}")
+            # Use fallback on API error
+            fallback_intensities = {
+                "IN": 708,
+                "US-MIDW-MISO": 420,
+                "US-EAST-PJM": 385,
+                "US-CAL-CISO": 250,
+                "BE": 150
+            }
+            
+            return GridSpec(
+                carbon_intensity_g_per_kwh=fallback_intensities.get(zone, 450),
+                grid_zone=zone,
+                timestamp=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                source=f"fallback (api error)"
+            )
+
+    def _shared_reading(self, zone: str) -> Optional[ZoneReading]:
+        """A reading another process already fetched (the service reads its grid snapshot)"""
+        return None
+
+    def _live_reading(self, zone: str) -> ZoneReading:
+        """A current reading from Electricity Maps (the service caches these per process)"""
+        return fetch_zone_reading(zone, self.api_key)
+
+    # =========================
+    # IMPACT ESTIMATION
+    # =========================
+
+    @traced("scoring")
+    def estimate(
+        self,
+        model_name: str,
+        input_tokens: int,
+        output_tokens: int,
+        cached: bool = False
+    ) -> Dict:
+
+        if model_name not in self.models:
+            raise ValueError(f"Unsupported model: {model_name}")
+
+        model = self.models[model_name]
+        total_tokens = input_tokens + output_tokens
+
+        base_energy = (total_tokens / 1000) * model.energy_per_1k_tokens_kwh
+
+        total_energy_kwh = (
+            base_energy
+            * (1 / self.gpu_utilization)
+            * (1 / self.batching_efficiency)
+            * self.pue
+            * (0.2 if cached else 1.0)
+        )
+
+        co2_g = total_energy_kwh * self.grid.carbon_intensity_g_per_kwh
+        water_l = total_energy_kwh * 1.8
+
+        return {
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "model": model_name,
+            "provider": model.provider,
+            "architecture": model.architecture,
+            "parameters_billion": model.parameters_billion,
+            "cloud": {
+                "provider": self.cloud_provider,
+                "region": self.cloud_region,
+                "grid_zone": self.grid.grid_zone
+            },
+            "grid_data": {
+                "carbon_intensity_g_per_kwh": self.grid.carbon_intensity_g_per_kwh,
+                "measured_at": self.grid.timestamp,
+                "source": self.grid.source
+            },
+            "tokens": {
+                "input": input_tokens,
+                "output": output_tokens,
+                "total": total_tokens
+            },
+            "energy_kwh": round(total_energy_kwh, 6),
+            "co2_grams": round(co2_g, 4),
+            "water_liters": round(water_l, 4),
+            "assumptions": {
+                "pue": self.pue,
+                "gpu_utilization": self.gpu_utilization,
+                "batching_efficiency": self.batching_efficiency,
+                "cached": cached
+            },
+            "confidence_interval": f"±{int(self.confidence_margin * 100)}%"
+        }
+
+    @traced("scoring")
+    def estimate_many(self, prompts: List[tuple]) -> tuple:
+        """
+        Score many (model_name, input_tokens, output_tokens, cached) prompts
+        with the same formulas as estimate(), folding the per-model constants
+        once instead of per prompt.
+        Returns (results [(index, energy_kwh, co2_grams, water_liters)],
+                 errors [(index, message)])
+        """
+        overhead = (1 / self.gpu_utilization) * (1 / self.batching_efficiency) * self.pue
+        intensity = self.grid.carbon_intensity_g_per_kwh
+        kwh_per_token = {
+            name: spec.energy_per_1k_tokens_kwh / 1000 * overhead
+            for name, spec in self.models.items()
+        }
+
+        results, errors = [], []
+        for index, (model_name, input_tokens, output_tokens, cached) in enumerate(prompts):
+            factor = kwh_per_token.get(model_name)
+            if factor is None:
+                errors.append((index, f"Unsupported model: {model_name}"))
+                continue
+            energy = (input_tokens + output_tokens) * factor * (0.2 if cached else 1.0)
+            results.append((
+                index,
+                round(energy, 6),
+                round(energy * intensity, 4),
+                round(energy * 1.8, 4)
+            ))
+        return results, errors
+
+    def get_supported_models(self) -> List[Dict]:
+        """Return list of supported models with their specs"""
+        return [
+            {
+                "name": name,
+                "provider": spec.provider,
+                "parameters_billion": spec.parameters_billion,
+                "energy_per_1k_tokens_kwh": spec.energy_per_1k_tokens_kwh,
+                "architecture": spec.architecture
+            }
+            for name, spec in self.models.items()
+        ]
+
+
+def fetch_zone_reading(zone: str, api_key: Optional[str]) -> ZoneReading:
+    """Latest Electricity Maps reading for a grid zone (raises on any failure)"""
+    headers = {"auth-token": api_key}
+    url = (
+        "https://api.electricitymap.org/v3/"
+        f"carbon-intensity/latest?zone={zone}"
+    )
+    with upstream_call("electricity_maps.latest"):
+        response = requests.get(url, headers=headers, timeout=6)
+        response.raise_for_status()
+    data = response.json()
+
+    return ZoneReading(
+        zone=zone,
+        carbon_intensity=data["carbonIntensity"],
+        fossil_free_percentage=data.get("fossilFreePercentage"),
+        renewable_percentage=data.get("renewablePercentage"),
+        measured_at=data["datetime"],
+        fetched_at=time.time(),
+        is_estimate=False
+    )
+
+
+def grid_zones() -> List[str]:
+    """Every grid zone a supported cloud region maps to"""
+    return sorted({
+        zone
+        for regions in EnvironmentalImpactTracker._load_cloud_zone_map().values()
+        for zone in regions.values()
+    })
@@ -5,41 +5,121 @@ Production-ready Flask API for carbon-aware cloud optimization.
 
 from flask import Flask, request, jsonify
 from engine import CarbonEngine
+from gaia_common.grid_snapshot import GridSnapshotReader
+from gaia_common.warm_cache import WarmCachePersister
+from gaia_common.metrics import BATCH_SIZE, CACHE_EVENTS, StatsCollector, instrument_app
+from gaia_common.tracing import RequestIdFilter, span, trace_app
+import itertools
 import os
 import logging
+import tempfile
+import threading
+import time
 from datetime import datetime
 from functools import wraps
 
 from dotenv import load_dotenv
 load_dotenv()
  
-# Configure logging
+# Configure logging (request_id is the caller's X-Request-ID or a generated one).
+# force: engine.py's basicConfig has already run by the time this executes
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    format='%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s',
+    force=True
 )
+for handler in logging.getLogger().handlers:
+    handler.addFilter(RequestIdFilter())
 logger = logging.getLogger(__name__)
 
 # Initialize Flask app
 app = Flask(__name__)
 app.config['JSON_SORT_KEYS'] = False
 
+# Prometheus-style metrics at /metrics (bearer token required when METRICS_TOKEN is set)
+instrument_app(app, token=os.getenv("METRICS_TOKEN"))
+
+# Request IDs, span timing (sampled, or X-Gaia-Trace: 1 with the DEBUG_TOKEN),
+# per-request profiling and /debug/traces
+trace_app(app, sample_rate=float(os.getenv("TRACE_SAMPLE_RATE", 0)), debug_token=os.getenv("DEBUG_TOKEN"))
+
 # Get API key from environment
 API_KEY = os.getenv("EL_MAPS_API_KEY")
 if not API_KEY:
     logger.warning("EL_MAPS_API_KEY not set - API will use fallback estimates")
 
+# Zone intensities shared by all workers on this host (see gunicorn.conf.py)
+GRID_SNAPSHOT_ENABLED = os.getenv("GRID_SNAPSHOT_ENABLED", "true").lower() == "true"
+GRID_SNAPSHOT_NAME = os.getenv("GRID_SNAPSHOT_NAME", "gaia_grid_suggestion")
+GRID_SNAPSHOT_MAX_AGE = float(os.getenv("GRID_SNAPSHOT_MAX_AGE_SECONDS", 900))
+
+grid_snapshot = (
+    GridSnapshotReader(GRID_SNAPSHOT_NAME, max_age=GRID_SNAPSHOT_MAX_AGE)
+    if GRID_SNAPSHOT_ENABLED else None
+)
+
+# How long a cache miss waits for an identical in-flight API call
+COALESCE_TIMEOUT = float(os.getenv("UPSTREAM_COALESCE_TIMEOUT_SECONDS", 10))
+
 # Initialize carbon engine
-engine = CarbonEngine(API_KEY)
+engine = CarbonEngine(API_KEY, grid_snapshot=grid_snapshot, coalesce_timeout=COALESCE_TIMEOUT)
+
+# Warm-cache snapshot: restore cached intensities/forecasts before serving,
+# then persist them periodically so the next start is warm too
+WARM_CACHE_ENABLED = os.getenv("WARM_CACHE_ENABLED", "true").lower() == "true"
+WARM_CACHE_PATH = os.getenv(
+    "WARM_CACHE_PATH", os.path.join(tempfile.gettempdir(), "gaia_suggestion_warm_cache.bin")
+)
+WARM_CACHE_SAVE_SECONDS = float(os.getenv("WARM_CACHE_SAVE_SECONDS", 60))
+
+warm_cache = None
+warm_cache_restored = None
+_warm_cache_lock = threading.Lock()
+
+
+def start_warm_cache():
+    """
+    Restore the warm-cache snapshot and start saving it periodically.
+
+    Called by the service entry points (__main__ and gunicorn's
+    post_worker_init), never on import, so tests and scripts that import this
+    module don't read or overwrite the service's snapshot. Safe to call twice.
+    """
+    global warm_cache, warm_cache_restored
+    with _warm_cache_lock:
+        if warm_cache is not None or not WARM_CACHE_ENABLED:
+            return warm_cache
+        persister = WarmCachePersister(WARM_CACHE_PATH, engine.export_warm_cache, interval=WARM_CACHE_SAVE_SECONDS)
+        snapshot = persister.load()
+        if snapshot is not None:
+            stale = engine.restore_warm_cache(snapshot)
+            CACHE_EVENTS.labels("carbon_intensity", "stale").inc(len(stale["intensity"]))
+            CACHE_EVENTS.labels("forecast", "stale").inc(len(stale["forecast"]))
+            engine.refresh_in_background(stale)
+            warm_cache_restored = {
+                "snapshot_age_seconds": round(time.time() - snapshot.written_at, 1),
+                "entries": sum(len(entries) for entries in snapshot.sections.values()),
+                "stale": sum(len(zones) for zones in stale.values()),
+            }
+            logger.info(f"Restored warm cache: {warm_cache_restored}")
+        persister.start()
+        StatsCollector("gaia_warm_cache", "Warm-cache snapshot saves", persister.stats)
+        warm_cache = persister
+        return warm_cache
+
+
+StatsCollector("gaia_upstream_coalescing", "Coalesced upstream calls (singleflight)", engine.inflight.stats)
+if grid_snapshot is not None:
+    StatsCollector("gaia_grid_snapshot", "Shared grid snapshot state", grid_snapshot.stats)
 
-# Request counter for IDs
-request_counter = {"count": 0}
+# Request counter for IDs (next() on itertools.count is atomic, so request
+# threads never hand out the same ID)
+request_counter = itertools.count(1)
 
 
 def generate_request_id():
     """Generate unique request ID."""
-    request_counter["count"] += 1
-    return f"carbon_req_{request_counter['count']:06d}"
+    return f"carbon_req_{next(request_counter):06d}"
 
 
 def handle_errors(f):
@@ -47,7 +127,8 @@ def handle_errors(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         try:
-            return f(*args, **kwargs)
+            with span("handler", endpoint=f.__name__):
+                return f(*args, **kwargs)
         except ValueError as e:
             logger.error(f"Validation error: {e}")
             return jsonify({
@@ -74,7 +155,10 @@ def health_check():
         "status": "healthy",
         "service": "carbon-optimizer",
         "timestamp": datetime.utcnow().isoformat(),
-        "api_configured": API_KEY is not None
+        "api_configured": API_KEY is not None,
+        "grid_snapshot": grid_snapshot.stats() if grid_snapshot is not None else None,
+        "upstream_coalescing": engine.inflight.stats(),
+        "warm_cache": dict(warm_cache.stats(), restored=warm_cache_restored) if warm_cache is not None else None
     })
 
 
@@ -272,6 +356,7 @@ def compare_options():
             "status": "error",
             "message": "Provide 1-20 options to compare"
         }), 400
+    BATCH_SIZE.labels("compare_options").observe(len(options))
     
     comparisons = []
     
@@ -416,4 +501,5 @@ def method_not_allowed(e):
 if __name__ == '__main__':
     # Development server
     logger.info("Starting Carbon Optimizer API in development mode")
+    start_warm_cache()
     app.run(host='0.0.0.0', port=5000, debug=False)
@@ -4,12 +4,25 @@ Carbon-aware cloud optimization engine.
 Integrates with Electricity Maps API for real-time carbon intensity data.
 """
 
+import os
+import sys
+import threading
+import time
 import requests
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Tuple
-from cachetools import TTLCache
 import logging
 
+# Shared code lives in flask/gaia_common (copied next to this file in Docker)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gaia_common.grid_snapshot import GridSnapshotReader, ZoneReading
+from gaia_common.singleflight import SingleFlight, SingleFlightTimeout
+from gaia_common.striped_cache import StripedTTLCache
+from gaia_common.warm_cache import WarmSnapshot
+from gaia_common.metrics import CACHE_EVENTS, upstream_call
+from gaia_common.tracing import span, traced
+
 from mapping import (
     REGION_TO_ZONE,
     INSTANCE_CATALOG,
@@ -22,27 +35,48 @@ from mapping import (
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Bound once so cache lookups only increment a cell
+SNAPSHOT_HIT = CACHE_EVENTS.labels("grid_snapshot", "hit")
+SNAPSHOT_MISS = CACHE_EVENTS.labels("grid_snapshot", "miss")
+INTENSITY_HIT = CACHE_EVENTS.labels("carbon_intensity", "hit")
+INTENSITY_MISS = CACHE_EVENTS.labels("carbon_intensity", "miss")
+FORECAST_HIT = CACHE_EVENTS.labels("forecast", "hit")
+FORECAST_MISS = CACHE_EVENTS.labels("forecast", "miss")
+
 
 class CarbonEngine:
     """
     Main engine for carbon-aware cloud resource recommendations.
     """
     
-    def __init__(self, api_key: str):
+    def __init__(
+        self,
+        api_key: str,
+        grid_snapshot: Optional[GridSnapshotReader] = None,
+        coalesce_timeout: float = 10.0
+    ):
         """
         Initialize the carbon engine.
         
         Args:
             api_key: Electricity Maps API key
+            grid_snapshot: Optional host-wide snapshot of zone intensities,
+                consulted before the local cache and the API
+            coalesce_timeout: Seconds a cache miss waits for an identical
+                in-flight API call before falling back
         """
         self.api_key = api_key
         self.base_url = "https://api.electricitymap.org/v3"
+        self.grid_snapshot = grid_snapshot
         
-        # Cache carbon intensity data for 5 minutes
-        self.carbon_cache = TTLCache(maxsize=100, ttl=300)
+        # Cache carbon intensity data for 5 minutes (shared by request threads)
+        self.carbon_cache = StripedTTLCache(maxsize=100, ttl=300)
         
         # Cache forecast data for 30 minutes
-        self.forecast_cache = TTLCache(maxsize=100, ttl=1800)
+        self.forecast_cache = StripedTTLCache(maxsize=100, ttl=1800)
+        
+        # Concurrent misses for the same key share one API call
+        self.inflight = SingleFlight(timeout=coalesce_timeout)
     
     def get_carbon_intensity(self, zone: str) -> Optional[Dict]:
         """
@@ -54,40 +88,89 @@ class CarbonEngine:
         Returns:
             Dict with carbon intensity data or None if unavailable
         """
-        # Check cache first
-        if zone in self.carbon_cache:
-            logger.info(f"Using cached carbon data for {zone}")
-            return self.carbon_cache[zone]
-        
-        try:
-            headers = {"auth-token": self.api_key}
-            url = f"{self.base_url}/carbon-intensity/latest"
-            params = {"zone": zone}
-            
-            response = requests.get(url, headers=headers, params=params, timeout=5)
-            response.raise_for_status()
-            
-            data = response.json()
+        with span("cache_lookup", cache="carbon_intensity", zone=zone):
+            # Shared snapshot first (published by the gunicorn master's refresher)
+            reading = self.grid_snapshot.get(zone) if self.grid_snapshot else None
+            if reading is not None:
+                SNAPSHOT_HIT.inc()
+                return {
+                    "carbon_intensity": reading.carbon_intensity,
+                    "fossil_percentage": reading.fossil_free_percentage,
+                    "renewable_percentage": reading.renewable_percentage,
+                    "zone": zone,
+                    "datetime": reading.measured_at,
+                }
+            if self.grid_snapshot:
+                SNAPSHOT_MISS.inc()
             
-            result = {
-                "carbon_intensity": data.get("carbonIntensity"),  # gCO2eq/kWh
-                "fossil_percentage": data.get("fossilFreePercentage"),
-                "renewable_percentage": data.get("renewablePercentage"),
-                "zone": zone,
-                "datetime": data.get("datetime"),
-            }
+            # Check cache (a single get: the entry may expire between two calls)
+            cached = self.carbon_cache.get(zone)
+            if cached is not None:
+                INTENSITY_HIT.inc()
+                logger.info(f"Using cached carbon data for {zone}")
+                return cached
+            INTENSITY_MISS.inc()
+        
+        def fetch():
+            # A call that finished just before this one started may have filled it
+            cached = self.carbon_cache.get(zone)
+            if cached is not None:
+                return cached
+            result = self._fetch_carbon_intensity(zone)
             
             # Cache the result
             self.carbon_cache[zone] = result
             
             logger.info(f"Fetched carbon intensity for {zone}: {result['carbon_intensity']} gCO2eq/kWh")
             return result
+        
+        try:
+            return self.inflight.do(("intensity", zone), fetch)
             
-        except requests.RequestException as e:
+        except (requests.RequestException, SingleFlightTimeout) as e:
             logger.error(f"Error fetching carbon intensity for {zone}: {e}")
             # Return estimated fallback data
             return self._get_fallback_intensity(zone)
     
+    def _fetch_carbon_intensity(self, zone: str) -> Dict:
+        """Fetch the latest intensity for a zone from Electricity Maps (raises on failure)."""
+        headers = {"auth-token": self.api_key}
+        url = f"{self.base_url}/carbon-intensity/latest"
+        params = {"zone": zone}
+        
+        with upstream_call("electricity_maps.latest"):
+            response = requests.get(url, headers=headers, params=params, timeout=5)
+            response.raise_for_status()
+        
+        data = response.json()
+        
+        return {
+            "carbon_intensity": data.get("carbonIntensity"),  # gCO2eq/kWh
+            "fossil_percentage": data.get("fossilFreePercentage"),
+            "renewable_percentage": data.get("renewablePercentage"),
+            "zone": zone,
+            "datetime": data.get("datetime"),
+        }
+    
+    def fetch_zone_reading(self, zone: str) -> Optional[ZoneReading]:
+        """
+        Upstream reading for the shared grid snapshot refresher.
+        
+        Returns None when the API has no intensity for the zone.
+        """
+        result = self._fetch_carbon_intensity(zone)
+        if result["carbon_intensity"] is None:
+            return None
+        return ZoneReading(
+            zone=zone,
+            carbon_intensity=result["carbon_intensity"],
+            fossil_free_percentage=result["fossil_percentage"],
+            renewable_percentage=result["renewable_percentage"],
+            measured_at=result["datetime"],
+            fetched_at=time.time(),
+            is_estimate=False,
+        )
+    
     def get_carbon_forecast(self, zone: str) -> Optional[List[Dict]]:
         """
         Get 24-hour carbon intensity forecast for a zone.
@@ -99,17 +182,25 @@ class CarbonEngine:
             List of forecasted carbon intensity data points
         """
         # Check cache first
-        if zone in self.forecast_cache:
-            logger.info(f"Using cached forecast data for {zone}")
-            return self.forecast_cache[zone]
-        
-        try:
+        with span("cache_lookup", cache="forecast", zone=zone):
+            cached = self.forecast_cache.get(zone)
+            if cached is not None:
+                FORECAST_HIT.inc()
+                logger.info(f"Using cached forecast data for {zone}")
+                return cached
+            FORECAST_MISS.inc()
+        
+        def fetch():
+            cached = self.forecast_cache.get(zone)
+            if cached is not None:
+                return cached
             headers = {"auth-token": self.api_key}
             url = f"{self.base_url}/carbon-intensity/forecast"
             params = {"zone": zone}
             
-            response = requests.get(url, headers=headers, params=params, timeout=5)
-            response.raise_for_status()
+            with upstream_call("electricity_maps.forecast"):
+                response = requests.get(url, headers=headers, params=params, timeout=5)
+                response.raise_for_status()
             
             data = response.json()
             forecast = data.get("forecast", [])
@@ -119,11 +210,64 @@ class CarbonEngine:
             
             logger.info(f"Fetched forecast for {zone}: {len(forecast)} data points")
             return forecast
+        
+        try:
+            return self.inflight.do(("forecast", zone), fetch)
             
-        except requests.RequestException as e:
+        except (requests.RequestException, SingleFlightTimeout) as e:
             logger.error(f"Error fetching forecast for {zone}: {e}")
             return None
     
+    def export_warm_cache(self) -> Dict[str, Dict]:
+        """
+        Cached upstream data as warm-cache snapshot sections.
+        
+        Rankings are not exported: they are rebuilt from the cached
+        intensities on every call.
+        """
+        return {
+            "intensity": {zone: (stored_at, value) for zone, stored_at, value in self.carbon_cache.stamped_items()},
+            "forecast": {zone: (stored_at, value) for zone, stored_at, value in self.forecast_cache.stamped_items()},
+        }
+    
+    def restore_warm_cache(self, snapshot: WarmSnapshot) -> Dict[str, List[str]]:
+        """
+        Load a warm-cache snapshot into the caches.
+        
+        Entries keep their original store time, so they expire on schedule.
+        
+        Returns:
+            Zones per section whose entries had already expired
+        """
+        stale = {}
+        for name, cache in (("intensity", self.carbon_cache), ("forecast", self.forecast_cache)):
+            stale[name] = []
+            for zone, (stored_at, value) in snapshot.sections.get(name, {}).items():
+                cache.set(zone, value, stored_at=stored_at)
+                if zone not in cache:
+                    stale[name].append(zone)
+        return stale
+    
+    def refresh_in_background(self, stale: Dict[str, List[str]]) -> Optional[threading.Thread]:
+        """
+        Refetch expired snapshot entries without blocking startup.
+        
+        Requests for a zone that is still being refreshed join the in-flight call.
+        """
+        if not self.api_key or not any(stale.values()):
+            return None
+        
+        def refresh():
+            for zone in stale.get("intensity", []):
+                self.get_carbon_intensity(zone)
+            for zone in stale.get("forecast", []):
+                self.get_carbon_forecast(zone)
+            logger.info(f"Refreshed {sum(len(zones) for zones in stale.values())} stale warm-cache entries")
+        
+        thread = threading.Thread(target=refresh, name="warm-cache-refresh", daemon=True)
+        thread.start()
+        return thread
+    
     def _get_fallback_intensity(self, zone: str) -> Dict:
         """
         Provide estimated carbon intensity when API is unavailable.
@@ -197,6 +341,7 @@ class CarbonEngine:
             "carbon_intensity_used": carbon_intensity,
         }
     
+    @traced("scoring")
     def rank_regions_by_carbon(self) -> List[Dict]:
         """
         Rank all AWS regions by current carbon intensity.
@@ -222,6 +367,7 @@ class CarbonEngine:
         
         return region_data
     
+    @traced("scoring")
     def find_best_time_window(self, zone: str, duration_hours: int = 4) -> Optional[Dict]:
         """
         Find the optimal time window with lowest carbon intensity.
@@ -256,6 +402,7 @@ class CarbonEngine:
         
         return best_window
     
+    @traced("scoring")
     def suggest(
         self, 
         workload: str, 
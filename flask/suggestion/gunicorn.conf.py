@@ -0,0 +1,76 @@
+# gunicorn.conf.py
+"""
+Gunicorn settings for the carbon optimizer:  gunicorn -c gunicorn.conf.py app:app
+
+The master owns the shared grid snapshot (gaia_common/grid_snapshot.py). It
+creates the segment and forks one refresher before any worker starts, so the
+workers read zone intensities from shared memory instead of each calling
+Electricity Maps. Upstream calls per host are then one per zone per refresh,
+whatever the worker count.
+"""
+
+import os
+import tempfile
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("GUNICORN_WORKERS", 4))
+# More than one thread selects the gthread worker: threads overlap upstream
+# I/O, and the engine's caches and counters are safe to share between them
+threads = int(os.getenv("GUNICORN_THREADS", 2))
+accesslog = "-"
+errorlog = "-"
+proc_name = "carbon-optimizer"
+
+GRID_SNAPSHOT_REFRESH = float(os.getenv("GRID_SNAPSHOT_REFRESH_SECONDS", 300))
+
+# Workers combine their /metrics values through snapshot files here
+# (gaia_common/metrics.py); the workers inherit the variable from the master
+METRICS_DIR = os.environ.setdefault(
+    "GAIA_METRICS_DIR", os.path.join(tempfile.gettempdir(), f"gaia_metrics_suggestion_{os.getpid()}")
+)
+
+
+def on_starting(server):
+    from gaia_common.metrics import clear_directory
+
+    clear_directory(METRICS_DIR)
+
+
+def when_ready(server):
+    from engine import CarbonEngine
+    from mapping import REGION_TO_ZONE
+    from gaia_common.grid_snapshot import GridRefresher
+
+    api_key = os.getenv("EL_MAPS_API_KEY")
+    name = os.getenv("GRID_SNAPSHOT_NAME", "gaia_grid_suggestion")
+    if os.getenv("GRID_SNAPSHOT_ENABLED", "true").lower() != "true" or not api_key:
+        server.log.info("Grid snapshot disabled (GRID_SNAPSHOT_ENABLED=false or no EL_MAPS_API_KEY)")
+        return
+    server.grid_refresher = GridRefresher(
+        name,
+        REGION_TO_ZONE.values(),
+        CarbonEngine(api_key).fetch_zone_reading,
+        interval=GRID_SNAPSHOT_REFRESH
+    )
+    server.log.info(f"Grid snapshot {name} refreshed every {GRID_SNAPSHOT_REFRESH:.0f}s")
+
+
+def post_worker_init(worker):
+    # Each worker restores and saves the warm cache; importing the app
+    # elsewhere (scripts, the master) leaves the snapshot alone
+    from app import start_warm_cache
+
+    start_warm_cache()
+
+
+def child_exit(server, worker):
+    # Keep the exited worker's counters in the totals, drop its gauges
+    from gaia_common.metrics import mark_process_dead
+
+    mark_process_dead(METRICS_DIR, worker.pid)
+
+
+def on_exit(server):
+    refresher = getattr(server, "grid_refresher", None)
+    if refresher is not None:
+        refresher.stop()
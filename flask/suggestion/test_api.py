@@ -4,9 +4,23 @@ Comprehensive test suite for the Carbon Optimizer API.
 Run with: pytest test_api.py -v
 """
 
+import os
 import pytest
 import json
-from app import app, engine
+import threading
+import time
+
+# Header-requested traces need the debug token (see TestTracing)
+os.environ.setdefault('DEBUG_TOKEN', 'test-debug-token')
+from app import app, engine, generate_request_id
+from engine import CarbonEngine
+from gaia_common.grid_snapshot import GridSnapshotWriter, GridSnapshotReader, ZoneReading
+from gaia_common.metrics import (
+    Registry, Counter, Gauge, Histogram, StatsCollector, MultiProcessStore, mark_process_dead
+)
+from gaia_common.singleflight import SingleFlight, SingleFlightTimeout
+from gaia_common.striped_cache import StripedTTLCache
+from gaia_common.warm_cache import WarmCachePersister, read_snapshot, write_snapshot
 
 
 @pytest.fixture
@@ -228,6 +242,253 @@ class TestEngine:
             assert regions[i]['carbon_intensity'] <= regions[i + 1]['carbon_intensity']
 
 
+class TestGridSnapshot:
+    """Test the shared-memory grid snapshot."""
+    
+    def test_engine_reads_published_snapshot(self):
+        """Published readings are served without touching the API or cache."""
+        writer = GridSnapshotWriter.create('gaia_grid_test', capacity=4)
+        try:
+            writer.publish([ZoneReading('FR', 42.0, 91.0, None, '2025-01-01T00:00:00.000Z', time.time(), False)])
+            snapshot_engine = CarbonEngine(None, grid_snapshot=GridSnapshotReader('gaia_grid_test'))
+            result = snapshot_engine.get_carbon_intensity('FR')
+            assert result['carbon_intensity'] == 42.0
+            assert result['fossil_percentage'] == 91.0
+            assert result['renewable_percentage'] is None
+            assert len(snapshot_engine.carbon_cache) == 0
+        finally:
+            writer.close()
+    
+    def test_stale_snapshot_entry_is_ignored(self):
+        """Readings older than max_age are not served."""
+        writer = GridSnapshotWriter.create('gaia_grid_test_stale', capacity=4)
+        try:
+            writer.publish([ZoneReading('FR', 42.0, None, None, None, 0.0, False)])
+            assert GridSnapshotReader('gaia_grid_test_stale', max_age=60).get('FR') is None
+        finally:
+            writer.close()
+
+
+class TestSingleFlight:
+    """Test coalescing of concurrent cache misses."""
+
+    def test_concurrent_misses_share_one_fetch(self):
+        """Concurrent misses for the same zone make a single API call."""
+        calls = []
+
+        def slow_fetch(zone):
+            calls.append(zone)
+            time.sleep(0.2)
+            return {"carbon_intensity": 42, "fossil_percentage": None,
+                    "renewable_percentage": None, "zone": zone, "datetime": None}
+
+        coalescing_engine = CarbonEngine("test-key")
+        coalescing_engine._fetch_carbon_intensity = slow_fetch
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(coalescing_engine.get_carbon_intensity('FR')))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert calls == ['FR']
+        assert [result['carbon_intensity'] for result in results] == [42] * 8
+        stats = coalescing_engine.inflight.stats()
+        assert stats['executions'] == 1
+        assert stats['coalesced'] == 7
+
+    def test_waiter_times_out(self):
+        """A waiter past its deadline raises instead of blocking."""
+        flight = SingleFlight(timeout=0.05)
+        started = threading.Event()
+        release = threading.Event()
+
+        def lead():
+            started.set()
+            release.wait()
+
+        leader = threading.Thread(target=lambda: flight.do('FR', lead))
+        leader.start()
+        try:
+            assert started.wait(5)
+            with pytest.raises(SingleFlightTimeout):
+                flight.do('FR', lambda: None)
+        finally:
+            release.set()
+            leader.join()
+        assert flight.stats()['timeouts'] == 1
+
+
+class TestMetrics:
+    """Test the /metrics endpoint."""
+
+    def test_metrics_endpoint_reports_routes(self, client):
+        """Served requests show up in the latency histogram and counters."""
+        client.get('/health')
+        response = client.get('/metrics')
+        assert response.status_code == 200
+        assert response.content_type.startswith('text/plain')
+        body = response.data.decode()
+        assert 'gaia_http_request_duration_seconds_bucket{route="/health",method="GET",le="+Inf"}' in body
+        assert 'gaia_http_requests_total{route="/health",method="GET",status="200"}' in body
+        assert 'gaia_upstream_coalescing{stat="executions"}' in body
+
+    def test_counts_from_many_threads_add_up(self):
+        """Per-thread cells are summed at scrape time without losing updates."""
+        registry = Registry()
+        counter = Counter('test_events_total', 'Test events', registry=registry)
+        histogram = Histogram('test_seconds', 'Test latency', buckets=(0.1, 1.0), registry=registry)
+
+        def worker():
+            for _ in range(1000):
+                counter.inc()
+                histogram.observe(0.5)
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        body = registry.render()
+        assert 'test_events_total 8000' in body
+        assert 'test_seconds_bucket{le="0.1"} 0' in body
+        assert 'test_seconds_bucket{le="1.0"} 8000' in body
+        assert 'test_seconds_count 8000' in body
+
+    def test_worker_snapshots_are_combined(self, tmp_path):
+        """Counters add up across workers (exited ones too); stats keep their pid."""
+        registry = Registry()
+        counter = Counter('test_requests_total', 'Test requests', registry=registry)
+        gauge = Gauge('test_in_flight', 'Test in flight', registry=registry)
+        StatsCollector('test_pool', 'Test pool', lambda: {'in_use': 2}, registry=registry)
+        registry.store = MultiProcessStore(str(tmp_path), registry)
+        counter.inc(3)
+        gauge.inc()
+
+        # Another live worker, and one that has exited
+        other = os.getppid()
+        snapshot = json.dumps({'pid': other, 'families': registry.collect()})
+        (tmp_path / f'metrics-{other}.json').write_text(snapshot)
+        (tmp_path / 'metrics-1.json').write_text(snapshot)
+        mark_process_dead(str(tmp_path), 1)
+
+        body = registry.render()
+        assert 'test_requests_total 9' in body
+        assert 'test_in_flight 2' in body
+        assert f'test_pool{{stat="in_use",pid="{os.getpid()}"}} 2' in body
+        assert f'test_pool{{stat="in_use",pid="{other}"}} 2' in body
+        assert body.count('test_pool{') == 2
+
+
+class TestTracing:
+    """Test request IDs and per-request span timing."""
+
+    def test_request_id_is_propagated(self, client):
+        """A valid incoming X-Request-ID is echoed; an invalid one is replaced."""
+        response = client.get('/health', headers={'X-Request-ID': 'co2-worker-42-0'})
+        assert response.headers['X-Request-ID'] == 'co2-worker-42-0'
+        response = client.get('/health', headers={'X-Request-ID': 'not valid!'})
+        assert response.headers['X-Request-ID'] not in ('', 'not valid!')
+        assert 'X-Gaia-Trace' not in response.headers
+
+    def test_trace_header_returns_span_tree(self, client):
+        """X-Gaia-Trace: 1 with the debug token returns the request's spans."""
+        response = client.get('/api/v1/regions/us-east-1', headers={
+            'X-Gaia-Trace': '1',
+            'X-Gaia-Debug-Token': os.environ['DEBUG_TOKEN'],
+        })
+        tree = json.loads(response.headers['X-Gaia-Trace'])
+        if 'url' in tree:
+            pytest.skip("span tree too large for the header in this environment")
+        assert tree['name'] == 'GET /api/v1/regions/<region>'
+        assert [child['name'] for child in tree.get('children', [])] == ['handler']
+        handler = tree['children'][0]
+        names = [child['name'] for child in handler.get('children', [])]
+        assert 'cache_lookup' in names
+        assert names[-1] == 'serialization'
+
+    def test_debug_endpoints_need_token(self, client):
+        """Without the debug token no trace is returned and the store is not reachable."""
+        response = client.get('/api/v1/regions/us-east-1', headers={'X-Gaia-Trace': '1'})
+        assert 'X-Gaia-Trace' not in response.headers
+        assert client.get('/debug/traces').status_code == 404
+        response = client.get('/debug/traces', headers={'X-Gaia-Debug-Token': 'wrong'})
+        assert response.status_code == 404
+
+
+class TestWarmCache:
+    """Test warm-cache snapshots."""
+
+    def test_snapshot_round_trip_keeps_entry_age(self, tmp_path):
+        """Restored entries keep their store time; expired ones are reported stale."""
+        source = CarbonEngine(None)
+        source.carbon_cache['FR'] = {"carbon_intensity": 42}
+        source.carbon_cache.set('DE', {"carbon_intensity": 380}, stored_at=time.time() - 600)
+        source.forecast_cache.set('DE', [{"carbonIntensity": 300}], stored_at=time.time() - 60)
+        persister = WarmCachePersister(str(tmp_path / 'warm.bin'), source.export_warm_cache)
+        persister.save()
+
+        restored = CarbonEngine(None)
+        stale = restored.restore_warm_cache(persister.load())
+        assert restored.carbon_cache.get('FR') == {"carbon_intensity": 42}
+        assert restored.forecast_cache.get('DE') == [{"carbonIntensity": 300}]
+        assert 'DE' not in restored.carbon_cache
+        assert stale == {"intensity": [], "forecast": []}
+
+    def test_corrupt_snapshot_is_ignored(self, tmp_path):
+        """A truncated or foreign file loads as no snapshot."""
+        path = tmp_path / 'warm.bin'
+        write_snapshot(str(path), {"intensity": {"FR": (1.0, {"carbon_intensity": 42})}})
+        assert read_snapshot(str(path)).sections["intensity"]["FR"] == (1.0, {"carbon_intensity": 42})
+        path.write_bytes(path.read_bytes()[:-3])
+        assert read_snapshot(str(path)) is None
+
+
+class TestThreadSafety:
+    """Test engine state shared between request threads."""
+
+    def test_striped_cache_under_concurrent_writes(self):
+        """Concurrent writers and readers never corrupt the cache or exceed maxsize."""
+        cache = StripedTTLCache(maxsize=64, ttl=300, stripes=4)
+        errors = []
+
+        def worker(offset):
+            try:
+                for i in range(2000):
+                    key = f"zone-{(i + offset) % 200}"
+                    cache[key] = i
+                    cache.get(key)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(n * 13,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert errors == []
+        assert 0 < len(cache) <= 64
+
+    def test_request_ids_are_unique_across_threads(self):
+        """generate_request_id never repeats under concurrency."""
+        ids = []
+        threads = [
+            threading.Thread(target=lambda: ids.extend(generate_request_id() for _ in range(500)))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(set(ids)) == len(ids) == 4000
+
+
 class TestErrorHandling:
     """Test error handling."""
     
@@ -10,6 +10,12 @@
 export async function register() {
   // Only run in Node.js server runtime, not in edge or client
   if (process.env.NEXT_RUNTIME === "nodejs") {
+    // The bulk Python worker (flask/co2_worker.py) replaces this one when enabled
+    if (process.env.CO2_WORKER_ENABLED === "false") {
+      console.log("[Instrumentation] CO₂ worker disabled (CO2_WORKER_ENABLED=false)");
+      return;
+    }
+
     console.log("[Instrumentation] Server started — booting CO₂ worker...");
 
     const { startCO2Worker } = await import("./lib/co2-worker");
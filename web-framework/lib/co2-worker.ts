@@ -25,6 +25,12 @@ const FLASK_URL        = process.env.FLASK_SERVICE_URL ?? "http://localhost:5001
 const POLL_MS          = Number(process.env.CO2_WORKER_POLL_MS   ?? 5_000);
 const BATCH            = Number(process.env.CO2_WORKER_BATCH_SIZE ?? 10);
 const MAX_RETRY        = Number(process.env.CO2_WORKER_MAX_RETRY  ?? 3);
+// Only look at recent rows so the poll touches the newest monthly partitions.
+// Older pending rows are only reached by the catch-up pass below, which starts
+// scanning the whole table when a tick finds less than a full batch, at most
+// once per CATCHUP_MS; without it they would never be scored.
+const LOOKBACK_DAYS    = Number(process.env.CO2_WORKER_LOOKBACK_DAYS ?? 31);
+const CATCHUP_MS       = Number(process.env.CO2_WORKER_CATCHUP_MS ?? 3_600_000);
 
 interface PendingRow {
   id: number;
@@ -112,7 +118,8 @@ async function checkFlaskHealth(): Promise<boolean> {
 }
 
 // ── 3. Fetch a locked batch of unprocessed rows ───────────────────
-async function fetchPending(client: PoolClient): Promise<PendingRow[]> {
+// lookbackDays = null scans the whole table (catch-up pass)
+async function fetchPending(client: PoolClient, lookbackDays: number | null): Promise<PendingRow[]> {
   // ✅ FIX 1: "IS NOT TRUE" matches both FALSE and NULL
   // ✅ FIX 6: FOR UPDATE SKIP LOCKED — concurrent ticks don't double-process
   const { rows } = await client.query<PendingRow>(`
@@ -127,18 +134,25 @@ async function fetchPending(client: PoolClient): Promise<PendingRow[]> {
       AND input_tokens  IS NOT NULL
       AND output_tokens IS NOT NULL
       AND model         IS NOT NULL
+      AND ($3::int IS NULL OR captured_at >= NOW() - make_interval(days => $3::int))
     ORDER BY id ASC
     LIMIT $2
     FOR UPDATE SKIP LOCKED                 -- ✅ safe for concurrent ticks
-  `, [MAX_RETRY, BATCH]);
+  `, [MAX_RETRY, BATCH, lookbackDays]);
   return rows;
 }
 
 // ── 4. Call Flask /calculate ──────────────────────────────────────
+// X-Request-ID is echoed by Flask and tags its logs/traces, so a row's
+// attempt can be found on both sides
+function requestIdFor(row: PendingRow): string {
+  return `co2-worker-${row.id}-${row.retry_count}`;
+}
+
 async function callFlask(row: PendingRow): Promise<FlaskResult> {
   const res = await fetch(`${FLASK_URL}/calculate`, {
     method: "POST",
-    headers: { "Content-Type": "application/json" },
+    headers: { "Content-Type": "application/json", "X-Request-ID": requestIdFor(row) },
     body: JSON.stringify({
       model_name:     row.model,
       input_tokens:   row.input_tokens,
@@ -199,15 +213,16 @@ async function markFailure(client: any, id: number, msg: string): Promise<void>
 }
 
 // ── 7. One poll tick ──────────────────────────────────────────────
-async function tick(): Promise<void> {
+// Returns the number of rows claimed
+async function tick(lookbackDays: number | null = LOOKBACK_DAYS): Promise<number> {
   const client = await pool.connect();
   try {
     await client.query("BEGIN");
-    const rows = await fetchPending(client);
+    const rows = await fetchPending(client, lookbackDays);
 
     if (rows.length === 0) {
       await client.query("ROLLBACK");
-      return;
+      return 0;
     }
 
     console.log(`[CO2Worker] ⚙️  Processing ${rows.length} row(s)…`);
@@ -219,12 +234,13 @@ async function tick(): Promise<void> {
         await persistResult(client, row.id, result);
         console.log(`[CO2Worker] ✅ id=${row.id} model=${row.model} → co2=${result.co2_grams}g`);
       } catch (err: any) {
-        console.error(`[CO2Worker] ❌ id=${row.id} → ${err.message}`);
+        console.error(`[CO2Worker] ❌ id=${row.id} req=${requestIdFor(row)} → ${err.message}`);
         await markFailure(client, row.id, err.message);
       }
     }
 
     await client.query("COMMIT");
+    return rows.length;
   } catch (err) {
     await client.query("ROLLBACK");
     throw err;
@@ -236,6 +252,8 @@ async function tick(): Promise<void> {
 // ── 8. Public API ─────────────────────────────────────────────────
 let timer: NodeJS.Timeout | null = null;
 let running = false;
+let nextCatchup = 0;
+let catchingUp = false;
 
 export async function startCO2Worker(): Promise<void> {
   if (running) {
@@ -266,7 +284,13 @@ export async function startCO2Worker(): Promise<void> {
 
   const loop = async () => {
     try {
-      await tick();
+      const claimed = await tick();
+      if (claimed < BATCH && (catchingUp || Date.now() >= nextCatchup)) {
+        // Recent backlog drained: work through older rows a batch per poll
+        // until a catch-up tick comes back short
+        if (!catchingUp) nextCatchup = Date.now() + CATCHUP_MS;
+        catchingUp = (await tick(null)) === BATCH;
+      }
     } catch (err) {
       console.error("[CO2Worker] tick error:", err);
     }